@@ -0,0 +1,122 @@
+from __future__ import print_function
+from bokeh.plotting import figure, output_file, save
+from bokeh.layouts import row, column
+from bokeh.models import ColumnDataSource, LinearColorMapper, CustomJS, Button, Div
+from bokeh.palettes import Viridis256 as palette #@UnresolvedImport
+import argparse
+import numpy as np
+
+"""
+Benchmark page for the focal plane heatmap output backends. Draws a synthetic full focal plane
+(25 rafts x 9 CCDs x 16 amps) with the canvas and webgl backends side by side, plus a button that pans
+each figure for a fixed number of animation frames and reports the frame times.
+No eTraveler access is needed.
+"""
+
+
+class benchmarkFP():
+
+    def __init__(self, n_frames=200):
+
+        self.n_frames = n_frames
+        self.amp_width = 1 / 8.
+        self.ccd_width = 1.
+
+        # same geometry as renderFocalPlane
+        raft_center = [-6., -3., 0., 3., 6.]
+        ccd_center = [-1., 0., 1.]
+        amp_center_x = [-self.ccd_width / 2. - self.amp_width / 2. + (j + 1) / 8. for j in range(8)] * 2
+        amp_center_y = [-0.25] * 8 + [0.25] * 8
+
+        x = []
+        y = []
+        for raft_x in raft_center:
+            for raft_y in raft_center:
+                for ccd_x in ccd_center:
+                    for ccd_y in ccd_center:
+                        for amp in range(16):
+                            x.append(raft_x + ccd_x + amp_center_x[amp])
+                            y.append(raft_y + ccd_y + amp_center_y[amp])
+
+        self.x = np.array(x)
+        self.y = np.array(y)
+        self.test_q = np.random.normal(loc=1., scale=0.1, size=len(x)).astype(np.float32)
+
+    def make_figure(self, backend=None):
+
+        source = ColumnDataSource(data=dict(x=self.x, y=self.y, test_q=self.test_q))
+        color_mapper = LinearColorMapper(palette=palette, low=0.7, high=1.3)
+
+        p = figure(title="Backend: " + backend + " (" + str(len(self.x)) + " amps)",
+                   tools="pan, wheel_zoom, box_zoom, reset, hover",
+                   tooltips=[("value", "@test_q")], output_backend=backend,
+                   x_axis_location=None, y_axis_location=None, width=600, height=600)
+        p.grid.grid_line_color = None
+        p.rect(x='x', y='y', source=source, width=self.amp_width, height=self.ccd_width / 2.,
+               color="black", fill_alpha=0.7, fill_color={'field': 'test_q', 'transform': color_mapper},
+               line_width=0.5)
+        return p
+
+    def make_timer(self, p=None):
+        """
+        Button + Div which pan the figure over n_frames animation frames and report frame times
+        :param p: figure to pan
+        :return: bokeh column of the button and the result Div
+        """
+        result = Div(text="not run", width=600)
+        button = Button(label="Time " + p.output_backend, button_type="success", width=150)
+        button.js_on_click(CustomJS(args=dict(x_range=p.x_range, result=result, n_frames=self.n_frames),
+                                    code="""
+            const start = x_range.start;
+            const end = x_range.end;
+            const times = [];
+            let frame = 0;
+            let last = performance.now();
+
+            function step(now) {
+                times.push(now - last);
+                last = now;
+                const shift = 2. * Math.sin(2. * Math.PI * frame / 50.);
+                x_range.setv({start: start + shift, end: end + shift});
+                frame += 1;
+                if (frame < n_frames) {
+                    requestAnimationFrame(step);
+                } else {
+                    x_range.setv({start: start, end: end});
+                    times.shift();
+                    times.sort(function(a, b) {return a - b;});
+                    const mean = times.reduce(function(a, b) {return a + b;}, 0) / times.length;
+                    const median = times[Math.floor(times.length / 2)];
+                    const p95 = times[Math.floor(0.95 * (times.length - 1))];
+                    result.text = "frames: " + times.length + " mean: " + mean.toFixed(1) +
+                        " ms median: " + median.toFixed(1) + " ms 95%: " + p95.toFixed(1) + " ms";
+                }
+            }
+            requestAnimationFrame(step);
+            """))
+        return column(button, result)
+
+    def write_page(self, out_file=None):
+
+        figs = [self.make_figure(backend=backend) for backend in ["canvas", "webgl"]]
+        page = row([column(self.make_timer(p), p) for p in figs])
+
+        output_file(out_file, title="Focal plane backend benchmark")
+        save(page)
+
+
+if __name__ == "__main__":
+
+    ## Command line arguments
+    parser = argparse.ArgumentParser(
+        description='Write a page comparing canvas and webgl frame times for the full focal plane heatmap')
+
+    parser.add_argument('-o', '--output', default='benchmarkFP.html',
+                        help="output html file (default=%(default)s)")
+    parser.add_argument('-n', '--n_frames', default=200, type=int,
+                        help="number of animation frames to time (default=%(default)s)")
+
+    args = parser.parse_args()
+
+    bFP = benchmarkFP(n_frames=args.n_frames)
+    bFP.write_page(out_file=args.output)
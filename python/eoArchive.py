@@ -0,0 +1,252 @@
+from __future__ import print_function
+import json
+import sqlite3
+import threading
+import time
+import argparse
+import pandas as pd
+from get_EO_analysis_results import get_EO_analysis_results
+from exploreFocalPlane import exploreFocalPlane
+from exploreRaft import exploreRaft
+from eTraveler.clientAPI.connection import Connection
+from get_steps_schema import get_steps_schema
+import focalPlaneArrays as fpa
+
+"""
+Local SQLite archive of EO analysis results, one row per (run, test, raft, CCD, amp) with the raft and CCD
+serial numbers, plus run metadata from getRunResults. Prod and Dev runs can share an archive file: every row
+is keyed by the eT database as well as the run number, and an eoArchive only sees its own database's runs.
+
+eoArchive is also a read-through stand-in for get_EO_analysis_results (get_tests, get_all_results,
+get_results), get_steps_schema (get_test_info) and the eTraveler Connection (getRunResults): runs not yet in
+the archive are fetched from eTraveler once and stored. query() gives indexed lookups across runs,
+e.g. the gain of one CCD in every archived run.
+
+Ingest runs from the command line with
+    python eoArchive.py -f eo_results.db -r 12345 12346
+"""
+
+
+class eoArchive():
+
+    def __init__(self, db_file=None, db='Prod', server='Prod', site_type="I&T-Raft"):
+
+        self.db_file = db_file
+        self.db = db
+        self.server = server
+        self.site_type = site_type
+
+        # live eTraveler access, set up on the first read-through
+        self.live = None
+
+        # the archive is shared by the server's fetch threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, timeout=60.)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (db TEXT, run TEXT, kind TEXT, device TEXT, site_type TEXT,
+                                             tests TEXT, metadata TEXT, ingested REAL, PRIMARY KEY (db, run));
+            CREATE TABLE IF NOT EXISTS results (db TEXT, run TEXT, test TEXT, seq INTEGER, raft_slot TEXT,
+                                                raft TEXT, ccd_slot TEXT, ccd TEXT, amp INTEGER, value REAL);
+            CREATE INDEX IF NOT EXISTS results_run ON results (db, run, test, seq, amp);
+            CREATE INDEX IF NOT EXISTS results_ccd ON results (db, ccd, test);
+            CREATE INDEX IF NOT EXISTS results_raft ON results (db, raft, test);
+            """)
+        self.conn.commit()
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(runs)")]
+        if "db" not in columns:
+            print("Archive ", db_file, " predates the per-database keys - re-ingest its runs into a new file")
+            raise ValueError("Outdated archive file: " + str(db_file))
+
+    def connect_live(self):
+        if self.live is None:
+            pS = self.server == 'Prod'
+            self.live = {"get_EO": get_EO_analysis_results(db=self.db, server=self.server),
+                         "connect": Connection(operator='richard', db=self.db, exp='LSST-CAMERA', prodServer=pS),
+                         "eFP": exploreFocalPlane(db=self.db, prodServer=self.server),
+                         "eR": exploreRaft(db=self.db, prodServer=self.server),
+                         "get_step": get_steps_schema()}
+        return self.live
+
+    def has_run(self, run=None):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM runs WHERE db = ? AND run = ?", (self.db, str(run))).fetchone()
+        return row is not None
+
+    def serial_maps(self, run=None, kind=None, device=None):
+        """
+        Raft and CCD serial numbers for a run, looked up at ingest time
+        :return: BOT: ({raft slot: raft serial}, {raft slot: {ccd slot: ccd serial}});
+        single raft: (None, {ccd serial: ccd slot})
+        """
+        live = self.connect_live()
+        try:
+            if kind == "BOT":
+                rafts = {raft[1]: raft[0] for raft in live["eFP"].focalPlaneContents(run=run)}
+                ccds = {}
+                for slot, raft in rafts.items():
+                    contents = live["eR"].raftContents(raftName=raft, run=run)
+                    if slot in fpa.corner_raft_slots:
+                        # raftContents lists the corner raft sensors as W0, W1, G0, G1
+                        ccds[slot] = dict(zip(["SW0", "SW1", "SG0", "SG1"], [ccd[0] for ccd in contents]))
+                    else:
+                        ccds[slot] = {ccd[1]: ccd[0] for ccd in contents}
+                return rafts, ccds
+            contents = live["eR"].raftContents(raftName=device, run=run)
+            return None, {ccd[0]: ccd[1] for ccd in contents}
+        except Exception as e:
+            print("Archive: no serial numbers for run ", run, ": ", repr(e))
+            return {}, {}
+
+    def ingest_run(self, run=None, site_type=None, force=False):
+        """
+        Fetch all test results and the run metadata for a run from eTraveler and store them
+        :param run: run number
+        :param site_type: EO site type for get_tests
+        :param force: re-ingest a run already in the archive
+        :return: nothing
+        """
+        run = str(run)
+        if not force and self.has_run(run=run):
+            return
+        if site_type is None:
+            site_type = self.site_type
+
+        live = self.connect_live()
+        device, data = live["get_EO"].get_tests(site_type=site_type, run=run)
+        res = live["get_EO"].get_all_results(data=data, device=device)
+        tests = list(live["get_step"].get_test_info(runData=data))
+        info = live["connect"].getRunResults(run=run)
+        metadata = {k: v for k, v in info.items() if not isinstance(v, (dict, list))}
+
+        # BOT results are {test: {raft slot: {ccd slot: values}}}; single raft results {test: {ccd: values}}
+        first = next(iter(res.values()), {})
+        kind = "BOT" if isinstance(next(iter(first.values()), None), dict) else "raft"
+        rafts, ccds = self.serial_maps(run=run, kind=kind, device=device)
+
+        rows = []
+        seq = 0
+        for test, test_res in res.items():
+            if kind == "BOT":
+                groups = [(raft_slot, rafts.get(raft_slot), ccd_slot, ccds.get(raft_slot, {}).get(ccd_slot),
+                           values) for raft_slot in test_res for ccd_slot, values in test_res[raft_slot].items()]
+            else:
+                groups = [(None, device, ccds.get(ccd), ccd, values) for ccd, values in test_res.items()]
+            for raft_slot, raft, ccd_slot, ccd, values in groups:
+                rows.extend((self.db, run, test, seq, raft_slot, raft, ccd_slot, ccd, amp, value)
+                            for amp, value in enumerate(values))
+                seq += 1
+
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM results WHERE db = ? AND run = ?", (self.db, run))
+                self.conn.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (self.db, run, kind, str(device), site_type, json.dumps(tests),
+                                   json.dumps(metadata, default=str), time.time()))
+        print("Archived run ", run, " (", kind, "): ", len(rows), " values")
+
+    def run_row(self, run=None, site_type=None):
+        """
+        Run entry, ingesting the run first if it is not in the archive
+        :return: (kind, device, tests, metadata)
+        """
+        run = str(run)
+        if not self.has_run(run=run):
+            self.ingest_run(run=run, site_type=site_type)
+        with self.lock:
+            kind, device, tests, metadata = self.conn.execute(
+                "SELECT kind, device, tests, metadata FROM runs WHERE db = ? AND run = ?", (self.db, run)).fetchone()
+        return kind, device, json.loads(tests), json.loads(metadata)
+
+    def read_results(self, run=None, test=None):
+        """
+        :param run: run number
+        :param test: test name; all tests if None
+        :return: results in the get_all_results layout
+        """
+        kind = self.run_row(run=run)[0]
+        sql = "SELECT test, raft_slot, ccd_slot, ccd, value FROM results WHERE db = ? AND run = ?"
+        params = [self.db, str(run)]
+        if test is not None:
+            sql += " AND test = ?"
+            params.append(test)
+        with self.lock:
+            rows = self.conn.execute(sql + " ORDER BY seq, amp", params).fetchall()
+
+        res = {}
+        for test_name, raft_slot, ccd_slot, ccd, value in rows:
+            if kind == "BOT":
+                values = res.setdefault(test_name, {}).setdefault(raft_slot, {}).setdefault(ccd_slot, [])
+            else:
+                values = res.setdefault(test_name, {}).setdefault(ccd, [])
+            values.append(float("nan") if value is None else value)
+        return res
+
+    # get_EO_analysis_results interface
+
+    def get_tests(self, site_type=None, run=None, test_type=None):
+        device = self.run_row(run=run, site_type=site_type)[1]
+        return device, {"archive_run": str(run)}
+
+    def get_all_results(self, data=None, device=None):
+        return self.read_results(run=data["archive_run"])
+
+    def get_results(self, test_type=None, data=None, device=None):
+        run = data["archive_run"]
+        res = self.read_results(run=run, test=test_type)
+        if test_type not in res:
+            print("Archive: run ", run, " has no ", test_type)
+            raise KeyError(test_type)
+        # as get_EO_analysis_results: BOT results keep the test level, single raft results do not
+        if self.run_row(run=run)[0] == "BOT":
+            return res
+        return res[test_type]
+
+    # get_steps_schema and Connection interfaces
+
+    def get_test_info(self, runData=None):
+        return self.run_row(run=runData["archive_run"])[2]
+
+    def getRunResults(self, run=None):
+        return self.run_row(run=run)[3]
+
+    def query(self, test=None, run=None, raft=None, ccd=None, raft_slot=None, ccd_slot=None):
+        """
+        Indexed lookup of archived values across this database's runs, e.g. query(test="gain", ccd=<CCD serial>)
+        :return: DataFrame with columns run, test, raft_slot, raft, ccd_slot, ccd, amp, value
+        """
+        selection = {"db": self.db, "test": test, "run": None if run is None else str(run), "raft": raft,
+                     "ccd": ccd, "raft_slot": raft_slot, "ccd_slot": ccd_slot}
+        where = [(k, v) for k, v in selection.items() if v is not None]
+        sql = "SELECT run, test, raft_slot, raft, ccd_slot, ccd, amp, value FROM results WHERE " + \
+            " AND ".join(k + " = ?" for k, _ in where)
+        with self.lock:
+            return pd.read_sql_query(sql + " ORDER BY run, seq, amp", self.conn, params=[v for _, v in where])
+
+    def runs(self):
+        """
+        :return: DataFrame of the archived runs
+        """
+        with self.lock:
+            return pd.read_sql_query("SELECT run, kind, device, site_type, ingested FROM runs WHERE db = ? "
+                                     "ORDER BY run", self.conn, params=[self.db])
+
+
+if __name__ == "__main__":
+
+    ## Command line arguments
+    parser = argparse.ArgumentParser(
+        description='Ingest EO test results for runs into a local archive')
+
+    parser.add_argument('-f', '--file', default="eo_results.db", help="archive file (default=%(default)s)")
+    parser.add_argument('-r', '--runs', nargs="+", default=[], help="runs to ingest")
+    parser.add_argument('-s', '--site_type', default="I&T-Raft", help="EO site type (default=%(default)s)")
+    parser.add_argument('-d', '--db', default='Prod', help="eT database (default=%(default)s)")
+    parser.add_argument('--force', action='store_true', help="re-ingest runs already in the archive")
+
+    args = parser.parse_args()
+
+    archive = eoArchive(db_file=args.file, db=args.db, site_type=args.site_type)
+    for run in args.runs:
+        archive.ingest_run(run=run, force=args.force)
+    print(archive.runs())
@@ -0,0 +1,89 @@
+from __future__ import print_function
+import numpy as np
+import pandas as pd
+import focalPlaneArrays as fpa
+
+"""
+Table of EO test requirements (test quantity -> threshold, direction, requirement ID) and their vectorized
+evaluation over the focal plane arrays of a run (see focalPlaneArrays).
+
+Additional requirements can be read from a csv file with columns test, threshold, direction, id, e.g.
+
+test, threshold, direction, id
+total_noise, 9., max, C-SRFT-073
+
+direction is "max" if the value must not exceed the threshold, "min" if it must not fall below it.
+"""
+
+
+class eoRequirements():
+
+    def __init__(self, req_file=None):
+
+        self.requirements = {}
+        self.requirements['total_noise'] = {"threshold": 9., "direction": "max", "id": "C-SRFT-073"}
+
+        if req_file is not None:
+            self.read_requirements(req_file=req_file)
+
+    def read_requirements(self, req_file=None):
+        """
+        Add (or override) requirements from a csv file
+        :param req_file: file spec or file-like object
+        :return: nothing
+        """
+        df = pd.read_csv(req_file, header=0, skipinitialspace=True)
+        for _, req in df.iterrows():
+            direction = str(req["direction"]).strip().lower()
+            if direction not in ["max", "min"]:
+                print("Requirement for ", req["test"], " - unknown direction: ", direction)
+                raise ValueError
+            self.requirements[str(req["test"]).strip()] = {"threshold": float(req["threshold"]),
+                                                           "direction": direction,
+                                                           "id": str(req["id"]).strip()}
+
+    def has_requirement(self, test=None):
+        return test in self.requirements
+
+    def threshold(self, test=None):
+        """
+        :param test: test quantity name
+        :return: requirement threshold; KeyError if there is no requirement for the test
+        """
+        return self.requirements[test]["threshold"]
+
+    def fail_mask(self, test=None, values=None):
+        """
+        Evaluate one requirement
+        :param test: test quantity name
+        :param values: array of values of the test quantity, any shape
+        :return: boolean array, True where the value fails the requirement. Missing (NaN) values do not fail
+        """
+        req = self.requirements[test]
+        values = np.asarray(values)
+        with np.errstate(invalid="ignore"):
+            if req["direction"] == "max":
+                return values > req["threshold"]
+            return values < req["threshold"]
+
+    def evaluate(self, store=None):
+        """
+        Evaluate every requirement whose test is in the store
+        :param store: dict {test name: (25, 9, 16) focal plane array} for a run
+        :return: dict {test name: (25, 9, 16) boolean fail mask}, plus "any" - failing any requirement
+        """
+        masks = {test: self.fail_mask(test=test, values=store[test]) for test in self.requirements
+                 if test in store}
+        any_fail = np.zeros((fpa.n_raft, fpa.n_ccd, fpa.n_amp), dtype=bool)
+        for mask in masks.values():
+            any_fail |= mask
+        masks["any"] = any_fail
+        return masks
+
+    def failure_counts(self, mask=None):
+        """
+        :param mask: (25, 9, 16) fail mask
+        :return: dict with the number of failing amps per raft, shape (25,), and per CCD, shape (25, 9)
+        """
+        ccd = mask.sum(axis=-1)
+        return {"raft": ccd.sum(axis=-1), "ccd": ccd}
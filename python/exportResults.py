@@ -0,0 +1,141 @@
+from __future__ import print_function
+import os
+import argparse
+import numpy as np
+from focalPlaneData import focalPlaneData
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""
+Bulk export of per-amp EO test results to columnar files, one row per (raft, CCD, amp) and one float32
+column per test quantity, for scans with pandas/pyarrow.
+
+Runs are fetched a few at a time (focalPlaneData.max_fetch_workers), written and dropped from the caches, so
+memory stays bounded over any number of runs. The output is partitioned by run, hive style:
+
+    <out_dir>/run=12540/part-0.parquet
+    <out_dir>/run=12541/part-0.parquet
+
+so e.g. pandas.read_parquet(out_dir, filters=[("run", "in", ["12540"])]) only reads the runs asked for.
+Runs already exported are skipped, so an interrupted export can be restarted. Needs pyarrow.
+
+    python exportResults.py -r 12540-12560 12600 -o eo_results [-t gain read_noise] [--format arrow]
+"""
+
+
+class exportResults():
+
+    def __init__(self, data=None, out_dir="eo_results", file_format="parquet", compression="zstd"):
+        """
+        :param data: focalPlaneData to read the runs through; a new one if None
+        :param out_dir: output directory
+        :param file_format: "parquet" or "arrow" (Arrow IPC file)
+        :param compression: parquet compression codec
+        """
+        if file_format not in ["parquet", "arrow"]:
+            print("Unknown export format: ", file_format)
+            raise ValueError
+
+        self.data = data if data is not None else focalPlaneData()
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.compression = compression
+
+    def run_file(self, run=None):
+        return os.path.join(self.out_dir, "run=" + str(run), "part-0." + self.file_format)
+
+    def run_table(self, run=None, tests=None):
+        """
+        :param run: run number (in the cache)
+        :param tests: test columns to write; all of the run's tests if None. Tests the run does not have are
+        written as all-NaN columns, so every run file has the same schema
+        :return: pyarrow Table of the run
+        """
+        available = list(self.data.array_cache[run])
+        present = available if tests is None else [test for test in tests if test in available]
+        df = self.data.frame(run=run, tests=present)
+        # the run is the partition key - it is not repeated in the files
+        df = df.drop(columns=["run"])
+        for test in tests if tests is not None else []:
+            if test not in present:
+                df[test] = np.float32(np.nan)
+
+        schema = pa.schema([("raft_slot", pa.string()), ("ccd_slot", pa.string()), ("amp", pa.int8()),
+                            ("raft", pa.string()), ("ccd", pa.string())] +
+                           [(test, pa.float32()) for test in (present if tests is None else tests)])
+        return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    def write_table(self, table=None, file_spec=None):
+        os.makedirs(os.path.dirname(file_spec), exist_ok=True)
+        tmp_file = file_spec + ".tmp"
+        if self.file_format == "parquet":
+            pq.write_table(table, tmp_file, compression=self.compression)
+        else:
+            with pa.OSFile(tmp_file, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        # only complete files get the final name
+        os.replace(tmp_file, file_spec)
+
+    def export_runs(self, runs=None, tests=None, force=False):
+        """
+        Export runs, fetching max_fetch_workers of them at a time
+        :param runs: list of (BOT) run numbers
+        :param tests: test columns to write (all of each run's tests if None)
+        :param force: re-export runs already written
+        :return: (list of runs written, list of runs that could not be fetched)
+        """
+        if pa is None:
+            print("Export needs pyarrow")
+            raise ValueError
+
+        todo = [str(run) for run in dict.fromkeys(runs)
+                if force or not os.path.exists(self.run_file(run=run))]
+        written = []
+        failed = []
+        chunk = self.data.max_fetch_workers
+        for i in range(0, len(todo), chunk):
+            batch = todo[i:i + chunk]
+            # runs the caller already has cached are kept; the others are dropped once written
+            fetched = [run for run in batch if run not in self.data.test_cache]
+            failed.extend(self.data.fill_run_caches(runs=batch))
+            for run in batch:
+                if run in failed:
+                    continue
+                self.write_table(table=self.run_table(run=run, tests=tests), file_spec=self.run_file(run=run))
+                written.append(run)
+                print("Exported run ", run, " to ", self.run_file(run=run))
+            for run in fetched:
+                self.data.release_run(run=run)
+        return written, failed
+
+
+if __name__ == "__main__":
+
+    ## Command line arguments
+    parser = argparse.ArgumentParser(
+        description='Export per-amp EO test results of BOT runs to Parquet/Arrow files partitioned by run')
+
+    parser.add_argument('-r', '--runs', nargs="+", required=True,
+                        help="runs and/or run ranges, e.g. 12540-12560 12600")
+    parser.add_argument('-t', '--tests', nargs="+", default=None, help="test names (default: all)")
+    parser.add_argument('-o', '--output', default="eo_results", help="output directory (default=%(default)s)")
+    parser.add_argument('--format', default="parquet", choices=["parquet", "arrow"],
+                        help="file format (default=%(default)s)")
+    parser.add_argument('--compression', default="zstd", help="parquet compression (default=%(default)s)")
+    parser.add_argument('--force', action='store_true', help="re-export runs already written")
+    parser.add_argument('--archive', default=None, help="local archive file of EO results (see eoArchive)")
+
+    args = parser.parse_args()
+
+    fpD = focalPlaneData()
+    if args.archive is not None:
+        fpD.use_archive(db_file=args.archive)
+    eR = exportResults(data=fpD, out_dir=args.output, file_format=args.format, compression=args.compression)
+
+    runs = fpD.parse_run_list(text=",".join(args.runs))
+    written, failed = eR.export_runs(runs=runs, tests=args.tests, force=args.force)
+    print("Exported ", len(written), " runs; could not fetch ", failed)
@@ -0,0 +1,240 @@
+from __future__ import print_function
+import warnings
+import numpy as np
+
+"""
+Fixed-shape NumPy layout for per-amp focal plane test quantities.
+
+A focal plane array has shape (25, 9, 16): raft slot (ordered as raft_slot_names), CCD position in the
+raft, amp. Science rafts use CCD positions 0-8 in the order of ccd_slot_names; corner rafts use
+positions 0-3 for SG0, SG1, SW0, SW1 with only amps 0-7 filled for the wavefront half-sensors.
+Missing rafts, CCDs and amps are NaN.
+"""
+
+raft_slot_names = ["R40", "R41", "R42", "R43", "R44",
+                   "R30", "R31", "R32", "R33", "R34",
+                   "R20", "R21", "R22", "R23", "R24",
+                   "R10", "R11", "R12", "R13", "R14",
+                   "R00", "R01", "R02", "R03", "R04"]
+corner_raft_slots = ["R00", "R04", "R40", "R44"]
+
+ccd_slot_names = ['S00', 'S01', 'S02',
+                  'S10', 'S11', 'S12',
+                  'S20', 'S21', 'S22']
+corner_raft_ccd_slots = ["SG0", "SG1", "SW0", "SW1"]
+
+n_raft = 25
+n_ccd = 9
+n_amp = 16
+
+# amps with data in each corner raft CCD position
+corner_raft_n_amp = {"SG0": 16, "SG1": 16, "SW0": 8, "SW1": 8}
+
+raft_index = {slot: i for i, slot in enumerate(raft_slot_names)}
+ccd_index = {slot: i for i, slot in enumerate(ccd_slot_names)}
+ccd_index.update({slot: i for i, slot in enumerate(corner_raft_ccd_slots)})
+
+
+def empty_array(dtype=np.float32):
+    """
+    :return: all-NaN focal plane array
+    """
+    return np.full((n_raft, n_ccd, n_amp), np.nan, dtype=dtype)
+
+
+def slot_labels():
+    """
+    :return: flat (3600,) arrays of the raft slot, CCD slot and amp number (1-16) of each element of a focal
+    plane array. Corner raft positions 4-8 have an empty CCD slot
+    """
+    corner_ccds = corner_raft_ccd_slots + [""] * (n_ccd - len(corner_raft_ccd_slots))
+    ccds = [corner_ccds if slot in corner_raft_slots else ccd_slot_names for slot in raft_slot_names]
+    raft_labels = np.repeat(np.array(raft_slot_names, dtype=object), n_ccd * n_amp)
+    ccd_labels = np.repeat(np.array(ccds, dtype=object).ravel(), n_amp)
+    amp_labels = np.tile(np.arange(1, n_amp + 1), n_raft * n_ccd)
+    return raft_labels, ccd_labels, amp_labels
+
+
+def results_to_array(res, dtype=np.float32):
+    """
+    Convert one test quantity from get_all_results for a BOT run to a focal plane array
+    :param res: dict {raft slot: {ccd slot: list of amp values}}
+    :param dtype: array dtype
+    :return: (25, 9, 16) array, NaN where there is no data
+    """
+    arr = empty_array(dtype=dtype)
+    for raft_slot in res:
+        if raft_slot not in raft_index:
+            continue
+        r = raft_index[raft_slot]
+        for ccd_slot in res[raft_slot]:
+            if ccd_slot not in ccd_index:
+                continue
+            vals = np.asarray(res[raft_slot][ccd_slot], dtype=dtype)[:n_amp]
+            if ccd_slot in corner_raft_n_amp:
+                vals = vals[:corner_raft_n_amp[ccd_slot]]
+            arr[r, ccd_index[ccd_slot], :len(vals)] = vals
+    return arr
+
+
+def raft_vector(arr, raft_slot):
+    """
+    Flatten one raft of a focal plane array into the per-raft vector used by renderFocalPlane:
+    144 values (9 CCDs x 16 amps) for science rafts; 48 values for corner rafts (SG0, SG1 with 16 amps,
+    SW0, SW1 with 8 amps each)
+    :param arr: (25, 9, 16) focal plane array
+    :param raft_slot: raft slot name
+    :return: 1-d array
+    """
+    raft = arr[raft_index[raft_slot]]
+    if raft_slot in corner_raft_slots:
+        return np.concatenate([raft[0], raft[1], raft[2, :8], raft[3, :8]])
+    return raft.ravel()
+
+
+def ccd_vector(arr, raft_slot, ccd_slot):
+    """
+    :param arr: (25, 9, 16) focal plane array
+    :param raft_slot: raft slot name
+    :param ccd_slot: CCD slot name
+    :return: the 16 amp values of one CCD (NaN padded for the wavefront half-sensors)
+    """
+    return arr[raft_index[raft_slot], ccd_index[ccd_slot]]
+
+
+def nan_range(values):
+    """
+    NaN-aware range of a set of values
+    :param values: array
+    :return: (lo, hi); (0., 1.) if there are no finite values
+    """
+    finite = np.asarray(values)[np.isfinite(values)]
+    if len(finite) == 0:
+        return 0., 1.
+    return float(finite.min()), float(finite.max())
+
+
+def grouped_matrix(values, codes, n_groups):
+    """
+    Arrange values into one row per group, NaN padded, so per-group statistics are single array operations
+    :param values: 1-d array
+    :param codes: integer group code for each value, 0 <= code < n_groups
+    :param n_groups: number of groups
+    :return: (n_groups, largest group size) float array
+    """
+    codes = np.asarray(codes, dtype=int)
+    counts = np.bincount(codes, minlength=n_groups)
+    order = np.argsort(codes, kind="stable")
+    starts = np.cumsum(counts) - counts
+    pos = np.arange(len(codes)) - np.repeat(starts, counts)
+    mat = np.full((n_groups, max(1, counts.max(initial=0))), np.nan)
+    mat[codes[order], pos] = np.asarray(values)[order]
+    return mat
+
+
+def group_stats(values, codes, n_groups, lo=None, hi=None):
+    """
+    Per-group summary of values grouped by integer code (e.g. amps by CCD or by raft)
+    :param values: 1-d array, NaN for missing
+    :param codes: integer group code for each value
+    :param n_groups: number of groups
+    :param lo: low end of the allowed range, for counting out of range values
+    :param hi: high end of the allowed range
+    :return: dict of per-group arrays: median, min, max, count (finite values), n_out (out of range)
+    """
+    mat = grouped_matrix(values, codes, n_groups)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)   # all-NaN groups give NaN
+        stats = {"median": np.nanmedian(mat, axis=1), "min": np.nanmin(mat, axis=1),
+                 "max": np.nanmax(mat, axis=1)}
+    stats["count"] = np.isfinite(mat).sum(axis=1)
+    n_out = np.zeros(n_groups, dtype=int)
+    if lo is not None:
+        n_out += (mat < lo).sum(axis=1)
+    if hi is not None:
+        n_out += (mat > hi).sum(axis=1)
+    stats["n_out"] = n_out
+    return stats
+
+
+def amp_mask():
+    """
+    :return: (25, 9, 16) boolean array, True where an amp exists (unused corner raft positions and the
+    padding of the wavefront half-sensors are False)
+    """
+    mask = np.ones((n_raft, n_ccd, n_amp), dtype=bool)
+    for slot in corner_raft_slots:
+        r = raft_index[slot]
+        mask[r, len(corner_raft_ccd_slots):] = False
+        for ccd_slot, n in corner_raft_n_amp.items():
+            mask[r, ccd_index[ccd_slot], n:] = False
+    return mask
+
+
+def summary_stats(arr, percentiles=(1, 5, 25, 75, 95, 99)):
+    """
+    Robust statistics of a focal plane array at focal plane, raft and CCD granularity
+    :param arr: (25, 9, 16) focal plane array
+    :param percentiles: percentiles to compute
+    :return: dict {"focal_plane": {...}, "raft": {...}, "ccd": {...}}, each with median, mad (median absolute
+    deviation), p<N> for each percentile, n_nan (existing amps without data) and count (amps with data).
+    Values are scalars for the focal plane, shape (25,) for rafts and (25, 9) for CCDs
+    """
+    missing = np.isnan(arr) & amp_mask()
+    finite = np.isfinite(arr)
+
+    levels = {"focal_plane": (arr.reshape(1, -1), missing.reshape(1, -1), finite.reshape(1, -1)),
+              "raft": (arr.reshape(n_raft, -1), missing.reshape(n_raft, -1), finite.reshape(n_raft, -1)),
+              "ccd": (arr, missing, finite)}
+
+    stats = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)   # all-NaN rafts/CCDs give NaN
+        for level, (values, level_missing, level_finite) in levels.items():
+            median = np.nanmedian(values, axis=-1)
+            s = {"median": median,
+                 "mad": np.nanmedian(np.abs(values - median[..., np.newaxis]), axis=-1),
+                 "n_nan": level_missing.sum(axis=-1),
+                 "count": level_finite.sum(axis=-1)}
+            pct = np.nanpercentile(values, percentiles, axis=-1)
+            for p, v in zip(percentiles, pct):
+                s["p" + str(p)] = v
+            if level == "focal_plane":
+                s = {k: v[0] for k, v in s.items()}
+            stats[level] = s
+    return stats
+
+
+def trend_slope(matrix):
+    """
+    Least-squares slope of each row of a matrix against the column index, ignoring NaN - e.g. the drift per run
+    of each amp in an (amp x run) matrix
+    :param matrix: (n, n_col) array
+    :return: (n,) float32 array of slopes; NaN for rows with fewer than two finite values
+    """
+    ok = np.isfinite(matrix)
+    n = ok.sum(axis=-1)
+    x = np.broadcast_to(np.arange(matrix.shape[-1], dtype=np.float64), matrix.shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean = np.where(ok, x, 0.).sum(axis=-1) / n
+        y_mean = np.where(ok, matrix, 0.).sum(axis=-1) / n
+        dx = np.where(ok, x - x_mean[:, np.newaxis], 0.)
+        dy = np.where(ok, matrix - y_mean[:, np.newaxis], 0.)
+        slope = (dx * dy).sum(axis=-1) / (dx * dx).sum(axis=-1)
+    slope[n < 2] = np.nan
+    return slope.astype(np.float32)
+
+
+def array_to_results(arr, layout):
+    """
+    Inverse of results_to_array: per-amp lists in the get_all_results layout of a BOT run
+    :param arr: (25, 9, 16) focal plane array
+    :param layout: dict {raft slot: list of CCD slots} to fill
+    :return: dict {raft slot: {ccd slot: list of amp values}}
+    """
+    res = {}
+    for raft_slot, ccd_slots in layout.items():
+        r = raft_index[raft_slot]
+        res[raft_slot] = {ccd_slot: arr[r, ccd_index[ccd_slot], :corner_raft_n_amp.get(ccd_slot, n_amp)].tolist()
+                          for ccd_slot in ccd_slots}
+    return res
@@ -0,0 +1,561 @@
+from __future__ import print_function
+import numpy as np
+import pandas as pd
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from get_EO_analysis_results import get_EO_analysis_results
+from exploreFocalPlane import exploreFocalPlane
+from exploreRaft import exploreRaft
+from eTraveler.clientAPI.connection import Connection
+from get_steps_schema import get_steps_schema
+import focalPlaneArrays as fpa
+import runBundle
+from eoRequirements import eoRequirements
+from eoArchive import eoArchive
+from metadataCache import metadataCache
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+"""
+Headless access to the EO test results renderFocalPlane displays: the run caches, the focal plane and raft
+geometry lookups and the per-amp focal plane arrays, with no bokeh dependency - for notebooks and batch QA.
+
+    fpD = focalPlaneData()
+    df = fpD.frame(run="12345", tests=["gain", "read_noise"])    # one row per amp
+    arrays = fpD.arrays(run="12345")                             # {test: (25, 9, 16) float32 array}
+    ds = fpD.dataset(run="12345")                                # xarray Dataset, if xarray is installed
+
+An emulated focal plane of single raft runs is given by an emulation config file (csv with columns raft,
+slot, run), as for serveRenderFP.py --emulate:
+
+    df = fpD.frame(emulation="emulate.csv")
+"""
+
+
+class focalPlaneData():
+
+    def __init__(self, db='Prod', server='Prod'):
+
+        self.server = server
+        self.EO_type = "I&T-Raft"
+
+        if server == 'Prod':
+            pS = True
+        else:
+            pS = False
+
+        self.connections = {}
+        self.connections["connect"] = {
+            "Prod": Connection(operator='richard', db="Prod", exp='LSST-CAMERA', prodServer=pS),
+            "Dev": Connection(operator='richard', db="Dev", exp='LSST-CAMERA', prodServer=pS)}
+        self.connections["eFP"] = {"Prod": exploreFocalPlane(db="Prod", prodServer=server),
+                                   "Dev": exploreFocalPlane(db="Dev", prodServer=server)}
+        self.connections["eR"] = {"Prod": exploreRaft(db="Prod", prodServer=server),
+                                  "Dev": exploreRaft(db="Dev", prodServer=server)}
+        self.connections["get_EO"] = {"Prod": get_EO_analysis_results(db="Prod", server=server),
+                                      "Dev": get_EO_analysis_results(db="Dev", server=server)}
+        self.get_step = get_steps_schema()
+
+        # per run - BOT: get_all_results {test: {raft slot: {ccd slot: values}}};
+        # single raft: {raft: {test: {ccd: values}}}
+        self.test_cache = {}
+        # BOT runs: float32 focal plane arrays (see focalPlaneArrays) per run and test, filled with test_cache
+        self.array_cache = {}
+        # BOT runs: robust summary statistics per run and test (see focalPlaneArrays.summary_stats)
+        self.stats_cache = {}
+        # EO requirements, and per run the fail masks of all requirements (see eoRequirements.evaluate)
+        self.requirements = eoRequirements()
+        self.fail_cache = {}
+        # available tests per run, as (label, test) menu entries
+        self.menu_test_cache = {}
+        # focal plane arrays of emulated focal planes, per emulation config file
+        self.emulation_cache = {}
+        # maximum number of runs fetched concurrently
+        self.max_fetch_workers = 4
+        # BOT runs being fetched in full in the background after a single test fetch (see fill_run_test). The
+        # lock guards the cache updates against release_run and clear_cache on the server's event loop
+        self.background_fetches = {}
+        self.background_pool = None
+        self.cache_lock = threading.Lock()
+        # run info, focal plane and raft contents; persisted if given a cache file (see metadataCache)
+        self.metadata = metadataCache()
+
+        self.raft_labels, self.ccd_labels, self.amp_labels = fpa.slot_labels()
+        self.amp_exists = fpa.amp_mask().ravel()
+
+    def use_archive(self, db_file=None):
+        """
+        Read EO results, test lists and run metadata through a local archive (see eoArchive) instead of
+        querying eTraveler for every run. Runs not yet archived are fetched once and stored
+        :param db_file: archive file
+        :return: nothing
+        """
+        for db in ["Prod", "Dev"]:
+            archive = eoArchive(db_file=db_file, db=db, server=self.server, site_type=self.EO_type)
+            self.connections["get_EO"][db] = archive
+            self.connections["connect"][db] = archive
+        self.get_step = self.connections["get_EO"]["Prod"]
+
+    def clear_cache(self):
+        """
+        Empty the result caches in place (renderFocalPlane shares them)
+        :return: nothing
+        """
+        with self.cache_lock:
+            for cache in [self.test_cache, self.array_cache, self.stats_cache, self.fail_cache,
+                          self.menu_test_cache, self.emulation_cache]:
+                cache.clear()
+
+    def db_for_run(self, run=None):
+        if isinstance(run, str) and 'D' in run.upper():
+            return "Dev"
+        return "Prod"
+
+    def chk_11974(self, run=None):
+        outcome = True     # use prod
+        if isinstance(run, str) and 'D' in run.upper():
+            outcome = False
+        elif int(run) < 11974:
+            outcome = False
+
+        return outcome
+
+    def fill_run_cache(self, run=None):
+        """
+        Fetch all test quantities for a (BOT) run into the test cache, if not already there
+        :param run: run number
+        :return: nothing
+        """
+        if run in self.test_cache:
+            return
+
+        pending = self.background_fetches.get(run)
+        if pending is not None:
+            # the run is already on its way (see fill_run_test)
+            try:
+                pending.result()
+            except Exception:
+                pass    # fetched again below, so the caller sees the error
+        if run in self.test_cache:
+            return
+        self.fetch_run(run=run)
+
+    def fill_run_test(self, run=None, test=None, done=None):
+        """
+        Fetch just one test quantity of a (BOT) run, with the run's test menu as far as the test's get_tests
+        response lists it, so that it can be displayed at once; the rest of the run (and the complete menu) is
+        then fetched into the cache in a background thread. Other tests asked for meanwhile are fetched singly
+        too. A test the run does not have falls back to fetching the whole run
+        :param run: run number
+        :param test: test name
+        :param done: called from the background thread once the whole run is in the cache
+        :return: nothing
+        """
+        if run in self.test_cache or test in self.array_cache.get(run, {}):
+            return
+
+        get_EO = self.connections["get_EO"][self.db_for_run(run=run)]
+        raft_list, data = get_EO.get_tests(site_type=self.EO_type, run=run, test_type=test)
+        avail_tests = self.get_step.get_test_info(runData=data)
+        if test not in avail_tests:
+            self.fill_run_cache(run=run)
+            return
+        arr = fpa.results_to_array(get_EO.get_results(test_type=test, data=data, device=raft_list)[test])
+
+        with self.cache_lock:
+            if run in self.test_cache:
+                return
+            arrays = self.array_cache.setdefault(run, {})
+            arrays[test] = arr
+            self.summarize_run(run=run)
+            menu = self.menu_test_cache.setdefault(run, [])
+            menu.extend((t, t) for t in avail_tests if (t, t) not in menu)
+            if run in self.background_fetches:
+                return
+            if self.background_pool is None:
+                self.background_pool = ThreadPoolExecutor(max_workers=self.max_fetch_workers)
+            # the thread can only drop its entry once it is there - background_fetch takes the lock first
+            self.background_fetches[run] = self.background_pool.submit(self.background_fetch, run=run,
+                                                                       arrays=arrays, done=done)
+
+    def background_fetch(self, run=None, arrays=None, done=None):
+        fetched = False
+        try:
+            fetched = self.fetch_run(run=run, arrays=arrays)
+        except Exception as e:
+            print("Background fetch of run ", run, " failed: ", repr(e))
+        finally:
+            with self.cache_lock:
+                self.background_fetches.pop(run, None)
+        if fetched and done is not None:
+            done()
+
+    def fetch_run(self, run=None, arrays=None):
+        """
+        Fetch all test quantities for a (BOT) run into the test cache, completing any single test fetch
+        :param run: run number
+        :param arrays: the run's single test arrays the fetch completes (see fill_run_test). The results are
+        dropped if these are no longer cached, i.e. the run has been released or the cache cleared meanwhile
+        :return: True if the results were cached
+        """
+        # use get_EO to fetch the test quantities from the eT results database. The database is picked
+        # per run so that several runs can be fetched concurrently
+        get_EO = self.connections["get_EO"][self.db_for_run(run=run)]
+        raft_list, data = get_EO.get_tests(site_type=self.EO_type, run=run)
+        res = get_EO.get_all_results(data=data, device=raft_list)
+        avail_tests = self.get_step.get_test_info(runData=data)
+
+        with self.cache_lock:
+            if arrays is not None and self.array_cache.get(run) is not arrays:
+                return False
+            # arrays already there from fill_run_test are kept, so what was built from them stays valid
+            previous = self.array_cache.get(run, {})
+            self.array_cache[run] = {test: previous[test] if test in previous else
+                                     fpa.results_to_array(res[test]) for test in res}
+            self.summarize_run(run=run)
+            self.menu_test_cache[run] = [(t, t) for t in avail_tests]
+            # test_cache last: it marks the run as complete
+            self.test_cache[run] = res
+        return True
+
+    def summarize_run(self, run=None):
+        """
+        Summary statistics and requirement fail masks of a run's cached focal plane arrays
+        :param run: run number
+        :return: nothing
+        """
+        self.stats_cache[run] = {test: fpa.summary_stats(arr) for test, arr in self.array_cache[run].items()}
+        self.fail_cache[run] = self.requirements.evaluate(store=self.array_cache[run])
+
+    def fill_raft_run_cache(self, run=None, raft=None):
+        """
+        Fetch all test quantities for a single raft run (solo raft and emulation modes) into the test cache, if
+        not already there
+        :param run: run number
+        :param raft: raft name
+        :return: nothing
+        """
+        if run in self.test_cache and raft in self.test_cache[run]:
+            return
+
+        # use get_EO to fetch the test quantities from the eT results database
+        get_EO = self.connections["get_EO"][self.db_for_run(run=run)]
+        raft_list, data = get_EO.get_tests(site_type=self.EO_type, run=run)
+        res = get_EO.get_all_results(data=data, device=raft_list)
+        avail_tests = self.get_step.get_test_info(runData=data)
+        with self.cache_lock:
+            self.menu_test_cache[run] = [(t, t) for t in avail_tests]
+            c = self.test_cache.setdefault(run, {})
+            c[raft_list] = res
+
+    def fill_run_caches(self, runs=None):
+        """
+        Fetch several (BOT) runs into the cache concurrently, at most max_fetch_workers at a time, skipping
+        those already there
+        :param runs: list of run numbers
+        :return: list of the runs that could not be fetched
+        """
+        missing = [run for run in dict.fromkeys(runs) if run not in self.test_cache]
+        if len(missing) == 0:
+            return []
+
+        def fetch(run):
+            try:
+                self.fill_run_cache(run=run)
+            except Exception as e:
+                print("Failed to fetch run ", run, ": ", repr(e))
+                return run
+            return None
+
+        with ThreadPoolExecutor(max_workers=min(len(missing), self.max_fetch_workers)) as pool:
+            failed = list(pool.map(fetch, missing))
+        return [run for run in failed if run is not None]
+
+    def parse_run_list(self, text=None):
+        """
+        :param text: comma separated runs and/or ranges of (Prod) runs, e.g. "12540-12560, 12600, 6500D"
+        :return: list of run numbers (strings)
+        """
+        runs = []
+        for item in text.split(","):
+            item = item.strip()
+            if item == "":
+                continue
+            if "-" in item:
+                first, last = item.split("-", 1)
+                try:
+                    runs.extend([str(run) for run in range(int(first), int(last) + 1)])
+                except ValueError:
+                    print("Bad run range: ", item)
+                    raise
+            else:
+                runs.append(item)
+        return list(dict.fromkeys(runs))
+
+    def release_run(self, run=None):
+        """
+        Drop a run from the result caches
+        :param run: run number
+        :return: nothing
+        """
+        with self.cache_lock:
+            for cache in [self.test_cache, self.array_cache, self.stats_cache, self.fail_cache,
+                          self.menu_test_cache]:
+                cache.pop(run, None)
+
+    def fp_contents(self, run=None):
+        """
+        :param run: run number
+        :return: focal plane contents - list of [raft name, slot]. Runs before 11974 use the 11974 geometry
+        """
+        if not self.chk_11974(run):
+            run = 11974
+        return self.metadata.focalPlaneContents(eFP=self.connections["eFP"]["Prod"], db="Prod", run=run)
+
+    def geometry_run(self, run=None, emulate=False):
+        """
+        :param run: run number
+        :param emulate: run is a single raft run of an emulated focal plane
+        :return: (db, run) to look up the focal plane and raft contents of the run in - Prod run 11974 for Dev and
+        older BOT runs
+        """
+        if not emulate and not self.chk_11974(run):
+            return "Prod", 11974
+        return self.db_for_run(run=run), run
+
+    def raft_contents(self, raft_name=None, run=None, emulate=False):
+        """
+        :param raft_name: raft serial
+        :param run: run number
+        :param emulate: run is a single raft run of an emulated focal plane
+        :return: raftContents for the raft in the run; the run 11974 geometry for Dev and older BOT runs
+        """
+        db_k, use_run = self.geometry_run(run=run, emulate=emulate)
+        return self.metadata.raftContents(eR=self.connections["eR"][db_k], db=db_k, raftName=raft_name,
+                                          run=use_run)
+
+    def ccd_serials(self, raft_name=None, raft_slot=None, run=None, emulate=False):
+        """
+        :return: dict {ccd slot: ccd serial} for a raft in a run
+        """
+        contents = self.raft_contents(raft_name=raft_name, run=run, emulate=emulate)
+        if raft_slot in fpa.corner_raft_slots:
+            # raftContents lists the corner raft sensors as W0, W1, G0, G1
+            return dict(zip(["SW0", "SW1", "SG0", "SG1"], [ccd[0] for ccd in contents]))
+        return {ccd[1]: ccd[0] for ccd in contents}
+
+    def run_info(self, run=None):
+        """
+        :param run: run number
+        :return: scalar fields of getRunResults for the run (cached)
+        """
+        db = self.db_for_run(run=run)
+        return self.metadata.getRunResults(connect=self.connections["connect"][db], db=db, run=run)
+
+    def parse_emulation_config(self, file_spec=None):
+        """
+        :param file_spec: emulation config - csv with columns raft, slot, run
+        :return: list of [raft name, slot], list of runs indexed the same
+        """
+        df = pd.read_csv(file_spec, header=0, skipinitialspace=True)
+        raft_frame = df.set_index('raft', drop=False)
+
+        raft_col = raft_frame["raft"]
+        raft_list = []
+        run_list = []
+
+        for raft in raft_col:
+            slot = raft_frame.loc[raft, "slot"]
+            run = raft_frame.loc[raft, "run"]
+            raft_list.append([raft, slot])
+            run_list.append(str(run))
+
+        return raft_list, run_list
+
+    def emulated_arrays(self, raft_list=None, run_list=None):
+        """
+        Focal plane arrays of an emulated focal plane of single raft runs
+        :param raft_list: list of [raft name, slot]
+        :param run_list: list of runs, indexed the same as raft_list
+        :return: dict {test: (25, 9, 16) float32 array} of every test in any of the runs
+        """
+        rafts = []
+        for (raft, slot), run in zip(raft_list, run_list):
+            self.fill_raft_run_cache(run=run, raft=raft)
+            ccd_slots = {ccd[0]: ccd[1] for ccd in self.raft_contents(raft_name=raft, run=run, emulate=True)}
+            rafts.append((fpa.raft_index[slot], self.test_cache[run][raft], ccd_slots))
+
+        arrays = {}
+        for r, res, ccd_slots in rafts:
+            for test, ccds in res.items():
+                arr = arrays.setdefault(test, fpa.empty_array())
+                for ccd, values in ccds.items():
+                    c = fpa.ccd_index.get(ccd_slots.get(ccd))
+                    if c is None:
+                        continue
+                    values = np.asarray(values, dtype=np.float32)[:fpa.n_amp]
+                    arr[r, c, :len(values)] = values
+        return arrays
+
+    def arrays(self, run=None, tests=None, emulation=None):
+        """
+        :param run: BOT run number
+        :param tests: list of test names; default all tests of the run
+        :param emulation: emulation config file to use instead of a run
+        :return: dict {test: (25, 9, 16) float32 focal plane array}; missing amps are NaN. The arrays are the
+        cached ones - copy before modifying
+        """
+        if emulation is not None:
+            if emulation not in self.emulation_cache:
+                raft_list, run_list = self.parse_emulation_config(file_spec=emulation)
+                self.emulation_cache[emulation] = self.emulated_arrays(raft_list=raft_list, run_list=run_list)
+            store = self.emulation_cache[emulation]
+        else:
+            run = str(run)
+            self.fill_run_cache(run=run)
+            store = self.array_cache[run]
+
+        if tests is None:
+            return dict(store)
+        missing = [test for test in tests if test not in store]
+        if len(missing) > 0:
+            print("No results for tests ", missing)
+            raise ValueError
+        return {test: store[test] for test in tests}
+
+    def slot_contents(self, run=None, emulation=None):
+        """
+        :return: per raft slot (run, raft serial, {ccd slot: ccd serial}) for the installed rafts
+        """
+        if emulation is not None:
+            raft_list, run_list = self.parse_emulation_config(file_spec=emulation)
+            rafts = [(raft, slot, raft_run, True) for (raft, slot), raft_run in zip(raft_list, run_list)]
+        else:
+            run = str(run)
+            rafts = [(raft, slot, run, False) for raft, slot in self.fp_contents(run=run)]
+        contents = {slot: (raft_run, raft, self.ccd_serials(raft_name=raft, raft_slot=slot, run=raft_run,
+                                                              emulate=emulate))
+                    for raft, slot, raft_run, emulate in rafts if slot in fpa.raft_index}
+        self.metadata.flush()
+        return contents
+
+    def frame(self, run=None, tests=None, emulation=None, serials=True):
+        """
+        Tidy table of per-amp values, one row per amp position on the focal plane
+        :param run: BOT run number
+        :param tests: list of test names; default all tests of the run
+        :param emulation: emulation config file to use instead of a run
+        :param serials: add the run, raft and ccd serial columns (cached lookups)
+        :return: DataFrame with columns raft_slot, ccd_slot, amp (1-16), [run, raft, ccd], then one per test
+        """
+        arrays = self.arrays(run=run, tests=tests, emulation=emulation)
+        keep = self.amp_exists
+        columns = {"raft_slot": self.raft_labels[keep], "ccd_slot": self.ccd_labels[keep],
+                   "amp": self.amp_labels[keep]}
+
+        if serials:
+            contents = self.slot_contents(run=run, emulation=emulation)
+            rows = [contents.get(raft_slot, (None, None, {})) for raft_slot in fpa.raft_slot_names]
+            runs = np.repeat([row[0] for row in rows], fpa.n_ccd * fpa.n_amp)
+            rafts = np.repeat([row[1] for row in rows], fpa.n_ccd * fpa.n_amp)
+            ccds = np.array([rows[fpa.raft_index[raft_slot]][2].get(ccd_slot)
+                             for raft_slot, ccd_slot in zip(self.raft_labels, self.ccd_labels)], dtype=object)
+            columns.update({"run": runs[keep], "raft": rafts[keep], "ccd": ccds[keep]})
+
+        for test, arr in arrays.items():
+            columns[test] = arr.ravel()[keep]
+        return pd.DataFrame(columns)
+
+    def dataset(self, run=None, tests=None, emulation=None):
+        """
+        :param run: BOT run number
+        :param tests: list of test names; default all tests of the run
+        :param emulation: emulation config file to use instead of a run
+        :return: xarray Dataset, one (raft_slot, ccd, amp) variable per test. The ccd coordinate is the CCD
+        position - S00-S22 for science rafts, SG0, SG1, SW0, SW1 for positions 0-3 of corner rafts
+        """
+        if xr is None:
+            print("dataset needs xarray")
+            raise ValueError
+
+        arrays = self.arrays(run=run, tests=tests, emulation=emulation)
+        return xr.Dataset({test: (("raft_slot", "ccd", "amp"), arr) for test, arr in arrays.items()},
+                          coords={"raft_slot": fpa.raft_slot_names, "ccd": np.arange(fpa.n_ccd),
+                                  "ccd_slot": (("raft_slot", "ccd"),
+                                               self.ccd_labels.reshape(fpa.n_raft, fpa.n_ccd, fpa.n_amp)[:, :, 0]),
+                                  "amp": np.arange(1, fpa.n_amp + 1)},
+                          attrs={"run": "emulation" if emulation is not None else str(run)})
+
+    def export_bundle(self, run=None, file_spec=None, compress=False):
+        """
+        Write everything needed to display a BOT run to a single bundle file (see runBundle)
+        :param run: run number
+        :param file_spec: bundle file
+        :param compress: compress the data block
+        :return: nothing
+        """
+        run = str(run)
+        self.fill_run_cache(run=run)
+        res = self.test_cache[run]
+
+        geometry_db, geometry_run = self.geometry_run(run=run)
+        focal_plane = self.fp_contents(run=run)
+        rafts = {raft[0]: self.raft_contents(raft_name=raft[0], run=run) for raft in focal_plane}
+        layouts = {test: {raft_slot: [ccd_slot for ccd_slot in res[test][raft_slot] if ccd_slot in fpa.ccd_index]
+                          for raft_slot in res[test] if raft_slot in fpa.raft_index} for test in res}
+
+        header = {"run": run, "db": self.db_for_run(run=run), "run_info": self.run_info(run=run),
+                  "menu": [t[0] for t in self.menu_test_cache[run]], "focal_plane": focal_plane, "rafts": rafts,
+                  "geometry_db": geometry_db, "geometry_run": geometry_run, "layouts": layouts}
+        runBundle.write_bundle(file_spec=file_spec, header=header, arrays=self.array_cache[run], compress=compress)
+        self.metadata.flush()
+        print("Wrote run ", run, " bundle to ", file_spec)
+
+    def load_bundle(self, file_spec=None):
+        """
+        Fill the caches for a run from a bundle file, so it can be used with no database queries
+        :param file_spec: bundle file
+        :return: the bundle's run number
+        """
+        header, arrays = runBundle.read_bundle(file_spec=file_spec)
+        run = header["run"]
+
+        self.array_cache[run] = arrays
+        self.summarize_run(run=run)
+        self.menu_test_cache[run] = [(t, t) for t in header["menu"]]
+        self.metadata.preload(run_info=header["run_info"], focal_plane=header["focal_plane"], rafts=header["rafts"],
+                              db=header["db"], run=run, geometry_db=header["geometry_db"],
+                              geometry_run=header["geometry_run"])
+        self.test_cache[run] = {test: fpa.array_to_results(arrays[test], header["layouts"][test])
+                                for test in arrays}
+        return run
+
+
+if __name__ == "__main__":
+
+    ## Command line arguments
+    parser = argparse.ArgumentParser(
+        description='Write the per-amp EO test results of a run (or emulated focal plane) to a csv file')
+
+    parser.add_argument('-r', '--run', default=None, help="BOT run number")
+    parser.add_argument('-t', '--tests', nargs="+", default=None, help="test names (default: all)")
+    parser.add_argument('--emulate', default=None, help="emulation config file, instead of a run")
+    parser.add_argument('-o', '--output', default="fp_results.csv", help="output csv file (default=%(default)s)")
+    parser.add_argument('--archive', default=None, help="local archive file of EO results (see eoArchive)")
+    parser.add_argument('--bundle', default=None, help="run bundle file (see runBundle) to read the run from")
+
+    args = parser.parse_args()
+
+    fpD = focalPlaneData()
+    if args.archive is not None:
+        fpD.use_archive(db_file=args.archive)
+    run = args.run
+    if args.bundle is not None:
+        run = fpD.load_bundle(file_spec=args.bundle)
+
+    df = fpD.frame(run=run, tests=args.tests, emulation=args.emulate)
+    df.to_csv(args.output, index=False)
+    print("Wrote ", len(df), " amps to ", args.output)
@@ -0,0 +1,177 @@
+from __future__ import print_function
+import atexit
+import json
+import os
+import threading
+import argparse
+from exploreFocalPlane import exploreFocalPlane
+from exploreRaft import exploreRaft
+
+"""
+Cache of run metadata and hardware hierarchy lookups - getRunResults, focalPlaneContents and raftContents -
+optionally persisted to a json file so a restarted server does not query them again. New entries are written
+out by flush() - once per view or run lookup by the callers, and at exit - not on every miss.
+
+Only the scalar fields of getRunResults (experimentSN etc.) are kept; the step results are not.
+
+Run 11974 provides the reference geometry for runs without their own (Dev and pre-11974 runs). Its
+focal plane and raft contents can be read from a static table, reference_file, written ahead of time with
+    python metadataCache.py --make_reference
+Cached and preloaded (e.g. run bundle) entries take precedence over the table; without either, the reference
+geometry is queried like any other run's.
+"""
+
+REFERENCE_RUN = 11974
+
+
+class metadataCache():
+
+    def __init__(self, cache_file=None, reference_file=None):
+
+        self.cache_file = cache_file
+        if reference_file is None:
+            reference_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                          "fpGeometry_" + str(REFERENCE_RUN) + ".json")
+        self.reference_file = reference_file
+
+        self.lock = threading.Lock()
+        self.cache = {}
+        # entries added since the last save
+        self.dirty = False
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.cache = json.load(f)
+        if cache_file is not None:
+            atexit.register(self.flush)
+
+        # static reference geometry: {"focal_plane": [[raft, slot], ...], "rafts": {raft: raftContents}}
+        self.reference = None
+        if os.path.exists(self.reference_file):
+            with open(self.reference_file) as f:
+                self.reference = json.load(f)
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def flush(self):
+        """
+        Save the cache file if there are new entries
+        :return: nothing
+        """
+        with self.lock:
+            if self.dirty:
+                self.save()
+                self.dirty = False
+
+    def key(self, *parts):
+        return "/".join(str(part) for part in parts)
+
+    def preload(self, run_info=None, focal_plane=None, rafts=None, db=None, run=None, geometry_db=None,
+                geometry_run=None):
+        """
+        Fill the cache from a saved copy (e.g. a run bundle) so no queries are needed for the run
+        :param run_info: scalar getRunResults fields
+        :param focal_plane: focalPlaneContents
+        :param rafts: {raft name: raftContents}
+        :param db: database of the run
+        :param run: run number
+        :param geometry_db: database the focal plane/raft contents are looked up in (Prod for the run 11974
+        reference geometry)
+        :param geometry_run: run the focal plane/raft contents are looked up for (the run, or 11974)
+        :return: nothing
+        """
+        with self.lock:
+            self.cache[self.key(db, "run", run)] = run_info
+            self.cache[self.key("Prod", "fp", geometry_run)] = focal_plane
+            for raft, contents in rafts.items():
+                self.cache[self.key(geometry_db, "raft", raft, geometry_run)] = contents
+            self.save()
+
+    def lookup(self, key=None, fetch=None):
+        """
+        :param key: cache key
+        :param fetch: function to call on a miss
+        :return: cached value
+        """
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+        value = fetch()
+        with self.lock:
+            self.cache[key] = value
+            self.dirty = True
+        return value
+
+    def getRunResults(self, connect=None, db=None, run=None):
+        def fetch():
+            info = connect.getRunResults(run=run)
+            return {k: v for k, v in info.items() if isinstance(v, (str, int, float, bool)) or v is None}
+        return self.lookup(key=self.key(db, "run", run), fetch=fetch)
+
+    def cached(self, key=None):
+        """
+        :param key: cache key
+        :return: cached value, None if not there
+        """
+        with self.lock:
+            return self.cache.get(key)
+
+    def focalPlaneContents(self, eFP=None, db=None, run=None):
+        key = self.key(db, "fp", run)
+        value = self.cached(key=key)
+        if value is not None:
+            return value
+        if self.reference is not None and str(run) == str(REFERENCE_RUN):
+            return self.reference["focal_plane"]
+        return self.lookup(key=key, fetch=lambda: [list(raft) for raft in eFP.focalPlaneContents(run=run)])
+
+    def raftContents(self, eR=None, db=None, raftName=None, run=None):
+        key = self.key(db, "raft", raftName, run)
+        value = self.cached(key=key)
+        if value is not None:
+            return value
+        if self.reference is not None and str(run) == str(REFERENCE_RUN) and raftName in self.reference["rafts"]:
+            return self.reference["rafts"][raftName]
+        return self.lookup(key=key,
+                           fetch=lambda: [list(ccd) for ccd in eR.raftContents(raftName=raftName, run=run)])
+
+    def write_reference(self, eFP=None, eR=None):
+        """
+        Query the run 11974 focal plane and raft contents and write them to reference_file (--make_reference)
+        :return: nothing
+        """
+        focal_plane = [list(raft) for raft in eFP.focalPlaneContents(run=REFERENCE_RUN)]
+        rafts = {raft[0]: [list(ccd) for ccd in eR.raftContents(raftName=raft[0], run=REFERENCE_RUN)]
+                 for raft in focal_plane}
+        self.reference = {"focal_plane": focal_plane, "rafts": rafts}
+        tmp_file = self.reference_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.reference, f, indent=1)
+        os.replace(tmp_file, self.reference_file)
+        print("Wrote reference geometry for run ", REFERENCE_RUN, " to ", self.reference_file)
+
+    def make_reference(self, db='Prod', server='Prod'):
+        self.write_reference(eFP=exploreFocalPlane(db=db, prodServer=server),
+                             eR=exploreRaft(db=db, prodServer=server))
+
+
+if __name__ == "__main__":
+
+    ## Command line arguments
+    parser = argparse.ArgumentParser(
+        description='Write the static run 11974 reference geometry table used by metadataCache')
+
+    parser.add_argument('--make_reference', action='store_true', help="query and write the reference table")
+    parser.add_argument('-o', '--output', default=None, help="reference table file (default: next to this module)")
+    parser.add_argument('-d', '--db', default='Prod', help="eT database (default=%(default)s)")
+
+    args = parser.parse_args()
+
+    if args.make_reference:
+        mC = metadataCache(reference_file=args.output)
+        mC.make_reference(db=args.db)
@@ -8,11 +8,12 @@ from bokeh.layouts import widgetbox
 from bokeh.models.widgets import Panel, Tabs, PreText, DataTable, TableColumn, HTMLTemplateFormatter
 from  eTraveler.clientAPI.connection import Connection
 from bokeh.models import Span, Label
+from eoArchive import eoArchive
 import argparse
 
 class plotGoodRaftRuns():
 
-    def __init__(self, db='Prod', server='Prod', base_dir=None):
+    def __init__(self, db='Prod', server='Prod', base_dir=None, output_backend='canvas', archive=None):
 
         self.traveler_name = {}
         self.test_type = "fe55_raft_analysis"
@@ -21,6 +22,8 @@ class plotGoodRaftRuns():
         self.base_dir = base_dir
         self.db = db
         self.server = server
+        # "webgl" draws the scatter plots with WebGL where the browser supports it, else falls back to canvas
+        self.output_backend = output_backend
 
         if server == 'Prod':
             pS = True
@@ -28,6 +31,13 @@ class plotGoodRaftRuns():
             pS = False
         self.connect = Connection(operator='richard', db=db, exp='LSST-CAMERA', prodServer=pS)
 
+        # optional local archive file (see eoArchive) used as a read-through cache of the eT results and
+        # run metadata
+        self.archive = None
+        if archive is not None:
+            self.archive = eoArchive(db_file=archive, db=db, server=server)
+            self.connect = self.archive
+
 
     def find_runs(self,site_type=None, runs=None):
 
@@ -59,7 +69,10 @@ class plotGoodRaftRuns():
 
         print ('Operating on run ', run)
 
-        g = get_EO_analysis_results(db=self.db, server=self.server)
+        if self.archive is not None:
+            g = self.archive
+        else:
+            g = get_EO_analysis_results(db=self.db, server=self.server)
 
         raft_list, data = g.get_tests(site_type=site_type, test_type="gain", run=run)
         res = g.get_results(test_type="gain", data=data, device=raft)
@@ -196,34 +209,35 @@ class plotGoodRaftRuns():
 
 
         TOOLS = "pan,wheel_zoom,box_zoom,reset,save,box_select,lasso_select"
+        fig_args = dict(tools=TOOLS, output_backend=self.output_backend)
 
         # create a new plot with a title and axis labels
-        p = figure(tools=TOOLS, title="gains", x_axis_label='amp', y_axis_label='gain')
-        ptc = figure(tools=TOOLS, title="ptc gains", x_axis_label='amp', y_axis_label='gain')
-        psf = figure(tools=TOOLS, title="psf", x_axis_label='amp', y_axis_label='psf')
-        rn = figure(tools=TOOLS, title="Read noise", x_axis_label='amp', y_axis_label='Noise')
-
-        cls = figure(tools=TOOLS, title="CTI low serial", x_axis_label='amp', y_axis_label='CTI')
-        chs = figure(tools=TOOLS, title="CTI high serial", x_axis_label='amp', y_axis_label='CTI')
-        clp = figure(tools=TOOLS, title="CTI low parallel", x_axis_label='amp', y_axis_label='CTI')
-        chp = figure(tools=TOOLS, title="CTI high parallel", x_axis_label='amp', y_axis_label='CTI')
-
-        bp = figure(tools=TOOLS, title="Bright Pixels", x_axis_label='amp', y_axis_label='Bright Pixels')
-        bc = figure(tools=TOOLS, title="Bright Columns", x_axis_label='amp', y_axis_label='Bright Columns')
-        dp = figure(tools=TOOLS, title="Dark Pixels", x_axis_label='amp', y_axis_label='Dark Pixels')
-        dc = figure(tools=TOOLS, title="Dark Columns", x_axis_label='amp', y_axis_label='Dark Columns')
-        tp = figure(tools=TOOLS, title="Traps", x_axis_label='amp', y_axis_label='Traps')
-
-        drkC = figure(tools=TOOLS, title="Dark Current", x_axis_label='amp', y_axis_label='Current')
-        fw = figure(tools=TOOLS, title="Full Well", x_axis_label='amp', y_axis_label='Full Well')
-        nonl = figure(tools=TOOLS, title="Non-linearity", x_axis_label='amp', y_axis_label='Max dev')
-
-        qe_u = figure(tools=TOOLS, title="QE: u band", x_axis_label='sensor', y_axis_label='QE')
-        qe_g = figure(tools=TOOLS, title="QE: g band", x_axis_label='sensor', y_axis_label='QE')
-        qe_r = figure(tools=TOOLS, title="QE: r band", x_axis_label='sensor', y_axis_label='QE')
-        qe_i = figure(tools=TOOLS, title="QE: i band", x_axis_label='sensor', y_axis_label='QE')
-        qe_z = figure(tools=TOOLS, title="QE: z band", x_axis_label='sensor', y_axis_label='QE')
-        qe_y = figure(tools=TOOLS, title="QE: y band", x_axis_label='sensor', y_axis_label='QE')
+        p = figure(title="gains", x_axis_label='amp', y_axis_label='gain', **fig_args)
+        ptc = figure(title="ptc gains", x_axis_label='amp', y_axis_label='gain', **fig_args)
+        psf = figure(title="psf", x_axis_label='amp', y_axis_label='psf', **fig_args)
+        rn = figure(title="Read noise", x_axis_label='amp', y_axis_label='Noise', **fig_args)
+
+        cls = figure(title="CTI low serial", x_axis_label='amp', y_axis_label='CTI', **fig_args)
+        chs = figure(title="CTI high serial", x_axis_label='amp', y_axis_label='CTI', **fig_args)
+        clp = figure(title="CTI low parallel", x_axis_label='amp', y_axis_label='CTI', **fig_args)
+        chp = figure(title="CTI high parallel", x_axis_label='amp', y_axis_label='CTI', **fig_args)
+
+        bp = figure(title="Bright Pixels", x_axis_label='amp', y_axis_label='Bright Pixels', **fig_args)
+        bc = figure(title="Bright Columns", x_axis_label='amp', y_axis_label='Bright Columns', **fig_args)
+        dp = figure(title="Dark Pixels", x_axis_label='amp', y_axis_label='Dark Pixels', **fig_args)
+        dc = figure(title="Dark Columns", x_axis_label='amp', y_axis_label='Dark Columns', **fig_args)
+        tp = figure(title="Traps", x_axis_label='amp', y_axis_label='Traps', **fig_args)
+
+        drkC = figure(title="Dark Current", x_axis_label='amp', y_axis_label='Current', **fig_args)
+        fw = figure(title="Full Well", x_axis_label='amp', y_axis_label='Full Well', **fig_args)
+        nonl = figure(title="Non-linearity", x_axis_label='amp', y_axis_label='Max dev', **fig_args)
+
+        qe_u = figure(title="QE: u band", x_axis_label='sensor', y_axis_label='QE', **fig_args)
+        qe_g = figure(title="QE: g band", x_axis_label='sensor', y_axis_label='QE', **fig_args)
+        qe_r = figure(title="QE: r band", x_axis_label='sensor', y_axis_label='QE', **fig_args)
+        qe_i = figure(title="QE: i band", x_axis_label='sensor', y_axis_label='QE', **fig_args)
+        qe_z = figure(title="QE: z band", x_axis_label='sensor', y_axis_label='QE', **fig_args)
+        qe_y = figure(title="QE: y band", x_axis_label='sensor', y_axis_label='QE', **fig_args)
 
         # add a line renderer with legend and line thickness
         #sensor_lines = [sensor_start, sensor_end, sensor_third]
@@ -494,13 +508,17 @@ if __name__ == "__main__":
                         help="site type (default=%((default)s)"                                                                     "default)s)")
     parser.add_argument('-o', '--output', default='/Users/richard/LSST/Data/bokeh/',
                         help="output base directory (default=%(default)s)")
+    parser.add_argument('-b', '--backend', default='canvas', choices=['canvas', 'webgl'],
+                        help="bokeh output backend (default=%(default)s)")
+    parser.add_argument('--archive', default=None, help="local archive file of EO results (see eoArchive)")
 
     args = parser.parse_args()
 
     eR_prod = exploreRaft(db='Prod')
     eR_dev = exploreRaft(db='Dev')
 
-    pG = plotGoodRaftRuns(db='Prod', server='Prod', base_dir=args.output)
+    pG = plotGoodRaftRuns(db='Prod', server='Prod', base_dir=args.output, output_backend=args.backend,
+                          archive=args.archive)
 
     runs_bnl = [4390, 4417, 4418, 4576, 4613, 4625, 4626, 5508, 5511, 5634, 5635, 5675, 5761, 6131, 6147,\
                 6317, 6350, 6829, 6854, 7192, 7195, 7479, 7652, 7653, 7659, 7660, 7661, 7678,\
@@ -517,7 +535,8 @@ if __name__ == "__main__":
 
     data_table_int = pG.write_table(run_list=run_list, raft_list=raft_list,type_list=type_list)
 
-    pG_dev = plotGoodRaftRuns(db='Dev', server='Prod', base_dir=args.output)
+    pG_dev = plotGoodRaftRuns(db='Dev', server='Prod', base_dir=args.output,
+                              output_backend=args.backend, archive=args.archive)
 
     runs_int_dev = [5708, 5715, 5867, 5899, 5923, 5941, 5943, 6006, 6106 ]
     run_list, raft_list = pG_dev.make_run_pages(site_type="I&T-Raft", runs=runs_int_dev)
@@ -9,18 +9,25 @@ from bokeh.models import Range1d
 from eTraveler.clientAPI.connection import Connection
 from bokeh.models import Span, Label
 from bokeh.io import export_png
+from eoRequirements import eoRequirements
+from eoArchive import eoArchive
+import runBundle
+import focalPlaneArrays as fpa
 import argparse
 import numpy as np
 
 class plot_EOtest_results():
 
-    def __init__(self, db='Prod', server='Prod', base_dir=None):
+    def __init__(self, db='Prod', server='Prod', base_dir=None, output_backend='canvas', req_file=None,
+                 archive=None, bundle=None):
 
         self.traveler_name = {}
         self.test_type = ""
         self.db = db
         self.server = server
         self.output_spec = ""
+        # "webgl" draws the scatter plots with WebGL where the browser supports it, else falls back to canvas
+        self.output_backend = output_backend
         self.slot_names = ["S00", "S01", "S02", "S10", "S11", "S12", "S20", "S21", "S22"]
 
         if server == 'Prod':
@@ -29,18 +36,30 @@ class plot_EOtest_results():
             pS = False
         self.connect = Connection(operator='richard', db=db, exp='LSST-CAMERA', prodServer=pS)
 
-        self.requirements = {}
-        self.requirements['total_noise'] = 9. # C-SRFT-073
+        self.requirements = eoRequirements(req_file=req_file)
+
+        # optional local archive file (see eoArchive) used as a read-through cache of the eT results
+        self.archive = archive
+        # optional run bundle file (see runBundle) to plot from, with no database access
+        self.bundle = bundle
 
     def write_run_plot(self, run=None, test_name=None, out_file=None, site=None):
 
         print('Operating on run ', run)
         self.output_spec = out_file
 
-        g = get_EO_analysis_results(db=self.db, server=self.server)
+        if self.bundle is not None:
+            header, arrays = runBundle.read_bundle(file_spec=self.bundle)
+            run = header["run"]
+            res = {test_name: fpa.array_to_results(arrays[test_name], header["layouts"][test_name])}
+        else:
+            if self.archive is not None:
+                g = eoArchive(db_file=self.archive, db=self.db, server=self.server)
+            else:
+                g = get_EO_analysis_results(db=self.db, server=self.server)
 
-        raft_list, data = g.get_tests(test_type=test_name, run=run, site_type=site)
-        res = g.get_results(test_type=test_name, data=data, device=raft_list)
+            raft_list, data = g.get_tests(test_type=test_name, run=run, site_type=site)
+            res = g.get_results(test_type=test_name, data=data, device=raft_list)
 
         TOOLS = "pan,wheel_zoom,box_zoom,reset,save,box_select,lasso_select"
 
@@ -56,7 +75,7 @@ class plot_EOtest_results():
             # create a new plot with a title and axis labels
             plt_title = raft + ":" + test_name + ": Run " + run
             p =figure(tools=TOOLS, title=plt_title, x_axis_label='amp',
-                       y_axis_label=test_name, height=200)
+                       y_axis_label=test_name, height=200, output_backend=self.output_backend)
 
             # add a line renderer with legend and line thickness
             #sensor_lines = [sensor_start, sensor_end, sensor_third]
@@ -68,14 +87,14 @@ class plot_EOtest_results():
 
             # add the requirement line, if there is one for this test
             try:
-                req = self.requirements[test_name]
-                sensor_lines.append(Span(location=self.requirements[test_name],
+                req = self.requirements.threshold(test_name)
+                sensor_lines.append(Span(location=req,
                                          dimension='width', line_color='red',
                                          line_dash='dashed', line_width=3))
-                y_max = 1.2 * max(np.max(np.array(test_list)), self.requirements[test_name])
+                y_max = 1.2 * max(np.nanmax(np.array(test_list)), req)
                 p.y_range = Range1d(0., y_max)
             except KeyError:
-                y_max = 1.2 * np.max(np.array(test_list))
+                y_max = 1.2 * np.nanmax(np.array(test_list))
                 p.y_range = Range1d(0., y_max)
                 pass
 
@@ -106,10 +125,17 @@ if __name__ == "__main__":
                         help="output base directory (default=%(default)s)")
     parser.add_argument('-s', '--site_type', default='I&T-BOT', help="type & site of test (default=%("
                                                                       "default)s)")
+    parser.add_argument('-b', '--backend', default='canvas', choices=['canvas', 'webgl'],
+                        help="bokeh output backend (default=%(default)s)")
+    parser.add_argument('--requirements', default=None,
+                        help="csv file of additional requirements: test, threshold, direction, id")
+    parser.add_argument('--bundle', default=None, help="run bundle file (see runBundle) to plot from")
+    parser.add_argument('--archive', default=None, help="local archive file of EO results (see eoArchive)")
 
     args = parser.parse_args()
 
-    pG = plot_EOtest_results(db=args.db, server='Prod')
+    pG = plot_EOtest_results(db=args.db, server='Prod', output_backend=args.backend,
+                             req_file=args.requirements, archive=args.archive, bundle=args.bundle)
 
     wrt_plot = pG.write_run_plot(run=args.run, test_name=args.test_name, out_file=args.output,
                                  site=args.site_type)
@@ -1,20 +1,26 @@
 from __future__ import print_function
 import numpy as np
-import pandas as pd
 import sys
 import importlib
-from get_EO_analysis_results import get_EO_analysis_results
-from exploreFocalPlane import exploreFocalPlane
-from exploreRaft import exploreRaft
-from eTraveler.clientAPI.connection import Connection
-from get_steps_schema import get_steps_schema
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import focalPlaneArrays as fpa
+from focalPlaneData import focalPlaneData
+from userHookRunner import userHookRunner
+from runAggregator import runAggregator
 from bokeh.models import LinearAxis, Grid, ContinuousColorMapper, LinearColorMapper, ColorBar, \
     LogTicker
 from bokeh.plotting import figure
+from bokeh.io import curdoc
 from bokeh.palettes import Viridis256 as palette #@UnresolvedImport
-from bokeh.layouts import row, layout
-from bokeh.models import CustomJS, ColumnDataSource, CDSView, BooleanFilter
-from bokeh.models.widgets import TextInput, Dropdown, Button, RangeSlider
+from bokeh.palettes import Category20_20 as trend_palette #@UnresolvedImport
+from bokeh.layouts import row, layout, gridplot
+from bokeh.models import CustomJS, ColumnDataSource, HoverTool, CustomJSHover
+from bokeh.events import Tap, RangesUpdate
+from bokeh.models.widgets import TextInput, Dropdown, Button, RangeSlider, PreText, DataTable, TableColumn, \
+    NumberFormatter, Toggle, Slider
 try:
     from StringIO import StringIO
 except ImportError:
@@ -75,15 +81,29 @@ class renderFocalPlane():
         self.current_test = ""
         self.previous_test = ""
         self.current_raft = None
-        self.EO_type = "I&T-Raft"
         self.current_mode = 0
         self.current_raft_list = []
         self.current_FP_raft_list = []
 
         self.user_hook = None
         self.user_module = None
+        # optional vectorized hook: called once per render with the whole run's focal plane arrays
+        self.user_fp_hook = None
+        self.user_fp_array = None
+        # optionally run the hooks in a worker process, abandoning calls that take longer than the timeout
+        self.user_hook_isolated = False
+        self.user_hook_timeout = 10.
+        self.hook_runner = None
+        self.hook_stats = PreText(text="", width=900)
+        # isolated hooks are called off the event loop: a render queues its calls (slot, hook arguments) and
+        # draws the amps as missing; hook_done draws the results, which are kept for the view (see hook_key)
+        self.hook_requests = []
+        self.hook_pending = None
+        self.hook_future = None
+        self.hook_results = None
+        # bumped when the user module is (re)loaded, so results of the previous version are not drawn
+        self.hook_generation = 0
         self.tap_cb = self.tap_input
-        self.select_cb = self.select_input
 
         self.text_input = TextInput(value=str(self.get_current_run()), title="Select Run")
 
@@ -217,13 +237,123 @@ class renderFocalPlane():
         self.heatmap = None
         self.heatmap_rect = None
 
+        # heatmap glyph backend: "rect" draws one rect per amp; "image" rasterizes the amps into a single
+        # image glyph
+        self.heatmap_backend = "rect"
+        self.image_lookup = None
+
+        # lookup tables for the dictionary encoded raft_code and ccd_code columns of self.source:
+        # lists of [name, slot]
+        self.raft_table = []
+        self.ccd_table = []
+
+        # level of detail: in full focal plane mode, draw per-CCD summary tiles when the view spans at
+        # least lod_span focal plane units, and only the amps in the visible region when zoomed in further
+        self.lod = False
+        self.lod_span = 10.
+        self.amp_data = None
+        self.ccd_tile_source = ColumnDataSource()
+        self.lod_renderers = None
+
+        # bokeh output backend for the heatmap and histogram: "canvas" or "webgl". WebGL falls back to
+        # canvas in browsers without support
+        self.output_backend = "canvas"
+
         self.emulate_raft_list = []
 
         self.slot_mapping = None
 
         self.testq_timer = 0
 
-        self.test_cache = {}
+        # eT connections, run caches and geometry lookups (see focalPlaneData). The caches are shared with it
+        self.data = focalPlaneData(db=db, server=server)
+        self.connections = self.data.connections
+        self.test_cache = self.data.test_cache
+        self.array_cache = self.data.array_cache
+        self.stats_cache = self.data.stats_cache
+        # auto-range the slider on the 1st-99th percentiles rather than min/max
+        self.robust_range = False
+        # show the table of per-raft/CCD summary statistics under the heatmap
+        self.show_summary = False
+        # per run the fail masks of all requirements (see eoRequirements.evaluate)
+        self.fail_cache = self.data.fail_cache
+        # outline the amps failing the current test's requirement (or, for tests without one, any requirement)
+        self.show_failing = False
+        self.toggle_failing = Toggle(label="Failing amps", button_type="warning", width=100)
+        self.toggle_failing.on_click(self.update_toggle_failing)
+        # flat index into the (25, 9, 16) focal plane arrays of each amp in the heatmap source
+        self.fp_index = None
+        self.amp_columns = None
+        # assembled heatmap payloads (source columns, lookup tables, histograms) of recent views, keyed by the
+        # view state and checked against the result cache entries they were built from (see view_key)
+        self.view_memo = OrderedDict()
+        self.view_memo_size = 32
+        # histograms kept per payload, one per colour range (slider position)
+        self.hist_memo_size = 8
+        # heatmap amp alpha, and that of amps outside a histogram selection (see hist_select_callback)
+        self.amp_alpha = 0.7
+        self.amp_alpha_faded = 0.1
+
+        # progressive full focal plane rendering (bokeh server): draw the outlines at once and stream the amps
+        # into the heatmap as the data arrives from background fetches. eT serves a BOT run's results for the
+        # whole focal plane, so there the rafts all arrive with the one fetch of the displayed test; emulated
+        # focal planes arrive raft by raft
+        self.progressive = False
+        self.fetch_pool = None
+        self.render_generation = 0
+        self.stream_state = None
+
+        # comparison mode (BOT runs): show the per-amp difference or ratio of the current run to a reference
+        # run, with rafts matched by serial number
+        self.reference_run = None
+        self.compare_op = None
+        # compare arrays and raft slot maps of recent run pairs, least recently used first (see lru_store)
+        self.compare_cache = OrderedDict()
+        self.compare_cache_size = 8
+        self.slot_map_cache = OrderedDict()
+        self.slot_map_cache_size = 64
+        self.reference_input = TextInput(value="", title="Reference Run")
+        self.reference_input.on_change('value', self.update_reference_input)
+        # trending: slope per run of each amp over a list of runs, and per raft/CCD/amp trend plots
+        self.trend_runs = []
+        # (amp x run) matrices of recent trends - 14 kB per run
+        self.trend_cache = OrderedDict()
+        self.trend_cache_size = 4
+        self.trend_input = TextInput(value="", title="Trend Runs (e.g. 12540-12560, 12600)")
+        self.trend_input.on_change('value', self.update_trend_input)
+        # per-amp aggregates over the trend runs, reduced one run at a time (see runAggregator)
+        self.aggregate_ops = ["mean", "median", "std", "percentile"]
+        self.aggregate_percentile = 90.
+        self.reservoir_size = 64
+        # the most recent aggregators (about 1 MB each with the default reservoir), least recently used first
+        self.aggregate_cache = OrderedDict()
+        self.aggregate_cache_size = 8
+        self.menu_compare = [("No comparison", "off"), ("Difference", "difference"), ("Ratio", "ratio"),
+                             ("Trend slope", "slope"), ("Mean over trend runs", "mean"),
+                             ("Median over trend runs", "median"), ("Std dev over trend runs", "std"),
+                             ("Percentile over trend runs", "percentile")]
+        self.drop_compare = Dropdown(label="Compare: off", button_type="warning", menu=self.menu_compare,
+                                     width=150)
+        self.drop_compare.on_click(self.update_dropdown_compare)
+        # mosaic (BOT runs): the current test on the focal planes of several runs, drawn from one source with a
+        # column per run and one colour mapper
+        self.mosaic_runs = []
+        self.mosaic_columns = 4
+        self.mosaic_input = TextInput(value="", title="Mosaic Runs (e.g. 12540, 12545-12547)")
+        self.mosaic_input.on_change('value', self.update_mosaic_input)
+        # time-lapse playback (BOT runs): the current test of each playback run preloaded as a column of the
+        # heatmap source; the slider/play button swap the field the amps are coloured by, in the browser
+        self.playback_runs = []
+        self.playback_interval = 500    # ms per frame when playing
+        self.playback_cache = {}
+        self.playback_input = TextInput(value="", title="Playback Runs (e.g. 12540-12560)")
+        self.playback_input.on_change('value', self.update_playback_input)
+        # correlation view (BOT runs): scatter of the displayed values against a second cached test quantity,
+        # drawn from the heatmap source so selections are linked both ways in the browser
+        self.corr_test = None
+        self.drop_corr = Dropdown(label="Correlate: off", button_type="warning",
+                                  menu=[("No correlation", "off")], width=150)
+        self.drop_corr.on_click(self.update_dropdown_corr)
         self.ccd_content_cache = {}
 
         # list of available test quantities in raft/focal plane runs
@@ -239,7 +369,7 @@ class renderFocalPlane():
                           ('PTC gain', 'ptc_gain'), ('Pixel mean', 'pixel_mean'), ('Full Well', 'full_well'),
                           ('Nonlinearity', 'max_frac_dev')]
         self.menu_test.append(("User supplied", "User"))
-        self.menu_test_cache = {}
+        self.menu_test_cache = self.data.menu_test_cache
 
         # drop down menu of test names, taking the menu from self.menu_test
         self.drop_test = Dropdown(label="Select test", button_type="warning", menu=self.menu_test, width=150)
@@ -276,6 +406,22 @@ class renderFocalPlane():
 
         self.corner_raft_amp_ordering_guider = [15, 14, 13, 12, 11, 10, 9, 8, 0, 1, 2, 3, 4, 5, 6, 7]
         self.corner_raft_amp_ordering_wave = [0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15]
+
+        # corner raft sensor positions (in the 3x3 CCD grid) and orientations
+        self.CR_content = {"R40": {"SG0": {"pos": 1, "orient": "up"},
+                                   "SG1": {"pos": 5, "orient": "side"},
+                                   "SW": {"pos": 2, "orient": "side"}},
+                           "R44": {"SG0": {"pos": 3, "orient": "side"},
+                                   "SG1": {"pos": 1, "orient": "up"},
+                                   "SW": {"pos": 0, "orient": "up"}},
+                           "R00": {"SG0": {"pos": 5, "orient": "side"},
+                                   "SG1": {"pos": 7, "orient": "side"},
+                                   "SW": {"pos": 8, "orient": "up"}},
+                           "R04": {"SG0": {"pos": 7, "orient": "up"},
+                                   "SG1": {"pos": 3, "orient": "side"},
+                                   "SW": {"pos": 6, "orient": "side"}}
+                           }
+        self.CR_slot_index = {0:"R40", 4:"R44", 20:"R00", 24:"R04"}
         self.ccd_ordering = ['S00','S01','S02',
                              'S10','S11','S12',
                              'S20','S21','S22']
@@ -342,62 +488,79 @@ class renderFocalPlane():
                                     aspect ratio is that amps long side is vertical
         """
 
-        if server == 'Prod':
-            pS = True
-        else:
-            pS = False
-        self.connect_Prod = Connection(operator='richard', db="Prod", exp='LSST-CAMERA', prodServer=pS)
-        self.connect_Dev = Connection(operator='richard', db="Dev", exp='LSST-CAMERA', prodServer=pS)
-
-        self.eFP_Prod = exploreFocalPlane(db="Prod", prodServer=server)
-        self.eR_Prod = exploreRaft(db="Prod", prodServer=server)
-        self.get_EO_Prod = get_EO_analysis_results(db="Prod", server=server)
-
-        self.eFP_Dev = exploreFocalPlane(db="Dev", prodServer=server)
-        self.eR_Dev = exploreRaft(db="Dev", prodServer=server)
-        self.get_EO_Dev = get_EO_analysis_results(db="Dev", server=server)
+        self.server = server
+        self.dbsel = "Prod"
 
-        self.connections = {}
-        o = self.connections.setdefault("connect", {})
-        o["Prod"] = self.connect_Prod
-        o["Dev"] = self.connect_Dev
+    def set_db(self, run=None):
+        # check the run number again for dev or prod (for mixed mode emulation where runs could be either)
+        self.dbsel = self.data.db_for_run(run=run)
 
-        FP = self.connections.setdefault("eFP", {})
-        FP["Prod"] = self.eFP_Prod
-        FP["Dev"] = self.eFP_Dev
+    def chk_11974(self, run=None):
+        return self.data.chk_11974(run=run)
 
-        eR = self.connections.setdefault("eR", {})
-        eR["Prod"] = self.eR_Prod
-        eR["Dev"] = self.eR_Dev
+    def update_test_menu(self):
+        """
+        Set the test menu to the current run's tests, falling back to the first of them if the current test
+        is not there
+        :return: nothing
+        """
+        found_test = False
+        for tests in self.menu_test_cache[self.current_run]:
+            if tests[0] == self.current_test:
+                found_test = True
+                break
 
-        EO = self.connections.setdefault("get_EO", {})
-        EO["Prod"] = self.get_EO_Prod
-        EO["Dev"] = self.get_EO_Dev
+        if not found_test:  # if user has asked for non-existent test via CL
+            self.current_test = self.menu_test_cache[self.current_run][0][0]
 
-        self.get_step = get_steps_schema()
-        self.dbsel = "Prod"
+        self.menu_test = self.menu_test_cache[self.current_run]
+        self.drop_test.menu = self.menu_test
+        if self.user_module is not None:
+            if self.menu_test[0][0] != "User":
+                self.menu_test.insert(0,("User", "User"))
 
-    def set_db(self, run=None):
-        # check the run number again for dev or prod (for mixed mode emulation where runs could be either)
-        self.dbsel = "Prod"
-        if isinstance(run,str) and 'D' in run.upper():
-            self.dbsel = "Dev"
+    def run_done_callback(self):
+        """
+        For focalPlaneData.fill_run_test: once the rest of the current run is in the cache, its full test menu
+        is put up from the server's event loop
+        :return: function called by the background fetch thread
+        """
+        doc = curdoc()
+        run = self.current_run
+        return lambda: doc.add_next_tick_callback(partial(self.refresh_test_menu, run=run))
 
-    def chk_11974(self, run=None):
-        outcome = True     # use prod
-        if isinstance(run, str) and 'D' in run.upper():
-            outcome = False
-        elif int(run) < 11974:
-            outcome = False
+    def refresh_test_menu(self, run=None):
+        """
+        Event loop callback: update the test menu if the run whose fetch completed is still displayed. Not while
+        a user test is displayed: it is not in the run's menu, so update_test_menu would replace it
+        :param run: run number
+        :return: nothing
+        """
+        if run == self.current_run and run in self.menu_test_cache and "user" not in self.current_test.lower():
+            self.update_test_menu()
 
-        return outcome
+    def hook_test_cache(self, raft_slot=None):
+        """
+        The part of the test cache the per-raft user hook reads: the current run's results for one raft
+        :param raft_slot: raft slot
+        :return: {run: {test: {raft slot: ...}}} for BOT runs; {run: {raft: {test: ...}}} for single raft runs
+        """
+        run_cache = self.test_cache.get(self.current_run, {})
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        if BOT:
+            return {self.current_run: {test: {raft_slot: run_cache[test][raft_slot]} for test in run_cache
+                                       if raft_slot in run_cache[test]}}
+        if self.current_raft in run_cache:
+            return {self.current_run: {self.current_raft: run_cache[self.current_raft]}}
+        return {self.current_run: {}}
 
     def get_testq(self, raft_slot=None):
         """
         Get the per raft or ccd test quantity array for this run and test name.
         :param run:  run number
         :param testq: test quantity name
-        :return: list of test quantities - 144 long for raft; 16 for ccd
+        :return: float32 array of test quantities - 144 long for raft (48 for corner rafts); 16 for ccd.
+        Missing amps are NaN
         """
 
         in_time = time.time()
@@ -407,7 +570,14 @@ class renderFocalPlane():
         if not BOT:
             raft_index = self.current_raft
 
-        # user override for "User"
+        # user override for "User" - vectorized hook output was computed once for this render
+        if self.user_fp_array is not None and "user" in self.current_test.lower():
+            if self.single_ccd_mode or self.solo_ccd_mode:
+                return fpa.ccd_vector(self.user_fp_array, raft_slot, self.single_ccd_name[0][1])
+            if raft_slot in fpa.corner_raft_slots:
+                self.solo_corner_raft = True
+            return fpa.raft_vector(self.user_fp_array, raft_slot)
+
         if self.user_hook is not None and "user" in self.current_test.lower():
             if self.single_ccd_mode or self.solo_ccd_mode:
                 ccd_slot = self.single_ccd_name[0][1]
@@ -416,99 +586,58 @@ class renderFocalPlane():
                 if raft_slot in ["R00", "R04", "R40", "R44"]:
                     self.solo_corner_raft = True
 
-            return self.user_hook(run=self.current_run, mode=self.current_mode, raft=raft_slot,
-                                  ccd=ccd_slot, test_cache=self.test_cache, test=self.current_test,
-                                  range_limits=self.slider_limits)
+            if BOT:
+                # hooks are handed the run's complete results
+                self.data.fill_run_cache(run=self.current_run)
+            hook_args = dict(run=self.current_run, mode=self.current_mode, raft=raft_slot, ccd=ccd_slot,
+                             test_cache=self.test_cache, test=self.current_test, range_limits=self.slider_limits)
+            if self.hook_runner is None:
+                return np.asarray(self.user_hook(**hook_args), dtype=np.float32)
+
+            # the worker only needs this run's results for the raft - not every cached run
+            hook_args["test_cache"] = self.hook_test_cache(raft_slot=raft_slot)
+            hook_args["range_limits"] = dict(self.slider_limits)
+            test_list = self.hook_result(slot=(raft_slot, ccd_slot), hook_args=hook_args)
+            if test_list is None:   # not there yet, timed out or failed - show the raft as missing
+                if ccd_slot is not None:
+                    test_list = np.full(16, np.nan, dtype=np.float32)
+                elif raft_slot in fpa.corner_raft_slots:
+                    test_list = np.full(48, np.nan, dtype=np.float32)
+                else:
+                    test_list = np.full(144, np.nan, dtype=np.float32)
+            return test_list
 
         if BOT:
             #if self.current_run not in self.test_cache or raft_index not in \
             #       self.test_cache[self.current_run][self.current_test]:
-            if self.current_run not in self.test_cache:
-                # use get_EO to fetch the test quantities from the eT results database
-                raft_list, data = self.connections["get_EO"][self.dbsel].get_tests(site_type=self.EO_type,
-                                                                                   run=self.current_run)
-                res = self.connections["get_EO"][self.dbsel].get_all_results(data=data, device=raft_list)
-                self.test_cache[self.current_run] = res
-                avail_tests = self.get_step.get_test_info(runData=data)
-                self.menu_test_cache[self.current_run] = [(t, t) for t in avail_tests]
+            # the current test first - the rest of the run follows in the background
+            self.data.fill_run_test(run=self.current_run, test=self.current_test, done=self.run_done_callback())
 
         else:
-            if self.current_run not in self.test_cache or raft_index not in \
-                    self.test_cache[self.current_run]:
-                # use get_EO to fetch the test quantities from the eT results database
-                raft_list, data = self.connections["get_EO"][self.dbsel].get_tests(site_type=self.EO_type,
-                                                                                   run=self.current_run)
-                res = self.connections["get_EO"][self.dbsel].get_all_results(data=data, device=raft_list)
-                c = self.test_cache.setdefault(self.current_run, {})
-                c[raft_list] = res
-                avail_tests = self.get_step.get_test_info(runData=data)
-                self.menu_test_cache[self.current_run] = [(t, t) for t in avail_tests]
+            self.data.fill_raft_run_cache(run=self.current_run, raft=raft_index)
 
-        found_test = False
-        for tests in self.menu_test_cache[self.current_run]:
-            if tests[0] == self.current_test:
-                found_test = True
-                break
-
-        if not found_test:  # if user has asked for non-existent test via CL
-            self.current_test = self.menu_test_cache[self.current_run][0][0]
-
-        ccd_idx = {"S00":0, "S01":1, "S02":2, "S10":3, "S11":4, "S12":5, "S20":6, "S21":7, "S22":8 }
-        CR_ccd_idx = {"SG0":0, "SG1":1, "SW0":2, "SW1":2.5}
+        self.update_test_menu()
 
         # fetch the test from the cache
 
-        self.menu_test = self.menu_test_cache[self.current_run]
-        self.drop_test.menu = self.menu_test
-        if self.user_hook is not None:
-            if self.menu_test[0][0] != "User":
-                self.menu_test.insert(0,("User", "User"))
-
-#        if self.EO_type == "I&T-BOT":
-
-        if raft_slot in ["R00", "R04", "R40", "R44"]:  # CR slots
-            len_raft = 48
-        else:
-            len_raft = 144
-
         if BOT:
-            test_list = [-1.]*len_raft
+            if self.compare_active():
+                arr = self.compare_array()
+            else:
+                arr = self.array_cache[self.current_run][self.current_test]
             if self.single_ccd_mode or self.solo_ccd_mode:
-                test_list = [-1.] * 16
-            t = self.test_cache[self.current_run][self.current_test][raft_slot]
-
-            for ccd in t:
-                if (self.single_ccd_mode or self.solo_ccd_mode) and ccd != self.single_ccd_name[0][1]:
-                    continue
-
-                # calculate offset per sensor into the test q array
-                if "G" in ccd or "W" in ccd:
-                    list_idx = int(16 * CR_ccd_idx[ccd])
-                else:
-                    list_idx = 16 * ccd_idx[ccd]
-
-                if self.single_ccd_mode or self.solo_ccd_mode:
-                    list_idx = 0
-
-                # kludge for CR - fake 2 guider half-sensors as a single one - assume they arrive in order
-
-                t_end = 16
-                t_start = 0
-                if ccd == "SW0" or ccd == "SW1":   #SW has only 8 real amps; rest padded with -1
-                    t_end = 8
-
-                for i in range(t_start, t_end):
-                    test_list[list_idx+i] = t[ccd][i]
+                test_list = fpa.ccd_vector(arr, raft_slot, self.single_ccd_name[0][1])
+            else:
+                test_list = fpa.raft_vector(arr, raft_slot)
 
         else:
             t = self.test_cache[self.current_run][self.current_raft][self.current_test]
 
-            ccd_name = ""
-            for ccd in t:
-                # if in single CCD mode, only return that one's quantities
-                if (self.single_ccd_mode or self.solo_ccd_mode) and ccd != self.single_ccd_name[0][0]:
-                    continue
-                test_list.extend(t[ccd])
+            # if in single CCD mode, only return that one's quantities
+            if self.single_ccd_mode or self.solo_ccd_mode:
+                test_list = np.asarray(t[self.single_ccd_name[0][0]], dtype=np.float32)
+            else:
+                test_list = np.concatenate([np.asarray(t[ccd], dtype=np.float32) for ccd in t])
 
         self.testq_timer += time.time() - in_time
 
@@ -524,6 +653,569 @@ class renderFocalPlane():
 
         return test_list
 
+    def raft_contents(self, raft_name=None):
+        """
+        :param raft_name: raft serial
+        :return: raftContents for the raft in the current run; the run 11974 geometry for Dev and older runs
+        """
+        return self.data.raft_contents(raft_name=raft_name, run=self.current_run, emulate=self.emulate)
+
+    def compare_active(self):
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        if not BOT or self.compare_op is None or "user" in self.current_test.lower():
+            return False
+        if self.compare_op == "slope" or self.compare_op in self.aggregate_ops:
+            return len(self.trend_runs) > 0
+        return self.reference_run is not None
+
+    def reference_slot_map(self, run=None, reference_run=None):
+        """
+        Match rafts between two runs by serial number, so rafts that moved slots are compared with themselves
+        :param run: run number
+        :param reference_run: reference run number
+        :return: int array (25,) - for each raft slot of run, the slot index of the same raft in the reference
+        run; -1 if the raft is not in the reference run
+        """
+        key = (run, reference_run)
+        if key not in self.slot_map_cache:
+            ref_slots = {raft[0]: raft[1] for raft in self.data.fp_contents(run=reference_run)}
+            src = np.full(fpa.n_raft, -1, dtype=int)
+            for raft in self.data.fp_contents(run=run):
+                ref_slot = ref_slots.get(raft[0])
+                if raft[1] in fpa.raft_index and ref_slot in fpa.raft_index:
+                    src[fpa.raft_index[raft[1]]] = fpa.raft_index[ref_slot]
+            self.lru_store(cache=self.slot_map_cache, key=key, value=src, size=self.slot_map_cache_size)
+        self.slot_map_cache.move_to_end(key)
+        return self.slot_map_cache[key]
+
+    def lru_store(self, cache=None, key=None, value=None, size=None):
+        """
+        Add an entry to an OrderedDict cache kept least recently used first (callers move_to_end on hits),
+        dropping the oldest entries beyond size
+        :return: nothing
+        """
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    def aligned_array(self, run=None):
+        """
+        The current test for another run, with its rafts moved to their slots in the current run
+        :param run: run number, already in the cache
+        :return: (25, 9, 16) float32 array; NaN where the run has no data
+        """
+        arr = self.array_cache.get(run, {}).get(self.current_test)
+        if arr is None:
+            print("Run ", run, " has no ", self.current_test)
+            return fpa.empty_array()
+
+        src = self.reference_slot_map(run=self.current_run, reference_run=run)
+        aligned = arr[np.maximum(src, 0)]
+        aligned[src < 0] = np.nan
+        return aligned
+
+    def parse_run_list(self, text=None):
+        return self.data.parse_run_list(text=text)
+
+    def trend_matrix(self):
+        """
+        Assemble the current test over the trend runs, rafts matched by serial to the current run's slots. The runs
+        are streamed (see streamed_runs), so only the matrix is kept
+        :return: (list of runs with the test, (amp x run) matrix of shape (3600, n_run), (25, 9, 16) array of the
+        least-squares slope per run of each amp)
+        """
+        key = (tuple(self.trend_runs), self.current_run, self.current_test)
+        if key not in self.trend_cache:
+            self.data.fill_run_cache(run=self.current_run)
+            runs = []
+            columns = []
+            for run in self.streamed_runs(runs=self.trend_runs):
+                runs.append(run)
+                columns.append(self.aligned_array(run=run).ravel())
+            if len(runs) > 0:
+                matrix = np.stack(columns, axis=-1)
+            else:
+                matrix = np.full((fpa.n_raft * fpa.n_ccd * fpa.n_amp, 0), np.nan, dtype=np.float32)
+            slope = fpa.trend_slope(matrix).reshape(fpa.n_raft, fpa.n_ccd, fpa.n_amp)
+            self.lru_store(cache=self.trend_cache, key=key, value=(runs, matrix, slope), size=self.trend_cache_size)
+        self.trend_cache.move_to_end(key)
+        return self.trend_cache[key]
+
+    def streamed_runs(self, runs=None):
+        """
+        Fetch runs max_fetch_workers at a time, yielding those that have the current test. Runs that were not
+        already cached (other than the current and reference runs) are dropped again once the caller has moved
+        past their batch, so memory does not grow with the number of runs
+        :param runs: list of run numbers
+        :return: generator of run numbers, in order
+        """
+        chunk = self.data.max_fetch_workers
+        for i in range(0, len(runs), chunk):
+            batch = runs[i:i + chunk]
+            fetched = [run for run in batch if run not in self.test_cache]
+            failed = self.data.fill_run_caches(runs=batch)
+            for run in batch:
+                if run not in failed and self.current_test in self.array_cache[run]:
+                    yield run
+            for run in fetched:
+                if run not in [self.current_run, self.reference_run]:
+                    self.data.release_run(run=run)
+
+    def aggregate_array(self):
+        """
+        Per-amp aggregate (compare_op: mean, median, std or percentile) of the current test over the trend runs,
+        rafts matched by serial to the current run's slots. The runs are streamed into a runAggregator
+        :return: (25, 9, 16) float32 array
+        """
+        key = (tuple(self.trend_runs), self.current_run, self.current_test)
+        if key not in self.aggregate_cache:
+            aggregator = runAggregator(reservoir_size=self.reservoir_size)
+            self.data.fill_run_cache(run=self.current_run)
+            for run in self.streamed_runs(runs=self.trend_runs):
+                aggregator.add(arr=self.aligned_array(run=run), run=run)
+            self.lru_store(cache=self.aggregate_cache, key=key, value=aggregator, size=self.aggregate_cache_size)
+        self.aggregate_cache.move_to_end(key)
+
+        return self.aggregate_cache[key].result(op=self.compare_op, percentile=self.aggregate_percentile)
+
+    def playback_active(self, view=None):
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        return BOT and self.full_FP_mode and view is None and len(self.playback_runs) > 0 and \
+            self.heatmap_backend == "rect" and not self.lod and not self.compare_active() and \
+            "user" not in self.current_test.lower()
+
+    def playback_frames(self):
+        """
+        The current test for each playback run, rafts matched by serial to the current run's slots. Only the
+        latest run list/test is kept
+        :return: OrderedDict {run: (25, 9, 16) float32 array} of the runs that have the test
+        """
+        key = (tuple(self.playback_runs), self.current_run, self.current_test)
+        if key not in self.playback_cache:
+            self.data.fill_run_cache(run=self.current_run)
+            frames = OrderedDict()
+            for run in self.streamed_runs(runs=self.playback_runs):
+                frames[run] = self.aligned_array(run=run)
+            self.playback_cache = {key: frames}
+        return self.playback_cache[key]
+
+    def playback_controls(self, amp_renderer=None, color_mapper=None):
+        """
+        Add a run_<run> column per playback run to the heatmap source and make the slider and play button
+        that step through them. Stepping only swaps the fill_color field of the amp renderer in the browser;
+        the colour range spans all the frames so they can be compared
+        :param amp_renderer: heatmap amp renderer
+        :param color_mapper: its colour mapper
+        :return: bokeh row of the controls, or None if there are no frames
+        """
+        frames = self.playback_frames()
+        if len(frames) == 0:
+            return None
+
+        runs = list(frames)
+        for run in runs:
+            self.source.data["run_" + run] = frames[run].ravel()[self.fp_index]
+
+        values = np.concatenate([self.source.data["run_" + run] for run in runs])
+        lo, hi = fpa.nan_range(values)
+        if self.robust_range and np.isfinite(values).any():
+            lo, hi = (float(v) for v in np.nanpercentile(values, [1, 99]))
+        color_mapper.update(low=lo, high=hi)
+
+        start = runs.index(self.current_run) if self.current_run in runs else 0
+        amp_renderer.glyph.fill_color = {'field': 'run_' + runs[start], 'transform': color_mapper}
+        self.heatmap.title.text = self.current_test + " Run: " + runs[start]
+        # the hover shows the value of the frame on display
+        hover = self.heatmap.select_one(HoverTool)
+        hover.tooltips = hover.tooltips[:-1] + [(self.current_test, "@run_" + runs[start])]
+
+        slider = Slider(start=0, end=max(len(runs) - 1, 1), value=start, step=1, title="Playback frame",
+                        disabled=len(runs) == 1, width=400)
+        slider.js_on_change('value', CustomJS(
+            args=dict(glyph=amp_renderer.glyph, mapper=color_mapper, title=self.heatmap.title, hover=hover,
+                      runs=runs, test=self.current_test),
+            code="""
+            const run = runs[cb_obj.value]
+            glyph.fill_color = {field: "run_" + run, transform: mapper}
+            title.text = test + " Run: " + run
+            hover.tooltips = hover.tooltips.slice(0, -1).concat([[test, "@run_" + run]])
+            """))
+        play = Toggle(label="Play", button_type="success", width=80)
+        play.js_on_change('active', CustomJS(args=dict(slider=slider, interval=self.playback_interval), code="""
+            window.playback_timers = window.playback_timers || {}
+            if (cb_obj.active) {
+                cb_obj.label = "Pause"
+                window.playback_timers[cb_obj.id] = setInterval(function () {
+                    slider.value = slider.value < slider.end ? slider.value + 1 : slider.start
+                }, interval)
+            } else {
+                cb_obj.label = "Play"
+                clearInterval(window.playback_timers[cb_obj.id])
+            }
+            """))
+        return row(play, slider)
+
+    def trend_plot(self):
+        """
+        Trend of the current test over the trend runs: per raft medians in full focal plane mode, per CCD
+        medians of the selected raft in single raft mode, the amps of the selected CCD in single CCD mode
+        :return: bokeh figure, or None if not trending
+        """
+        if not (self.compare_active() and self.compare_op == "slope"):
+            return None
+
+        runs, matrix, _ = self.trend_matrix()
+        matrix = matrix.reshape(fpa.n_raft, fpa.n_ccd, fpa.n_amp, -1)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)   # all-NaN units give NaN
+            if self.full_FP_mode:
+                labels = fpa.raft_slot_names
+                lines = np.nanmedian(matrix.reshape(fpa.n_raft, -1, len(runs)), axis=1)
+            elif self.single_raft_mode:
+                slot = self.single_raft_name[0][1]
+                ccd_slots = fpa.corner_raft_ccd_slots if slot in fpa.corner_raft_slots else fpa.ccd_slot_names
+                labels = [slot + " " + ccd_slot for ccd_slot in ccd_slots]
+                lines = np.nanmedian(matrix[fpa.raft_index[slot], :len(ccd_slots)], axis=1)
+            else:
+                slot = self.single_raft_name[0][1]
+                ccd_slot = self.single_ccd_name[0][1]
+                labels = [slot + " " + ccd_slot + " amp " + str(amp + 1) for amp in range(fpa.n_amp)]
+                lines = matrix[fpa.raft_index[slot], fpa.ccd_index[ccd_slot]]
+
+        keep = np.isfinite(lines).any(axis=1)
+        x = np.arange(len(runs))
+        trend_source = ColumnDataSource(data=dict(xs=[x] * int(keep.sum()), ys=list(lines[keep]),
+                                                  unit=[label for label, k in zip(labels, keep) if k],
+                                                  color=[trend_palette[i % len(trend_palette)]
+                                                         for i in range(int(keep.sum()))]))
+
+        t = figure(title=self.current_test + " trend", tools="pan, wheel_zoom, box_zoom, reset, save, hover",
+                   tooltips=[("", "@unit")], width=900, height=300, output_backend=self.output_backend)
+        t.multi_line(xs="xs", ys="ys", line_color="color", source=trend_source, line_width=2)
+        t.xaxis.ticker = list(x)
+        t.xaxis.major_label_overrides = {int(i): str(run) for i, run in enumerate(runs)}
+        t.xaxis.major_label_orientation = 0.8
+        return t
+
+    def mosaic_plot(self):
+        """
+        Small multiples of the current test over the mosaic runs, in full focal plane mode. The runs are fetched
+        concurrently; the amp geometry is that of the current view (all its amps, whatever the heatmap source
+        holds), and each run's values are gathered from its focal plane arrays into a column of a single source
+        shared by all the panels
+        :return: bokeh grid, or None if there are no mosaic runs
+        """
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        if not (BOT and self.full_FP_mode and len(self.mosaic_runs) > 0 and self.fp_index is not None) or \
+                "user" in self.current_test.lower():
+            return None
+
+        failed = self.data.fill_run_caches(runs=self.mosaic_runs)
+        runs = [run for run in self.mosaic_runs if run not in failed and self.current_test in self.array_cache[run]]
+        if len(runs) == 0:
+            return None
+
+        columns = {k: self.amp_columns[k] for k in ["x", "y", "raft_code", "ccd_code", "amp_number"]}
+        for run in runs:
+            columns["run_" + run] = self.array_cache[run][self.current_test].ravel()[self.fp_index]
+        mosaic_source = ColumnDataSource(data=columns)
+
+        values = np.concatenate([columns["run_" + run] for run in runs])
+        lo, hi = fpa.nan_range(values)
+        if self.robust_range and np.isfinite(values).any():
+            lo, hi = (float(v) for v in np.nanpercentile(values, [1, 99]))
+        color_mapper = LinearColorMapper(palette=palette, low=lo, high=hi, nan_color="lightgrey")
+
+        panels = []
+        for run in runs:
+            p = figure(title="Run: " + run, tools="pan, wheel_zoom, box_zoom, reset, save, hover",
+                       tooltips=[("Raft slot", "@raft_code{slot}"), ("CCD slot", "@ccd_code{slot}"),
+                                 ("Amp", "@amp_number"), (self.current_test, "@run_" + run)],
+                       x_axis_location=None, y_axis_location=None, width=300, height=300,
+                       match_aspect=True, output_backend=self.output_backend)
+            if len(panels) > 0:
+                p.x_range = panels[0].x_range
+                p.y_range = panels[0].y_range
+            p.grid.grid_line_color = None
+            p.rect(x='x', y='y', source=mosaic_source, width=self.amp_width, height=self.ccd_width / 2.,
+                   line_color=None, fill_color={'field': 'run_' + run, 'transform': color_mapper})
+            p.hover.formatters = self.code_formatters()
+            panels.append(p)
+        panels[-1].add_layout(ColorBar(color_mapper=color_mapper, label_standoff=12, border_line_color=None,
+                                       location=(0, 0)), "right")
+        return gridplot(panels, ncols=self.mosaic_columns)
+
+    def corr_active(self):
+        # the scatter shares the heatmap source, which only holds the amps in view under level of detail (and is
+        # filled raft by raft when progressive - render does not go progressive with a correlation test)
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        return BOT and self.corr_test is not None and self.fp_index is not None and \
+            not (self.lod and self.full_FP_mode) and self.corr_test in self.array_cache.get(self.current_run, {})
+
+    def corr_plot(self):
+        """
+        Scatter of the displayed values against the correlation test, per amp. It draws from the heatmap source
+        (adding the corr_q column), so a box/lasso selection in either plot highlights the amps in both
+        :return: bokeh figure, or None if there is no correlation test
+        """
+        if not self.corr_active():
+            return None
+
+        self.source.data["corr_q"] = self.array_cache[self.current_run][self.corr_test].ravel()[self.fp_index]
+
+        x_label = self.current_test
+        if self.compare_active():
+            x_label += " " + self.compare_op
+        c = figure(title=x_label + " vs " + self.corr_test,
+                   tools="pan, wheel_zoom, box_zoom, reset, save, box_select, lasso_select, hover",
+                   tooltips=[("Raft slot", "@raft_code{slot}"), ("CCD slot", "@ccd_code{slot}"),
+                             ("Amp", "@amp_number"), (x_label, "@test_q"), (self.corr_test, "@corr_q")],
+                   x_axis_label=x_label, y_axis_label=self.corr_test, width=600, height=600,
+                   output_backend=self.output_backend)
+        c.circle(x="test_q", y="corr_q", source=self.source, size=4, fill_alpha=0.5, line_color=None,
+                 selection_color="red", nonselection_fill_alpha=0.1)
+        c.hover.formatters = self.code_formatters()
+        return c
+
+    def compare_array(self):
+        """
+        Difference (current - reference) or ratio (current / reference) of the current test between the
+        current run and the reference run; or the slope per run over the trend runs
+        :return: (25, 9, 16) float32 array; NaN where either run has no data
+        """
+        if self.compare_op == "slope":
+            return self.trend_matrix()[2]
+        if self.compare_op in self.aggregate_ops:
+            return self.aggregate_array()
+
+        key = (self.current_run, self.reference_run, self.current_test, self.compare_op)
+        if key in self.compare_cache:
+            self.compare_cache.move_to_end(key)
+            return self.compare_cache[key]
+
+        self.data.fill_run_caches(runs=[self.current_run, self.reference_run])
+        current = self.array_cache[self.current_run][self.current_test]
+        aligned = self.aligned_array(run=self.reference_run)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if self.compare_op == "ratio":
+                out = current / aligned
+            else:
+                out = current - aligned
+        self.lru_store(cache=self.compare_cache, key=key, value=out, size=self.compare_cache_size)
+        return out
+
+    def call_user_fp_hook(self):
+        """
+        Call the vectorized user hook once for the whole focal plane of the current run.
+        The hook gets the run's cached results as {test name: (25, 9, 16) float32 array} (see focalPlaneArrays)
+        and returns one array of the same shape.
+        :return: (25, 9, 16) float32 array
+        """
+        self.set_db(run=self.current_run)
+        self.data.fill_run_cache(run=self.current_run)
+
+        hook_args = dict(run=self.current_run, mode=self.current_mode, store=self.array_cache[self.current_run],
+                         test=self.current_test, range_limits=self.slider_limits)
+        if self.hook_runner is None:
+            out = np.asarray(self.user_fp_hook(**hook_args), dtype=np.float32)
+        else:
+            hook_args["range_limits"] = dict(self.slider_limits)
+            out = self.hook_result(slot="fp", hook_args=hook_args)
+            if out is None:   # not there yet, timed out or failed - show everything as missing
+                return fpa.empty_array()
+        if out.shape != (fpa.n_raft, fpa.n_ccd, fpa.n_amp):
+            print("User fp_hook - error in shape of returned array: ", out.shape)
+            raise ValueError
+        return out
+
+    def hook_key(self):
+        """
+        :return: the view the isolated hook results are for. Not current_raft: the full focal plane render steps
+        it through the rafts, which the results are keyed by anyway (see hook_result)
+        """
+        return (self.current_run, self.current_mode, self.current_test, str(self.single_ccd_name), self.emulate,
+                self.hook_generation)
+
+    def hook_result(self, slot=None, hook_args=None):
+        """
+        Isolated hook result for this view, if hook_done has delivered it; otherwise the call is queued for
+        submit_hooks
+        :param slot: (raft slot, ccd slot) for the per-raft hook, "fp" for the vectorized hook
+        :param hook_args: hook arguments
+        :return: hook output, None if not there yet or the call timed out or failed
+        """
+        if self.hook_results is not None and self.hook_results["key"] == self.hook_key() and \
+                slot in self.hook_results["values"]:
+            return self.hook_results["values"][slot]
+        self.hook_requests.append((slot, hook_args))
+        return None
+
+    def submit_hooks(self):
+        """
+        Make the render's queued isolated hook calls in the runner's waiting thread; the results are drawn
+        from the event loop by hook_done
+        :return: nothing
+        """
+        if len(self.hook_requests) == 0 or self.hook_pending == self.hook_key():
+            return
+        key = self.hook_key()
+        self.hook_pending = key
+        requests = self.hook_requests
+        runner = self.hook_runner
+        doc = curdoc()
+
+        def calls():
+            runner.new_render()
+            values = {}
+            for slot, hook_args in requests:
+                if slot == "fp":
+                    values[slot] = runner.call_fp_hook(**hook_args)
+                else:
+                    values[slot] = runner.call_hook(**hook_args)
+            return values
+
+        self.hook_future = runner.run_async(calls=calls, done=lambda values: doc.add_next_tick_callback(
+            partial(self.hook_done, key=key, values=values, requests=requests)))
+
+    def hook_done(self, key=None, values=None, requests=None):
+        """
+        Event loop callback: keep the isolated hook results and redraw, if still showing the view they are for
+        :param key: hook_key of the view
+        :param values: {slot: hook output}; None if the calls could not be made
+        :param requests: the calls, whose range_limits the hooks may have updated
+        :return: nothing
+        """
+        if not self.keep_hook_results(key=key, values=values, requests=requests):
+            return
+        l_new = self.render()
+        m_new = layout(self.interactors, l_new)
+        self.layout.children = m_new.children
+
+    def keep_hook_results(self, key=None, values=None, requests=None):
+        """
+        :return: True if the results are new and for the view on display - it needs redrawing
+        """
+        if self.hook_pending == key:
+            self.hook_pending = None
+        if values is None or key != self.hook_key():
+            return False
+        if self.hook_results is not None and self.hook_results["values"] is values:
+            return False    # already drawn by wait_for_hooks
+        for _, hook_args in requests:
+            self.slider_limits.update(hook_args["range_limits"])
+        self.hook_results = {"key": key, "values": values}
+        return True
+
+    def wait_for_hooks(self):
+        """
+        Block until the isolated hook calls queued by the last render are done, and render again with their
+        results - for one-shot output such as the png export; the server uses hook_done
+        :return: the new layout, None if there was nothing to wait for
+        """
+        if self.hook_pending is None:
+            return None
+        key = self.hook_pending
+        requests = self.hook_requests
+        if not self.keep_hook_results(key=key, values=self.hook_future.result(), requests=requests):
+            return None
+        return self.render()
+
+    def get_run_stats(self):
+        """
+        :return: cached summary statistics for the current run and test, or None if there are none (solo raft
+        and emulation modes, user tests)
+        """
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        if not BOT or self.current_run not in self.stats_cache or self.compare_active():
+            return None
+        return self.stats_cache[self.current_run].get(self.current_test)
+
+    def robust_limits(self, test_q):
+        """
+        Slider auto-range on the 1st-99th percentiles, so single outliers do not wash out the colour scale
+        :param test_q: values being displayed
+        :return: (lo, hi)
+        """
+        stats = self.get_run_stats()
+        if stats is not None and self.full_FP_mode:
+            lo, hi = stats["focal_plane"]["p1"], stats["focal_plane"]["p99"]
+        elif np.isfinite(test_q).any():
+            lo, hi = np.nanpercentile(test_q, [1, 99])
+        else:
+            return 0., 1.
+        if not np.isfinite(lo) or not lo < hi:
+            return fpa.nan_range(test_q)
+        return float(lo), float(hi)
+
+    def failing_amps(self, test_q):
+        """
+        Which of the displayed amps fail: the current test's requirement if it has one, otherwise (BOT runs)
+        any requirement of the run. In comparison mode, the current run's values are evaluated
+        :param test_q: values being displayed
+        :return: boolean array aligned with the heatmap source, or None if there is nothing to evaluate
+        """
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        if BOT and self.current_run in self.fail_cache:
+            masks = self.fail_cache[self.current_run]
+            return masks.get(self.current_test, masks["any"]).ravel()[self.fp_index]
+
+        if self.data.requirements.has_requirement(test=self.current_test):
+            return self.data.requirements.fail_mask(test=self.current_test, values=test_q)
+        return None
+
+    def summary_table(self):
+        """
+        Table of the cached summary statistics: the focal plane and each raft; each CCD of the raft in the
+        single raft/CCD modes
+        :return: bokeh DataTable, or None if there are no statistics for this run/test
+        """
+        stats = self.get_run_stats()
+        if stats is None:
+            return None
+
+        fields = ["median", "mad", "p5", "p95", "count", "n_nan"]
+
+        # number of amps failing the test's requirement
+        fail = self.fail_cache.get(self.current_run, {}).get(self.current_test)
+        if fail is not None:
+            counts = self.data.requirements.failure_counts(mask=fail)
+            stats = dict(stats)
+            stats["focal_plane"] = dict(stats["focal_plane"], n_fail=counts["raft"].sum())
+            stats["raft"] = dict(stats["raft"], n_fail=counts["raft"])
+            stats["ccd"] = dict(stats["ccd"], n_fail=counts["ccd"])
+            fields = fields + ["n_fail"]
+
+        rows = {k: [] for k in ["unit"] + fields}
+
+        def add_row(unit, level_stats, idx):
+            rows["unit"].append(unit)
+            for f in fields:
+                rows[f].append(float(level_stats[f][idx]) if idx is not None else float(level_stats[f]))
+
+        if self.full_FP_mode:
+            add_row("Focal plane", stats["focal_plane"], None)
+            for r, slot in enumerate(fpa.raft_slot_names):
+                if stats["raft"]["count"][r] > 0 or stats["raft"]["n_nan"][r] > 0:
+                    add_row(slot, stats["raft"], r)
+        else:
+            slot = self.single_raft_name[0][1]
+            r = fpa.raft_index[slot]
+            add_row(slot, stats["raft"], r)
+            ccd_slots = fpa.corner_raft_ccd_slots if slot in fpa.corner_raft_slots else fpa.ccd_slot_names
+            for ccd_slot in ccd_slots:
+                add_row(slot + " " + ccd_slot, stats["ccd"], (r, fpa.ccd_index[ccd_slot]))
+
+        number = NumberFormatter(format="0[.]0000")
+        title = self.current_test
+        if fail is not None:
+            title += " (" + self.data.requirements.requirements[self.current_test]["id"] + ")"
+        columns = [TableColumn(field="unit", title=title)] + \
+                  [TableColumn(field=f, title=f, formatter=number) for f in fields]
+        return DataTable(source=ColumnDataSource(data=rows), columns=columns, width=900, height=280,
+                         index_position=None)
+
     def get_raft_content(self):
         """
         Figure out what rafts we need - be it in the full Focal Plane or single rafts
@@ -536,15 +1228,12 @@ class renderFocalPlane():
         if self.emulate is False:
             if self.full_FP_mode is True:
 #                raft_list = self.connections["eFP"][self.dbsel].focalPlaneContents(run=self.current_run)
-                if self.chk_11974(self.current_run):
-                    raft_list = self.connections["eFP"]["Prod"].focalPlaneContents(run=self.current_run)
-                else:
-                    raft_list = self.connections["eFP"]["Prod"].focalPlaneContents(run=11974)
+                raft_list = self.data.fp_contents(run=self.current_run)
                 self.current_FP_raft_list = raft_list
             # figure out the raft name etc from the desired run number
             elif self.solo_raft_mode is True:
                 run = self.current_run
-                run_info = self.connections["connect"][self.dbsel].getRunResults(run=run)
+                run_info = self.data.run_info(run=run)
                 raft_list = [[run_info['experimentSN'], "R22"]]
                 self.single_raft_name = raft_list
             # raft or CCD is on the focal plane; name set by tap_input selection
@@ -647,18 +1336,7 @@ class renderFocalPlane():
 
     def parse_emulation_config(self, file_spec=None):
 
-        df = pd.read_csv(file_spec, header=0, skipinitialspace=True)
-        raft_frame = df.set_index('raft', drop=False)
-
-        raft_col = raft_frame["raft"]
-        raft_list = []
-        run_list = []
-
-        for raft in raft_col:
-            slot = raft_frame.loc[raft, "slot"]
-            run = raft_frame.loc[raft, "run"]
-            raft_list.append([raft, slot])
-            run_list.append(str(run))
+        raft_list, run_list = self.data.parse_emulation_config(file_spec=file_spec)
 
         self.emulate_raft_list = raft_list
         self.current_raft_list = raft_list
@@ -684,18 +1362,13 @@ class renderFocalPlane():
         :param new: new value of self.source
         :return: nothing
 
-        # The index of the selected glyph is : new['1d']['indices'][0]
-        raft_name = self.source.data['raft_name'][new['1d']['indices'][0]]
-        raft_slot = self.source.data['raft_slot'][new['1d']['indices'][0]]
-        ccd_name = self.source.data['ccd_name'][new['1d']['indices'][0]]
-        ccd_slot = self.source.data['ccd_slot'][new['1d']['indices'][0]]
+        The raft and CCD names/slots are dictionary encoded in the source: raft_code and ccd_code index
+        self.raft_table and self.ccd_table
         """
 
         selected_row = new[0]
-        raft_name = self.source.data['raft_name'][selected_row]
-        raft_slot = self.source.data['raft_slot'][selected_row]
-        ccd_name = self.source.data['ccd_name'][selected_row]
-        ccd_slot = self.source.data['ccd_slot'][selected_row]
+        raft_name, raft_slot = self.raft_table[self.source.data['raft_code'][selected_row]]
+        ccd_name, ccd_slot = self.ccd_table[self.source.data['ccd_code'][selected_row]]
 
         self.single_raft_name = [[raft_name, raft_slot]]
         self.current_raft = raft_name
@@ -725,13 +1398,7 @@ class renderFocalPlane():
 
             self.set_db(run=self.current_run)
             # use PROD hardware description due to dev focal plane hardware mismatch
-            db_k = self.dbsel
-            use_run = self.current_run
-            if not self.emulate and not self.chk_11974(self.current_run):
-                db_k = "Prod"
-                use_run = 11974
-            raftContents = self.connections["eR"][db_k].raftContents(
-                raftName=raft_name, run=use_run)
+            raftContents = self.raft_contents(raft_name=raft_name)
             ccd_menu = [(tup[1] + ': ' + tup[0], tup[0]) for tup in raftContents]
             self.drop_ccd.menu = ccd_menu
 
@@ -746,25 +1413,304 @@ class renderFocalPlane():
             m_new = layout(self.interactors, l_new)
             self.layout.children = m_new.children
 
-    def select_input(self, attr, old, new):
+    def tap_heatmap(self, event):
         """
-        Handle the selections in the heatmap  or histogram.  Does nothing if
-        not in full Focal Plane mode
-        :param attr:
-        :param old: previous value of self.source
-        :param new: new value of self.source
+        Handle a click on the heatmap: map the click position to the amp under it and pass that on to tap_cb
+        as if the amp had been selected. Only taps drill down - box/lasso selections just highlight amps
+        :param event: bokeh Tap event
         :return: nothing
         """
+        if self.image_lookup is not None:
+            selected_row = self.image_row(event.x, event.y)
+        else:
+            selected_row = self.rect_row(event.x, event.y)
+        if selected_row < 0:
+            return
+        self.tap_cb("indices", [], [selected_row])
 
-        if self.full_FP_mode is True:
-            # The indices of the selected glyph is : new['1d']['indices']
-            min = self.histsource.data['left'][new['1d']['indices'][0]]
-            max = self.histsource.data['right'][new['1d']['indices'][-1]]
-            booleans = [True if val >= min and val <= max else False for val in self.source.data['test_q']]
-            view = CDSView(source=self.source, filters=[BooleanFilter(booleans)])
-            l_new = self.render(view=view)
-            m_new = layout(self.interactors, l_new)
-            self.layout.children = m_new.children
+    def rect_row(self, x, y):
+        """
+        :param x: x position
+        :param y: y position
+        :return: row index in self.source of the amp rect under the position, or -1 if there is none
+        """
+        data = self.source.data
+        if len(data["x"]) == 0:
+            return -1
+        hit = np.nonzero((np.abs(np.asarray(data["x"]) - x) <= self.amp_width / 2.) &
+                         (np.abs(np.asarray(data["y"]) - y) <= self.ccd_width / 4.))[0]
+        return int(hit[0]) if len(hit) > 0 else -1
+
+    def image_row(self, x, y):
+        """
+        Index math from a focal plane position to the row in self.source of the amp under it
+        :param x: x position
+        :param y: y position
+        :return: row index, or -1 if there is no amp there
+        """
+        if self.image_lookup is None:
+            return -1
+        col = int(np.floor((x - self.image_lookup["x0"]) / self.image_lookup["dw_pix"]))
+        row = int(np.floor((y - self.image_lookup["y0"]) / self.image_lookup["dh_pix"]))
+        amp_row = self.image_lookup["amp_row"]
+        if row < 0 or col < 0 or row >= amp_row.shape[0] or col >= amp_row.shape[1]:
+            return -1
+        return int(amp_row[row, col])
+
+    def draw_image_heatmap(self, x, y, test_q, color_mapper):
+        """
+        Rasterize the per-amp values into a 2-D array and draw it as a single image glyph. Amps are
+        1/8 x 1/2 in focal plane units and sit on a regular grid, so each amp is one pixel.
+        Hover labels are resolved in the browser from the pixel index via small lookup tables.
+        :param x: amp center x positions (ordered as self.source)
+        :param y: amp center y positions
+        :param test_q: amp values
+        :param color_mapper: color mapper shared with the color bar
+        :return: the image glyph renderer
+        """
+        dw_pix = self.amp_width
+        dh_pix = self.ccd_width / 2.
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        col = np.rint((x - x.min()) / dw_pix).astype(int)
+        row = np.rint((y - y.min()) / dh_pix).astype(int)
+        nx = col.max() + 1
+        ny = row.max() + 1
+
+        image = np.full((ny, nx), np.nan, dtype=np.float32)
+        image[row, col] = test_q
+
+        amp_row = np.full((ny, nx), -1, dtype=np.int32)
+        amp_row[row, col] = np.arange(len(x))
+
+        # raft/CCD codes per pixel; the names are resolved from self.raft_table/self.ccd_table
+        src = self.source.data
+        raft_code = np.full((ny, nx), -1, dtype=np.int8)
+        raft_code[row, col] = src['raft_code']
+        ccd_code = np.full((ny, nx), -1, dtype=np.int16)
+        ccd_code[row, col] = src['ccd_code']
+        amp_number = np.zeros((ny, nx), dtype=np.int8)
+        amp_number[row, col] = src['amp_number']
+
+        # pixels between CCDs (e.g. in the corner rafts) have no amp - leave them transparent. The image glyph
+        # cannot tell those apart from missing amps, so these are drawn underneath in the nan colour, as the
+        # rect backend shows them
+        missing = ~np.isfinite(np.asarray(test_q, dtype=np.float32))
+        if missing.any():
+            self.heatmap.rect(x=x[missing], y=y[missing], width=dw_pix, height=dh_pix, line_color=None,
+                              fill_color=color_mapper.nan_color)
+        color_mapper.nan_color = (0, 0, 0, 0.)
+
+        x0 = x.min() - dw_pix / 2.
+        y0 = y.min() - dh_pix / 2.
+        self.image_lookup = {"x0": x0, "y0": y0, "dw_pix": dw_pix, "dh_pix": dh_pix, "amp_row": amp_row}
+
+        img = self.heatmap.image(image=[image], x=x0, y=y0, dw=nx * dw_pix, dh=ny * dh_pix,
+                                 color_mapper=color_mapper)
+
+        pixels = ColumnDataSource(data=dict(raft_code=raft_code.ravel(), ccd_code=ccd_code.ravel(),
+                                            amp_number=amp_number.ravel()))
+        amp_label = CustomJSHover(args=dict(pixels=pixels, raft_table=self.table_source(self.raft_table),
+                                            ccd_table=self.table_source(self.ccd_table)),
+                                  code="""
+            const i = Math.floor((special_vars.x - %f) / %f);
+            const j = Math.floor((special_vars.y - %f) / %f);
+            if (i < 0 || j < 0 || i >= %d || j >= %d) { return ""; }
+            const k = j * %d + i;
+            const r = pixels.data.raft_code[k];
+            const c = pixels.data.ccd_code[k];
+            if (c < 0) { return ""; }
+            return raft_table.data.slot[r] + " " + raft_table.data.name[r] + " / " +
+                ccd_table.data.slot[c] + " " + ccd_table.data.name[c] + " amp " + pixels.data.amp_number[k];
+            """ % (x0, dw_pix, y0, dh_pix, nx, ny, nx))
+        hover = HoverTool(renderers=[img], point_policy="follow_mouse",
+                          tooltips=[("Amp", "$x{amp}"), (self.current_test, "@image")],
+                          formatters={"$x": amp_label})
+        self.heatmap.add_tools(hover)
+
+        return img
+
+    def setup_lod(self, amp_renderer, color_mapper, lo_val, hi_val):
+        """
+        Level of detail: summarize the amps per CCD (and per raft) and draw one tile per CCD coloured by
+        its median. The full per-amp data is kept in self.amp_data; self.source only gets the amps in view
+        once zoomed in (see update_lod).
+        :param amp_renderer: the per-amp rect renderer
+        :param color_mapper: color mapper shared with the amps
+        :param lo_val: low end of the colour range
+        :param hi_val: high end of the colour range
+        :return: nothing
+        """
+        self.amp_data = dict(self.source.data)
+        ccd_code = self.amp_data['ccd_code']
+        raft_code = self.amp_data['raft_code']
+        test_q = self.amp_data['test_q']
+        n_ccd = len(self.ccd_table)
+        n_raft = len(self.raft_table)
+
+        ccd_stats = fpa.group_stats(test_q, ccd_code, n_ccd, lo=lo_val, hi=hi_val)
+        raft_stats = fpa.group_stats(test_q, raft_code, n_raft, lo=lo_val, hi=hi_val)
+
+        # tile extents from the amps in each CCD - covers the corner raft half-sensors as well
+        x_mat = fpa.grouped_matrix(self.amp_data['x'], ccd_code, n_ccd)
+        y_mat = fpa.grouped_matrix(self.amp_data['y'], ccd_code, n_ccd)
+        x_lo = np.nanmin(x_mat, axis=1) - self.amp_width / 2.
+        x_hi = np.nanmax(x_mat, axis=1) + self.amp_width / 2.
+        y_lo = np.nanmin(y_mat, axis=1) - self.ccd_width / 4.
+        y_hi = np.nanmax(y_mat, axis=1) + self.ccd_width / 4.
+
+        ccd_raft = np.zeros(n_ccd, dtype=np.int8)
+        ccd_raft[ccd_code] = raft_code
+
+        self.ccd_tile_source = ColumnDataSource(data=dict(
+            x=(x_lo + x_hi) / 2., y=(y_lo + y_hi) / 2., width=x_hi - x_lo, height=y_hi - y_lo,
+            raft_code=ccd_raft, ccd_code=np.arange(n_ccd, dtype=np.int16),
+            median=ccd_stats["median"].astype(np.float32), min=ccd_stats["min"].astype(np.float32),
+            max=ccd_stats["max"].astype(np.float32), n_out=ccd_stats["n_out"],
+            raft_median=raft_stats["median"][ccd_raft].astype(np.float32),
+            raft_n_out=raft_stats["n_out"][ccd_raft], alpha=np.full(n_ccd, self.amp_alpha, dtype=np.float32)))
+
+        tiles = self.heatmap.rect(x='x', y='y', width='width', height='height', source=self.ccd_tile_source,
+                                  color="black", fill_alpha='alpha',
+                                  fill_color={'field': 'median', 'transform': color_mapper}, line_width=0.5)
+
+        # the figure's hover tool stays with the amps; the tiles get their own
+        self.heatmap.hover.renderers = [amp_renderer]
+        tile_hover = HoverTool(renderers=[tiles], point_policy="follow_mouse",
+                               tooltips=[("Raft", "@raft_code{slot} @raft_code{name}"),
+                                         ("CCD", "@ccd_code{slot} @ccd_code{name}"),
+                                         ("median", "@median"), ("min", "@min"), ("max", "@max"),
+                                         ("amps out of range", "@n_out"), ("raft median", "@raft_median"),
+                                         ("raft amps out of range", "@raft_n_out")],
+                               formatters=self.code_formatters())
+        self.heatmap.add_tools(tile_hover)
+
+        self.lod_renderers = (tiles, amp_renderer)
+        self.heatmap.on_event(RangesUpdate, self.update_lod)
+        self.show_lod_region(None)
+
+    def update_lod(self, event):
+        """
+        Switch level of detail when the heatmap is zoomed or panned
+        :param event: bokeh RangesUpdate event
+        :return: nothing
+        """
+        if self.lod_renderers is None:
+            return
+        if max(event.x1 - event.x0, event.y1 - event.y0) >= self.lod_span:
+            self.show_lod_region(None)
+        else:
+            self.show_lod_region((event.x0, event.x1, event.y0, event.y1))
+
+    def show_lod_region(self, region):
+        """
+        :param region: (x0, x1, y0, y1) to show the amps in; None to show the CCD tiles
+        :return: nothing
+        """
+        tiles, amps = self.lod_renderers
+        if region is None:
+            mask = np.zeros(len(self.amp_data['x']), dtype=bool)
+        else:
+            x0, x1, y0, y1 = region
+            x = self.amp_data['x']
+            y = self.amp_data['y']
+            mask = (x >= x0 - self.ccd_width) & (x <= x1 + self.ccd_width) & \
+                   (y >= y0 - self.ccd_width) & (y <= y1 + self.ccd_width)
+
+        self.source.selected.indices = []
+        data = {k: v[mask] for k, v in self.amp_data.items()}
+        data['alpha'] = self.hist_alpha(data[amps.glyph.fill_color['field']])
+        self.source.data = data
+        tiles.visible = region is None
+        amps.visible = region is not None
+
+    def code_formatters(self):
+        """
+        Hover formatters resolving the dictionary encoded raft_code/ccd_code columns to names and slots
+        via the lookup tables. Use as "@raft_code{name}" or "@raft_code{slot}" in the tooltips.
+        :return: dict of formatters for HoverTool.formatters
+        """
+        lookup = """
+            return format == "slot" ? table.data.slot[value] : table.data.name[value];
+            """
+        return {"@raft_code": CustomJSHover(args=dict(table=self.table_source(self.raft_table)), code=lookup),
+                "@ccd_code": CustomJSHover(args=dict(table=self.table_source(self.ccd_table)), code=lookup)}
+
+    def table_source(self, table):
+        """
+        :param table: lookup table - list of [name, slot]
+        :return: ColumnDataSource with name and slot columns, for use in javascript callbacks
+        """
+        return ColumnDataSource(data=dict(name=[entry[0] for entry in table], slot=[entry[1] for entry in table]))
+
+    def hist_select_callback(self, glyph=None, image=None, tiles=None):
+        """
+        Browser-side handling of a histogram selection, with no server round trip: amps with values inside the
+        selected bins keep their alpha, the others are faded, by rewriting the alpha column of the heatmap source
+        in place. The image backend has no per-amp alpha - its pixels outside the selection are blanked instead.
+        Level of detail CCD tiles are faded if none of their amps can be in the selection. An empty selection
+        restores all amps
+        :param glyph: amp rect glyph; the values are taken from the column it is coloured by (the playback frame
+        on display, see playback_controls). test_q if None
+        :param image: image backend renderer (see draw_image_heatmap)
+        :param tiles: level of detail CCD tile source (see setup_lod)
+        :return: CustomJS for the histogram source's selection indices
+        """
+        code = """
+            const idx = cb_obj.indices;
+            let lo = Infinity;
+            let hi = -Infinity;
+            for (const i of idx) {
+                lo = Math.min(lo, hist.data.left[i]);
+                hi = Math.max(hi, hist.data.right[i]);
+            }
+            const inside = (x) => idx.length == 0 || (x >= lo && x <= hi);
+            if (image !== null) {
+                const img = image.data_source.data.image[0];
+                const v = pixels.data.value;
+                for (let k = 0; k < v.length; k++) {
+                    img[k] = inside(v[k]) ? v[k] : NaN;
+                }
+                image.data_source.change.emit();
+            } else {
+                const v = source.data[glyph === null ? "test_q" : glyph.fill_color.field];
+                const alpha = source.data.alpha;
+                for (let i = 0; i < v.length; i++) {
+                    alpha[i] = inside(v[i]) ? on : off;
+                }
+                source.change.emit();
+            }
+            if (tiles !== null) {
+                const t = tiles.data;
+                for (let i = 0; i < t.alpha.length; i++) {
+                    t.alpha[i] = (idx.length == 0 || (t.max[i] >= lo && t.min[i] <= hi)) ? on : off;
+                }
+                tiles.change.emit();
+            }
+            """
+        # the image's own values are overwritten, so the callback keeps a copy
+        pixels = None
+        if image is not None:
+            pixels = ColumnDataSource(data=dict(value=np.asarray(image.data_source.data["image"][0]).ravel()))
+        return CustomJS(args=dict(source=self.source, hist=self.histsource, glyph=glyph, image=image,
+                                  pixels=pixels, tiles=tiles, on=self.amp_alpha, off=self.amp_alpha_faded),
+                        code=code)
+
+    def hist_alpha(self, values):
+        """
+        Server-side counterpart of hist_select_callback, for amp sources rebuilt on the server (level of detail)
+        :param values: amp values
+        :return: float32 amp alpha for the histogram's current selection
+        """
+        alpha = np.full(len(values), self.amp_alpha, dtype=np.float32)
+        idx = self.histsource.selected.indices
+        if len(idx) > 0:
+            lo = min(self.histsource.data['left'][i] for i in idx)
+            hi = max(self.histsource.data['right'][i] for i in idx)
+            values = np.asarray(values, dtype=np.float32)
+            alpha[~((values >= lo) & (values <= hi))] = self.amp_alpha_faded
+        return alpha
 
     def update_dropdown_test(self, event):
         new_test = event.item
@@ -877,13 +1823,7 @@ class renderFocalPlane():
                 #    self.single_raft_name = [raft_list[1]]
                 self.set_db(run=self.current_run)
                 # use prod hardware definition for full focal plane due to dev geometry mismatch
-                db_k = self.dbsel
-                use_run = self.current_run
-                if not self.emulate and not self.chk_11974(self.current_run):
-                    db_k = "Prod"
-                    use_run = 11974
-                raftContents = self.connections["eR"][db_k].raftContents(
-                    raftName=self.single_raft_name[0][0], run=use_run)
+                raftContents = self.raft_contents(raft_name=self.single_raft_name[0][0])
                 ccd_menu = [(tup[1] + ': ' + tup[0], tup[0]) for tup in raftContents]
                 print(ccd_menu)
                 self.drop_ccd.label = "Select CCD from " + self.single_raft_name[0][0][-7:]
@@ -947,13 +1887,7 @@ class renderFocalPlane():
                 #    self.single_raft_name = [raft_list[1]]
                 self.set_db(run=self.current_run)
                 # use prod hardware definition for full focal plane due to dev geometry mismatch
-                db_k = self.dbsel
-                use_run = self.current_run
-                if not self.emulate and not self.chk_11974(self.current_run):
-                    db_k = "Prod"
-                    use_run = 11974
-                raftContents = self.connections["eR"][db_k].raftContents(
-                    raftName=self.single_raft_name[0][0], run=use_run)
+                raftContents = self.raft_contents(raft_name=self.single_raft_name[0][0])
                 ccd_menu = [(tup[1] + ': ' + tup[0], tup[0]) for tup in raftContents]
                 print(ccd_menu)
                 self.drop_ccd.label = "Select CCD from " + self.single_raft_name[0][0][-7:]
@@ -992,7 +1926,7 @@ class renderFocalPlane():
 
             # figure out what kind of run this is: Full focal plane or single raft
             self.set_db(run=new_run)
-            run_info = self.connections["connect"][self.dbsel].getRunResults(run=new_run)
+            run_info = self.data.run_info(run=new_run)
             hw = run_info['experimentSN']
 
             if "CRYO" in hw.upper():   # full Focal Plane
@@ -1096,12 +2030,14 @@ class renderFocalPlane():
 
     def do_exit(self):
         print("Shutting down app")
+        if self.hook_runner is not None:
+            self.hook_runner.shutdown()
         sys.exit(0)
 
     def do_reload(self):
         if self.user_module_input is not None:
-            print("Reloading ", self.user_hook)
-            self.load_user_module(name=self.user_hook)
+            print("Reloading ", self.user_module)
+            self.load_user_module(name=self.user_module)
 
             l_new_run = self.render()
             m_new_run = layout(self.interactors, l_new_run)
@@ -1110,18 +2046,34 @@ class renderFocalPlane():
     # load (or reload) the user module. If there is an init function in the module, call it to
     # set up the user defined menu of tests. If not there, the default test is User. All user tests
     # must have "user" in the name. init function must have a menu_button argument
+    # The module supplies hook (called per raft, returning that raft's 144/48 list) and/or fp_hook (called
+    # once per render with the run's cached focal plane arrays, returning a full focal plane array).
+    # fp_hook is used for BOT runs when present; hook is used otherwise.
 
     def load_user_module(self, name=None):
 
         bail = False
 
-        if self.user_hook is not None:
+        if self.user_module is not None:
             importlib.reload(self.user_module)
         else:
-            self.user_module = __import__(name, fromlist=["init", "hook"])
+            self.user_module = __import__(name, fromlist=["init", "hook", "fp_hook"])
 
-        self.user_hook = self.user_module.hook
+        # a module may supply the per-raft hook, the vectorized fp_hook, or both
+        self.user_hook = getattr(self.user_module, "hook", None)
+        self.user_fp_hook = getattr(self.user_module, "fp_hook", None)
         self.test_transition = True
+
+        # isolated hooks run in a worker process; a new worker imports the current version of the module
+        if self.user_hook_isolated:
+            if self.hook_runner is None:
+                self.hook_runner = userHookRunner(module_name=self.user_module.__name__,
+                                                  timeout=self.user_hook_timeout)
+            else:
+                # after any calls under way, which use the worker being replaced
+                self.hook_runner.run_async(calls=self.hook_runner.restart, done=lambda out: None)
+        self.hook_results = None
+        self.hook_generation += 1
         try:
             print("calling user init")
             mod_init = self.user_module.init
@@ -1177,14 +2129,503 @@ class renderFocalPlane():
         m_new_run = layout(self.interactors, l_new_run)
         self.layout.children = m_new_run.children
 
+    def update_reference_input(self, sattr, old, new):
+        reference_run = new.strip() if new.strip() != "" else None
+        if reference_run == self.reference_run:    # render() syncing the widget
+            return
+        self.reference_run = reference_run
+        self.test_transition = True
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
+    def update_dropdown_compare(self, event):
+        self.compare_op = None if event.item == "off" else event.item
+        self.drop_compare.label = "Compare: " + event.item
+        self.test_transition = True
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
+    def update_mosaic_input(self, sattr, old, new):
+        mosaic_runs = self.parse_run_list(text=new)
+        if mosaic_runs == self.mosaic_runs:    # render() syncing the widget
+            return
+        self.mosaic_runs = mosaic_runs
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
+    def update_playback_input(self, sattr, old, new):
+        playback_runs = self.parse_run_list(text=new)
+        if playback_runs == self.playback_runs:    # render() syncing the widget
+            return
+        self.playback_runs = playback_runs
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
+    def update_dropdown_corr(self, event):
+        self.corr_test = None if event.item == "off" else event.item
+        self.drop_corr.label = "Correlate: " + event.item
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
+    def update_trend_input(self, sattr, old, new):
+        trend_runs = self.parse_run_list(text=new)
+        if trend_runs == self.trend_runs:    # render() syncing the widget
+            return
+        self.trend_runs = trend_runs
+        self.test_transition = True
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
+    def update_toggle_failing(self, active):
+        if active == self.show_failing:    # render() syncing the widget
+            return
+        self.show_failing = active
+        l_new_run = self.render()
+        m_new_run = layout(self.interactors, l_new_run)
+        self.layout.children = m_new_run.children
+
     def update_clear_cache(self):
-        self.test_cache = {}
+        self.data.clear_cache()
+        self.view_memo.clear()
+        self.compare_cache.clear()
+        self.trend_cache.clear()
+        self.aggregate_cache.clear()
+        self.playback_cache = {}
         l_new_run = self.render()
         m_new_run = layout(self.interactors, l_new_run)
         self.layout.children = m_new_run.children
 
         print("Cleared test cache")
 
+    def raft_rows(self, raft=None, raft_codes=None, ccd_codes=None):
+        """
+        Assemble the heatmap rows (one per amp) of one raft slot
+        :param raft: raft slot index, 0-24
+        :param raft_codes: dict (raft name, raft slot) -> code; new rafts are added
+        :param ccd_codes: dict (ccd name, ccd slot) -> code; new CCDs are added
+        :return: dict of lists x, y, raft_code, ccd_code, amp_number, test_q, fp_index; None if there is no data
+        for the slot
+        """
+        rows = {k: [] for k in ["x", "y", "raft_code", "ccd_code", "amp_number", "test_q", "fp_index"]}
+        x = rows["x"]
+        y = rows["y"]
+        raft_code = rows["raft_code"]
+        ccd_code = rows["ccd_code"]
+        amp_number = rows["amp_number"]
+        test_q = rows["test_q"]
+        fp_index = rows["fp_index"]
+
+        if self.raft_is_there[raft] is False:
+            return None
+
+        self.current_raft = self.installed_raft_names[raft]
+        raft_slot_current = self.installed_raft_slots[raft]
+        if self.emulate is True:
+            self.current_run = self.emulated_runs[raft]
+
+        # check the run number again for dev or prod (for mixed mode emulation where runs could be either)
+        self.set_db(run=self.current_run)
+
+        # will discover in get_testq if this is a CR
+        self.solo_corner_raft = False
+
+        try:
+            run_data = self.get_testq(raft_slot=raft_slot_current)
+        except KeyError:
+            #self.current_test = self.previous_test
+            #run_data = self.get_testq(raft_slot=raft_slot_current)
+            return None    # trying to handle case where raft is installed, but no data from it
+
+        num_ccd = 9
+        if not (self.single_ccd_mode or self.solo_ccd_mode):
+
+            # Kludge to use prod geometry for dev runs for full focal plane
+            ccd_list_run = self.raft_contents(raft_name=self.installed_raft_names[raft])
+
+            if self.current_run not in self.ccd_content_cache or self.installed_raft_names[raft] not in \
+                    self.ccd_content_cache[self.current_run]:
+                r = self.ccd_content_cache.setdefault(self.current_run, {})
+                r[self.installed_raft_names[raft]] = ccd_list_run
+
+            # fetch the CCD content from the cache
+            ccd_list = self.ccd_content_cache[self.current_run][self.installed_raft_names[raft]]
+            ccd_map = dict((ccd[1], ccd) for ccd in ccd_list)
+            if self.solo_corner_raft == True:
+                ccd_list = [ccd_map[ccd] for ccd in self.corner_raft_ccd_ordering]
+            else:
+                ccd_list = [ccd_map[ccd] for ccd in self.ccd_ordering]
+
+        else:
+            ccd_list = self.single_ccd_name
+            num_ccd = 1
+        raft_x = self.raft_center_x[raft]
+        raft_y = self.raft_center_y[raft]
+        r_code = raft_codes.setdefault((self.installed_raft_names[raft], self.raft_slot_names[raft]),
+                                       len(raft_codes))
+        fp_raft = fpa.raft_index[raft_slot_current] * fpa.n_ccd
+
+        if raft not in [0, 4, 20, 24] and self.solo_corner_raft == False:
+
+            for ccd in range(num_ccd):
+
+                for amp in range(16):    # fiddling amp order
+                #for amp in self.amp_ordering:
+                    cen_x = raft_x + self.ccd_center_x[ccd]
+                    cen_y = raft_y - self.ccd_center_y[ccd]
+
+                    a_cen_x = cen_x + self.amp_center_x[amp]
+                    a_cen_y = cen_y + self.amp_center_y[amp]
+
+                    x.append(a_cen_x)
+                    y.append(a_cen_y)
+                    raft_code.append(r_code)
+                    ccd_code.append(ccd_codes.setdefault((ccd_list[ccd][0], ccd_list[ccd][1]),
+                                                         len(ccd_codes)))
+                    amp_number.append(self.amp_ordering[amp]+1)  # fiddling amp order
+                    test_q.append(run_data[ccd*16+self.amp_ordering[amp]])  # fiddling amp order
+                    fp_index.append((fp_raft + fpa.ccd_index.get(ccd_list[ccd][1], ccd)) * fpa.n_amp +
+                                    self.amp_ordering[amp])
+                    #amp_number.append(amp+1)
+        elif self.solo_corner_raft == True and self.solo_raft_mode == True and False:  # not needed?
+            for ccd in [1, 2, 5]:
+                for amp in range(16):
+                    cen_x = raft_x + self.ccd_center_x[ccd]
+                    cen_y = raft_y - self.ccd_center_y[ccd]
+
+                    a_cen_x = cen_x + self.amp_center_x[amp]
+                    a_cen_y = cen_y + self.amp_center_y[amp]
+
+                    x.append(a_cen_x)
+                    y.append(a_cen_y)
+                    raft_code.append(r_code)
+                    ccd_code.append(ccd_codes.setdefault((ccd_list[ccd][0], ccd_list[ccd][1]),
+                                                         len(ccd_codes)))
+                    amp_number.append(self.amp_ordering[amp]+1)
+        else:  # get the CR sensor positions
+            CR_slot = self.CR_content[self.CR_slot_index[raft]]
+            name_order_kludge = [2, 3, 0]   # the order in ccd_run_list for SG0, SG1, SW0
+            ccd_idx = 0
+
+            for iccd, slot_name in enumerate(["SG0", "SG1", "SW"]):
+                ccd = CR_slot[slot_name]["pos"]
+
+                if slot_name == "SW":
+                    amp_order = self.corner_raft_amp_ordering_wave
+                else:
+                    amp_order = self.corner_raft_amp_ordering_guider
+
+                for i_amp, amp in enumerate(amp_order):
+                    cen_x = raft_x + self.ccd_center_x[ccd]
+                    cen_y = raft_y - self.ccd_center_y[ccd]
+
+                    a_cen_x = cen_x + self.amp_center_x[i_amp]
+                    a_cen_y = cen_y + self.amp_center_y[i_amp]
+
+                    x.append(a_cen_x)
+                    y.append(a_cen_y)
+                    raft_code.append(r_code)
+                    ccd_n = ccd_list_run[name_order_kludge[iccd]][0]
+
+                    # label the WFS as 2 units with amps 1-8
+                    new_amp = amp
+                    if "SW" in slot_name:
+                        if amp > 7:
+                            slot = slot_name + "1"
+                            new_amp = amp - 8
+                            ccd_n = ccd_list_run[name_order_kludge[iccd]+1][0]
+                        else:
+                            slot = slot_name + "0"
+                    else:
+                        slot = slot_name
+
+                    ccd_code.append(ccd_codes.setdefault((ccd_n, slot), len(ccd_codes)))
+                    amp_number.append(new_amp + 1)
+                    test_val = run_data[int(ccd_idx/2) * 16 + amp]
+                    test_q.append(test_val)  # fiddling amp order
+                    fp_index.append((fp_raft + fpa.ccd_index[slot]) * fpa.n_amp + new_amp)
+
+                ccd_idx += 2
+
+        return rows
+
+    def source_columns(self, rows):
+        """
+        :param rows: dict of lists from raft_rows
+        :return: heatmap source columns as typed arrays - float32 values with NaN for missing amps, so the source
+        goes out with the binary array protocol
+        """
+        return dict(x=np.array(rows["x"], dtype=float), y=np.array(rows["y"], dtype=float),
+                    raft_code=np.array(rows["raft_code"], dtype=np.int8),
+                    ccd_code=np.array(rows["ccd_code"], dtype=np.int16),
+                    amp_number=np.array(rows["amp_number"], dtype=np.int8),
+                    test_q=np.array(rows["test_q"], dtype=np.float32),
+                    alpha=np.full(len(rows["x"]), self.amp_alpha, dtype=np.float32))
+
+    def set_range(self, test_q):
+        """
+        Evaluate the colour range for the displayed values, updating the slider
+        :param test_q: values being displayed
+        :return: (lo, hi)
+        """
+        test_lo, test_hi = fpa.nan_range(test_q)
+        if self.robust_range:
+            test_lo, test_hi = self.robust_limits(test_q)
+        #self.test_slider.end = test_hi
+        #self.test_slider.start = test_lo
+
+        #print("0 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
+        #      self.test_slider.value)
+        if self.test_transition:
+            #print("1 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
+            #      self.test_slider.value)
+            lo_val = test_lo
+            hi_val = test_hi
+
+            if "user" in self.current_test.lower():
+                if self.slider_limits["state"]:
+                    lo_val = self.slider_limits["min"]
+                    hi_val = self.slider_limits["max"]
+                else:
+                    self.test_slider.end = test_hi
+                    self.test_slider.start = test_lo
+
+            self.slider_limits["min"] = lo_val
+            self.slider_limits["max"] = hi_val
+            self.test_slider.value = (lo_val, hi_val)
+            self.test_slider.step = (hi_val - lo_val)/500.
+            self.test_transition = False
+            self.slider_min.value = ""
+            self.slider_max.value = ""
+        elif self.slider_limits["state"]:
+            #print("2 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
+            #      self.test_slider.value)
+            lo_val = self.slider_limits["min"]
+            hi_val = self.slider_limits["max"]
+            self.test_slider.end = hi_val
+            self.test_slider.start = lo_val
+            self.test_slider.value = (lo_val, hi_val)
+            self.test_slider.step = (hi_val - lo_val) / 500.
+        else:
+            #print("3 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
+            #      self.test_slider.value)
+            lo_val = self.test_slider.value[0]
+            hi_val = self.test_slider.value[1]
+
+        return lo_val, hi_val
+
+    def hist_data(self, test_q, lo_val, hi_val):
+        """
+        :param test_q: values being displayed
+        :param lo_val: low end of the histogram range
+        :param hi_val: high end of the histogram range
+        :return: histogram source columns
+        """
+        selected_q = test_q[(test_q >= lo_val) & (test_q <= hi_val)]   # NaN compares False
+        h_q, bins = np.histogram(selected_q, bins=50, range=(lo_val, hi_val))
+        return dict(top=h_q, left=bins[:-1], right=bins[1:])
+
+    def draw_failing(self, x, y, test_q):
+        """
+        Outline the amps failing requirements
+        :param x: amp x positions
+        :param y: amp y positions
+        :param test_q: values being displayed
+        :return: nothing
+        """
+        failing = self.failing_amps(test_q)
+        if failing is not None and failing.any():
+            self.heatmap.rect(x=np.array(x)[failing], y=np.array(y)[failing], width=self.amp_width,
+                              height=self.ccd_width / 2., fill_alpha=0., line_color="red", line_width=2)
+
+    def view_key(self):
+        """
+        :return: (key, dependencies) of the current view for the payload memo: the normalized view state, and
+        the result cache entries the payload is built from. None if the view is not memoized (emulation, user
+        hooks)
+        """
+        if self.emulate or "user" in self.current_test.lower():
+            return None
+        runs = [self.current_run]
+        compare = None
+        if self.compare_active():
+            multi_run = self.compare_op == "slope" or self.compare_op in self.aggregate_ops
+            compare = (self.compare_op, tuple(self.trend_runs) if multi_run else self.reference_run,
+                       self.aggregate_percentile)
+            # multi-run results are cached by their run lists; the trend runs themselves are not kept
+            if not multi_run:
+                runs += [self.reference_run]
+        raft = self.single_raft_name[0][1] if (self.single_raft_mode or self.single_ccd_mode) else None
+        ccd = self.single_ccd_name[0][1] if (self.single_ccd_mode or self.solo_ccd_mode) else None
+        key = (self.current_run, self.current_test, self.current_mode, self.solo_raft_mode, self.solo_ccd_mode,
+               raft, ccd, compare)
+        if self.solo_raft_mode or self.solo_ccd_mode:
+            return key, [self.test_cache.get(run) for run in runs]
+        # BOT runs: the test's arrays, which are there before the rest of the run (see focalPlaneData.fill_run_test)
+        return key, [self.array_cache.get(run, {}).get(self.current_test) for run in runs]
+
+    def memo_lookup(self, view=None):
+        """
+        :param view: view_key()
+        :return: memoized payload for the view, or None. Payloads built from result cache entries that have
+        since been cleared or refetched are dropped
+        """
+        if view is None or view[0] not in self.view_memo:
+            return None
+        payload = self.view_memo[view[0]]
+        if len(payload["deps"]) != len(view[1]) or any(a is not b for a, b in zip(payload["deps"], view[1])):
+            del self.view_memo[view[0]]
+            return None
+        self.view_memo.move_to_end(view[0])
+        return payload
+
+    def drill_down_payload(self, view=None):
+        """
+        Payload of a single raft/CCD view on the focal plane, sliced out of the memoized full focal plane payload
+        of the same run, test and comparison (the amps keep their focal plane positions; the figure ranges
+        to them)
+        :param view: view_key() of the single raft/CCD view
+        :return: payload, or None if not in a drill-down mode or the full focal plane payload is not memoized
+        """
+        if view is None or not (self.single_raft_mode or self.single_ccd_mode):
+            return None
+        key, deps = view
+        full = self.memo_lookup(view=((key[0], key[1], 0, False, False, None, None, key[7]), deps))
+        if full is None:
+            return None
+
+        raft_name, raft_slot = self.single_raft_name[0][:2]
+        columns = full["columns"]
+        raft_codes = [code for code, entry in enumerate(full["raft_table"]) if entry[1] == raft_slot]
+        keep = np.isin(columns["raft_code"], raft_codes)
+        if self.single_ccd_mode:
+            ccd_codes = [code for code, entry in enumerate(full["ccd_table"]) if entry[1] == self.single_ccd_name[0][1]]
+            keep &= np.isin(columns["ccd_code"], ccd_codes)
+        if not keep.any():
+            return None
+
+        return {"columns": {k: v[keep] for k, v in columns.items()}, "raft_table": full["raft_table"],
+                "ccd_table": full["ccd_table"], "fp_index": full["fp_index"][keep], "current_raft": raft_name,
+                "solo_corner_raft": raft_slot in fpa.corner_raft_slots, "hist": OrderedDict()}
+
+    def memo_store(self, view=None, payload=None):
+        if view is None or payload is None or any(dep is None for dep in view[1]):
+            return
+        payload["deps"] = view[1]
+        self.lru_store(cache=self.view_memo, key=view[0], value=payload, size=self.view_memo_size)
+
+    def run_is_cached(self):
+        """
+        :return: True if the data for all rafts on the focal plane is in the cache (for BOT runs, the current
+        test will do)
+        """
+        if not self.emulate:
+            return self.current_run in self.test_cache or \
+                self.current_test in self.array_cache.get(self.current_run, {})
+        return all(self.emulated_runs[raft] in self.test_cache and
+                   self.installed_raft_names[raft] in self.test_cache[self.emulated_runs[raft]]
+                   for raft in range(25) if self.raft_is_there[raft])
+
+    def start_progressive(self, stream_rafts=None, raft_codes=None, ccd_codes=None, color_mapper=None):
+        """
+        Fetch the rafts' data in background threads; each raft's amps are streamed into the heatmap source
+        on the server's event loop as its data arrives. Emulated focal planes are fetched per raft run; a BOT run
+        is one fetch of just the displayed test (see focalPlaneData.fill_run_test), after which its rafts are
+        streamed one per tick
+        :param stream_rafts: raft slot indices still to be drawn
+        :param raft_codes: raft code dict being filled by raft_rows
+        :param ccd_codes: ccd code dict being filled by raft_rows
+        :param color_mapper: heatmap colour mapper
+        :return: nothing
+        """
+        doc = curdoc()
+        generation = self.render_generation
+        self.stream_state = {"rafts": set(stream_rafts), "raft_codes": raft_codes, "ccd_codes": ccd_codes,
+                             "color_mapper": color_mapper}
+        if self.fetch_pool is None:
+            self.fetch_pool = ThreadPoolExecutor(max_workers=self.data.max_fetch_workers)
+
+        def fetch_then_stream(fetch, rafts):
+            try:
+                fetch()
+            except Exception as e:
+                print("Progressive render - fetch failed: ", repr(e))
+            for raft in rafts:
+                doc.add_next_tick_callback(partial(self.stream_raft, raft=raft, generation=generation))
+
+        if self.emulate:
+            # one single raft run per slot
+            for raft in stream_rafts:
+                self.fetch_pool.submit(fetch_then_stream,
+                                       partial(self.data.fill_raft_run_cache, run=self.emulated_runs[raft],
+                                               raft=self.installed_raft_names[raft]), [raft])
+        else:
+            # the whole focal plane comes in one fetch; the rafts are still streamed one per tick
+            self.fetch_pool.submit(fetch_then_stream, partial(self.data.fill_run_test, run=self.current_run,
+                                                              test=self.current_test,
+                                                              done=self.run_done_callback()), stream_rafts)
+
+    def stream_raft(self, raft=None, generation=None):
+        """
+        Append one raft's amps to the heatmap (event loop callback)
+        :param raft: raft slot index
+        :param generation: render the callback belongs to; ignored if the heatmap has been re-rendered since
+        :return: nothing
+        """
+        if generation != self.render_generation or self.stream_state is None:
+            return
+        state = self.stream_state
+
+        rows = None
+        try:
+            rows = self.raft_rows(raft=raft, raft_codes=state["raft_codes"], ccd_codes=state["ccd_codes"])
+        except Exception as e:
+            print("Progressive render - no data for raft slot ", self.raft_slot_names[raft], ": ", repr(e))
+
+        if rows is not None and len(rows["x"]) > 0:
+            self.update_code_tables(raft_codes=state["raft_codes"], ccd_codes=state["ccd_codes"])
+            self.source.stream(self.source_columns(rows))
+            self.fp_index = np.concatenate([self.fp_index, np.array(rows["fp_index"], dtype=np.int16)])
+            # provisional colour range from the amps so far
+            lo, hi = fpa.nan_range(self.source.data["test_q"])
+            state["color_mapper"].update(low=lo, high=hi)
+
+        state["rafts"].discard(raft)
+        if len(state["rafts"]) == 0:
+            self.finish_progressive()
+
+    def update_code_tables(self, raft_codes=None, ccd_codes=None):
+        """
+        Refresh the raft/ccd lookup tables, and the copies the hover formatters hold, as codes are added
+        :return: nothing
+        """
+        self.raft_table = [list(k) for k in raft_codes]
+        self.ccd_table = [list(k) for k in ccd_codes]
+        formatters = self.heatmap.hover.formatters
+        for column, table in [("@raft_code", self.raft_table), ("@ccd_code", self.ccd_table)]:
+            if column in formatters:
+                formatters[column].args["table"].data = dict(self.table_source(table).data)
+
+    def finish_progressive(self):
+        """
+        All rafts are in: evaluate the final colour range and histogram
+        :return: nothing
+        """
+        state = self.stream_state
+        self.stream_state = None
+
+        test_q = np.asarray(self.source.data["test_q"], dtype=np.float32)
+        lo_val, hi_val = self.set_range(test_q)
+        self.histsource.data = self.hist_data(test_q, lo_val, hi_val)
+        state["color_mapper"].update(low=lo_val, high=hi_val)
+        if self.show_failing:
+            self.draw_failing(self.source.data["x"], self.source.data["y"], test_q)
+
     def render(self, view=None, box=None):
 
         """
@@ -1218,7 +2659,7 @@ class renderFocalPlane():
         TOOLS = "pan, wheel_zoom, box_zoom, reset, save, box_select, lasso_select, tap"
         # this could be updated to better choices for the values, but for now
         # low/high are arbitrary to ensure tick marks are plotted
-        color_mapper = LinearColorMapper(palette=palette,low=0,high=1e5)
+        color_mapper = LinearColorMapper(palette=palette,low=0,high=1e5, nan_color="lightgrey")
         color_bar = ColorBar(color_mapper=color_mapper, label_standoff=12,
                              border_line_color=None, location=(0, 0))
 
@@ -1232,17 +2673,31 @@ class renderFocalPlane():
             fig_title = self.single_raft_name[0][0] + " Run: " + self.current_run
         elif self.single_ccd_mode is True or self.solo_ccd_mode is True:
             fig_title = self.single_ccd_name[0][0] + " Run: " + self.current_run
-
-        self.heatmap = figure(
-            title=fig_title, tools=TOOLS, toolbar_location="below",
-            tooltips=[
-                ("Raft", "@raft_name"), ("Raft slot", "@raft_slot"), ("CCD slot", "@ccd_slot"),
-                ("CCD name", "@ccd_name"), ("Amp", "@amp_number"),
-                (self.current_test, "@test_q")
-            ],
-            x_axis_location=None, y_axis_location=None, )
+        if self.compare_active() and self.compare_op == "slope":
+            fig_title += " slope per run over " + str(len(self.trend_runs)) + " runs"
+        elif self.compare_active() and self.compare_op in self.aggregate_ops:
+            op_label = self.compare_op if self.compare_op != "percentile" else \
+                format(self.aggregate_percentile, "g") + "th percentile"
+            fig_title += " " + op_label + " over " + str(len(self.trend_runs)) + " runs"
+        elif self.compare_active():
+            fig_title += " " + self.compare_op + " vs Run: " + self.reference_run
+
+        if self.heatmap_backend == "image":
+            # the image glyph carries its own hover tool
+            self.heatmap = figure(
+                title=fig_title, tools=TOOLS, toolbar_location="below",
+                x_axis_location=None, y_axis_location=None, output_backend=self.output_backend)
+        else:
+            self.heatmap = figure(
+                title=fig_title, tools=TOOLS, toolbar_location="below",
+                tooltips=[
+                    ("Raft", "@raft_code{name}"), ("Raft slot", "@raft_code{slot}"),
+                    ("CCD slot", "@ccd_code{slot}"), ("CCD name", "@ccd_code{name}"), ("Amp", "@amp_number"),
+                    (self.current_test, "@test_q")
+                ],
+                x_axis_location=None, y_axis_location=None, output_backend=self.output_backend)
+            self.heatmap.hover.point_policy = "follow_mouse"
         self.heatmap.grid.grid_line_color = None
-        self.heatmap.hover.point_policy = "follow_mouse"
         self.heatmap.add_layout(color_bar, "right")
 
         if self.full_FP_mode is True and view is not None:
@@ -1250,14 +2705,8 @@ class renderFocalPlane():
         elif self.full_FP_mode is True:
             self.heatmap.rect(x=[0], y=[0], width=15., height=15., color="red", fill_alpha=0.1)
 
-        x = []
-        y = []
-        raft_name = []
-        raft_slot = []
-        ccd_name = []
-        ccd_slot = []
-        amp_number = []
-        test_q = []
+        raft_codes = {}   # (raft name, raft slot) -> code
+        ccd_codes = {}    # (ccd name, ccd slot) -> code
         raft_x_list = []
         raft_y_list = []
         cen_x_list = []
@@ -1265,21 +2714,6 @@ class renderFocalPlane():
 
         setup_time = time.time() - enter_time
 
-        CR_content = {"R40": {"SG0": {"pos": 1, "orient": "up"},
-                              "SG1": {"pos": 5, "orient": "side"},
-                              "SW": {"pos": 2, "orient": "side"}},
-                      "R44": {"SG0": {"pos": 3, "orient": "side"},
-                              "SG1": {"pos": 1, "orient": "up"},
-                              "SW": {"pos": 0, "orient": "up"}},
-                      "R00": {"SG0": {"pos": 5, "orient": "side"},
-                              "SG1": {"pos": 7, "orient": "side"},
-                              "SW": {"pos": 8, "orient": "up"}},
-                      "R04": {"SG0": {"pos": 7, "orient": "up"},
-                              "SG1": {"pos": 3, "orient": "side"},
-                              "SW": {"pos": 6, "orient": "side"}}
-                      }
-        CR_slot_index = {0:"R40", 4:"R44", 20:"R00", 24:"R04"}
-
         # work out all the squares for the rafts, CCDs and amps. If in single mode, suppress other rafts/
         # CCDs
         for raft in range(25):
@@ -1295,163 +2729,73 @@ class renderFocalPlane():
                     cen_x_list.append(cen_x)
                     cen_y_list.append(cen_y)
             else:  # Add the corner rafts
-                for CR_ccd in CR_content[CR_slot_index[raft]]:
-                    pos = CR_content[CR_slot_index[raft]][CR_ccd]["pos"]
+                for CR_ccd in self.CR_content[self.CR_slot_index[raft]]:
+                    pos = self.CR_content[self.CR_slot_index[raft]][CR_ccd]["pos"]
                     cen_x = raft_x + self.ccd_center_x[pos]
                     cen_y = raft_y - self.ccd_center_y[pos]
                     cen_x_list.append(cen_x)
                     cen_y_list.append(cen_y)
 
-        timing_ccd_hierarchy = 0
-
-        t_0_hierarchy = 0
-        t_hierarchy = 0
-
-        for raft in range(25):
-
-            if self.raft_is_there[raft] is False:
-                continue
-
-            self.current_raft = self.installed_raft_names[raft]
-            raft_slot_current = self.installed_raft_slots[raft]
-            if self.emulate is True:
-                self.current_run = self.emulated_runs[raft]
-
-            # check the run number again for dev or prod (for mixed mode emulation where runs could be either)
+        # vectorized user hook: one call for the whole focal plane; only for BOT runs, where the cache holds
+        # the full focal plane arrays. Other modes use the per-raft hook
+        self.user_fp_array = None
+        self.hook_requests = []
+        BOT = not (self.solo_raft_mode or self.solo_ccd_mode) and not self.emulate
+        if self.user_fp_hook is not None and BOT and "user" in self.current_test.lower():
+            self.user_fp_array = self.call_user_fp_hook()
+
+        # progressive: draw the outlines now and stream the amps in as the data arrives (see start_progressive)
+        self.render_generation += 1
+        self.stream_state = None
+        progressive = self.progressive and self.full_FP_mode and view is None and \
+            self.heatmap_backend == "rect" and not self.lod and "user" not in self.current_test.lower() and \
+            not self.compare_active() and self.corr_test is None and len(self.mosaic_runs) == 0 and \
+            len(self.playback_runs) == 0 and not self.run_is_cached()
+
+        # repeated views reuse the assembled payload rather than going through the rafts again
+        view_state = None if progressive else self.view_key()
+        payload = self.memo_lookup(view=view_state)
+        if payload is None:
+            # drilling down from the full focal plane: slice its payload
+            payload = self.drill_down_payload(view=view_state)
+            self.memo_store(view=view_state, payload=payload)
+        if payload is not None:
+            self.update_test_menu()
+            self.current_raft = payload["current_raft"]
+            self.solo_corner_raft = payload["solo_corner_raft"]
             self.set_db(run=self.current_run)
-
-            # will discover in get_testq if this is a CR
-            self.solo_corner_raft = False
-
-            try:
-                run_data = self.get_testq(raft_slot=raft_slot_current)
-            except KeyError:
-                #self.current_test = self.previous_test
-                #run_data = self.get_testq(raft_slot=raft_slot_current)
-                continue    # trying to handle case where raft is installed, but no data from it
-
-            num_ccd = 9
-            if not (self.single_ccd_mode or self.solo_ccd_mode):
-
-                # Kludge to use prod geometry for dev runs for full focal plane
-                db_k = self.dbsel
-                use_run = self.current_run
-                if not self.emulate and not self.chk_11974(self.current_run):
-                    db_k = "Prod"
-                    use_run = 11974
-                ccd_list_run = self.connections["eR"][db_k].raftContents(
-                    raftName=self.installed_raft_names[raft], run=use_run)
-
-                if self.current_run not in self.ccd_content_cache or self.installed_raft_names[raft] not in \
-                        self.ccd_content_cache[self.current_run]:
-                    t_0_hierarchy = time.time()
-                    t_hierarchy = time.time() - t_0_hierarchy
-                    timing_ccd_hierarchy += t_hierarchy
-                    r = self.ccd_content_cache.setdefault(self.current_run, {})
-                    r[self.installed_raft_names[raft]] = ccd_list_run
-
-                # fetch the CCD content from the cache
-                ccd_list = self.ccd_content_cache[self.current_run][self.installed_raft_names[raft]]
-                ccd_map = dict((ccd[1], ccd) for ccd in ccd_list)
-                if self.solo_corner_raft == True:
-                    ccd_list = [ccd_map[ccd] for ccd in self.corner_raft_ccd_ordering]
-                else:
-                    ccd_list = [ccd_map[ccd] for ccd in self.ccd_ordering]
-
-            else:
-                ccd_list = self.single_ccd_name
-                num_ccd = 1
-            raft_x = self.raft_center_x[raft]
-            raft_y = self.raft_center_y[raft]
-
-            if raft not in [0, 4, 20, 24] and self.solo_corner_raft == False:
-
-                for ccd in range(num_ccd):
-
-                    for amp in range(16):    # fiddling amp order
-                    #for amp in self.amp_ordering:
-                        cen_x = raft_x + self.ccd_center_x[ccd]
-                        cen_y = raft_y - self.ccd_center_y[ccd]
-
-                        a_cen_x = cen_x + self.amp_center_x[amp]
-                        a_cen_y = cen_y + self.amp_center_y[amp]
-
-                        x.append(a_cen_x)
-                        y.append(a_cen_y)
-                        raft_name.append(self.installed_raft_names[raft])
-                        raft_slot.append(self.raft_slot_names[raft])
-                        ccd_name.append(ccd_list[ccd][0])
-                        ccd_slot.append(ccd_list[ccd][1])
-                        amp_number.append(self.amp_ordering[amp]+1)  # fiddling amp order
-                        test_q.append(run_data[ccd*16+self.amp_ordering[amp]])  # fiddling amp order
-                        #amp_number.append(amp+1)
-            elif self.solo_corner_raft == True and self.solo_raft_mode == True and False:  # not needed?
-                for ccd in [1, 2, 5]:
-                    for amp in range(16):
-                        cen_x = raft_x + self.ccd_center_x[ccd]
-                        cen_y = raft_y - self.ccd_center_y[ccd]
-
-                        a_cen_x = cen_x + self.amp_center_x[amp]
-                        a_cen_y = cen_y + self.amp_center_y[amp]
-
-                        x.append(a_cen_x)
-                        y.append(a_cen_y)
-                        raft_name.append(self.installed_raft_names[raft])
-                        raft_slot.append(self.raft_slot_names[raft])
-                        ccd_name.append(ccd_list[ccd][0])
-                        ccd_slot.append(ccd_list[ccd][1])
-                        amp_number.append(self.amp_ordering[amp]+1)
-            else:  # get the CR sensor positions
-                CR_slot = CR_content[CR_slot_index[raft]]
-                name_order_kludge = [2, 3, 0]   # the order in ccd_run_list for SG0, SG1, SW0
-                ccd_idx = 0
-
-                for iccd, slot_name in enumerate(["SG0", "SG1", "SW"]):
-                    ccd = CR_slot[slot_name]["pos"]
-
-                    if slot_name == "SW":
-                        amp_order = self.corner_raft_amp_ordering_wave
-                    else:
-                        amp_order = self.corner_raft_amp_ordering_guider
-
-                    for i_amp, amp in enumerate(amp_order):
-                        cen_x = raft_x + self.ccd_center_x[ccd]
-                        cen_y = raft_y - self.ccd_center_y[ccd]
-
-                        a_cen_x = cen_x + self.amp_center_x[i_amp]
-                        a_cen_y = cen_y + self.amp_center_y[i_amp]
-
-                        x.append(a_cen_x)
-                        y.append(a_cen_y)
-                        raft_name.append(self.installed_raft_names[raft])
-                        raft_slot.append(self.raft_slot_names[raft])
-                        ccd_n = ccd_list_run[name_order_kludge[iccd]][0]
-
-                        # label the WFS as 2 units with amps 1-8
-                        new_amp = amp
-                        if "SW" in slot_name:
-                            if amp > 7:
-                                slot = slot_name + "1"
-                                new_amp = amp - 8
-                                ccd_n = ccd_list_run[name_order_kludge[iccd]+1][0]
-                            else:
-                                slot = slot_name + "0"
-                        else:
-                            slot = slot_name
-
-                        ccd_name.append(ccd_n)
-                        ccd_slot.append(slot)
-                        amp_number.append(new_amp + 1)
-                        test_val = run_data[int(ccd_idx/2) * 16 + amp]
-                        test_q.append(test_val)  # fiddling amp order
-
-                    ccd_idx += 2
+        else:
+            rows = {k: [] for k in ["x", "y", "raft_code", "ccd_code", "amp_number", "test_q", "fp_index"]}
+            for raft in range(25):
+                if progressive:
+                    break
+                r_rows = self.raft_rows(raft=raft, raft_codes=raft_codes, ccd_codes=ccd_codes)
+                if r_rows is not None:
+                    for k in rows:
+                        rows[k].extend(r_rows[k])
+
+            # codes are assigned in insertion order, so the dict keys are the lookup tables
+            payload = {"columns": self.source_columns(rows), "raft_table": [list(k) for k in raft_codes],
+                       "ccd_table": [list(k) for k in ccd_codes],
+                       "fp_index": np.array(rows["fp_index"], dtype=np.int16), "current_raft": self.current_raft,
+                       "solo_corner_raft": self.solo_corner_raft, "hist": OrderedDict()}
+            if not progressive:
+                # the key after the raft loop: get_testq may have replaced a test the run does not have
+                self.memo_store(view=self.view_key(), payload=payload)
+
+        columns = payload["columns"]
+        x = columns["x"]
+        y = columns["y"]
 
         ready_data_time = time.time() - enter_time
 
-        self.source = ColumnDataSource(pd.DataFrame(dict(x=x, y=y, raft_name=raft_name, raft_slot=raft_slot,
-                                                         ccd_name=ccd_name, ccd_slot=ccd_slot,
-                                                         amp_number=amp_number, test_q=test_q)))
+        self.raft_table = payload["raft_table"]
+        self.ccd_table = payload["ccd_table"]
+        test_q = columns["test_q"]
+        self.fp_index = payload["fp_index"]
+        # all the view's amps - under level of detail self.source only gets those in view
+        self.amp_columns = columns
+        self.source = ColumnDataSource(data=dict(columns))
 
         # draw all rafts and CCDs in full mode
         if self.full_FP_mode is True:
@@ -1463,61 +2807,26 @@ class renderFocalPlane():
 
         heat_map_done_time = time.time() - enter_time
 
-        test_lo = min(test_q)
-        test_hi = max(test_q)
-        #self.test_slider.end = test_hi
-        #self.test_slider.start = test_lo
-
-        #print("0 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
-        #      self.test_slider.value)
-        if self.test_transition:
-            #print("1 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
-            #      self.test_slider.value)
-            lo_val = test_lo
-            hi_val = test_hi
-
-            if "user" in self.current_test.lower():
-                if self.slider_limits["state"]:
-                    lo_val = self.slider_limits["min"]
-                    hi_val = self.slider_limits["max"]
-                else:
-                    self.test_slider.end = test_hi
-                    self.test_slider.start = test_lo
-
-            self.slider_limits["min"] = lo_val
-            self.slider_limits["max"] = hi_val
-            self.test_slider.value = (lo_val, hi_val)
-            self.test_slider.step = (hi_val - lo_val)/500.
-            self.test_transition = False
-            self.slider_min.value = ""
-            self.slider_max.value = ""
-        elif self.slider_limits["state"]:
-            #print("2 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
-            #      self.test_slider.value)
-            lo_val = self.slider_limits["min"]
-            hi_val = self.slider_limits["max"]
-            self.test_slider.end = hi_val
-            self.test_slider.start = lo_val
-            self.test_slider.value = (lo_val, hi_val)
-            self.test_slider.step = (hi_val - lo_val) / 500.
+        if progressive:
+            # the colour range is evaluated as the rafts arrive
+            lo_val, hi_val = self.test_slider.value
         else:
-            #print("3 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
-            #      self.test_slider.value)
-            lo_val = self.test_slider.value[0]
-            hi_val = self.test_slider.value[1]
+            lo_val, hi_val = self.set_range(test_q)
 
         #print("4 ", self.slider_limits, self.test_transition, self.test_slider.start, self.test_slider.end,
         #      self.test_slider.value)
-        np_array = np.array(test_q)
-        selected_q = [q for q in np_array if lo_val <= q <= hi_val]
-        h_q, bins = np.histogram(selected_q, bins=50, range=(lo_val, hi_val))
-        self.histsource = ColumnDataSource(pd.DataFrame(dict(top=h_q, left=bins[:-1], right=bins[1:])))
+        hist_key = (float(lo_val), float(hi_val))
+        if hist_key not in payload["hist"]:
+            self.lru_store(cache=payload["hist"], key=hist_key, value=self.hist_data(test_q, lo_val, hi_val),
+                           size=self.hist_memo_size)
+        payload["hist"].move_to_end(hist_key)
+        self.histsource = ColumnDataSource(data=dict(payload["hist"][hist_key]))
         # Using numpy to get the index of the bins to which the value is assigned
-        h = figure(title=self.current_test, tools=TOOLS, toolbar_location="below")
+        h = figure(title=self.current_test, tools=TOOLS, toolbar_location="below",
+                   output_backend=self.output_backend)
         h.quad(source=self.histsource, top='top', bottom=0, left='left', right='right', fill_color='blue',
                fill_alpha=0.2)
-        self.source.selected.on_change('indices', self.tap_cb)
-        self.histsource.on_change('selected', self.select_cb)
+        self.heatmap.on_event(Tap, self.tap_heatmap)
 
         cm = self.heatmap.select_one(LinearColorMapper)
 
@@ -1528,11 +2837,27 @@ class renderFocalPlane():
                                 width=self.ccd_width/2.,
                                 color="black",
                                 fill_alpha=0.7, fill_color="black",view=view, line_width = 0.5)
-        self.heatmap.rect(x='x', y='y', source=self.source, width=self.amp_width,
-                          height=self.ccd_width / 2.,
-                          color="black",
-                          fill_alpha=0.7, fill_color={'field': 'test_q', 'transform': color_mapper},
-                          line_width=0.5)
+        amp_renderer = None
+        image_renderer = None
+        self.lod_renderers = None
+        if self.heatmap_backend == "image":
+            image_renderer = self.draw_image_heatmap(x, y, test_q, color_mapper)
+        else:
+            self.image_lookup = None
+            amp_renderer = self.heatmap.rect(x='x', y='y', source=self.source, width=self.amp_width,
+                                             height=self.ccd_width / 2.,
+                                             color="black",
+                                             fill_alpha='alpha',
+                                             fill_color={'field': 'test_q', 'transform': color_mapper},
+                                             line_width=0.5)
+            self.heatmap.hover.formatters = self.code_formatters()
+            if self.lod and self.full_FP_mode and view is None:
+                self.setup_lod(amp_renderer, color_mapper, lo_val, hi_val)
+        self.histsource.selected.js_on_change('indices', self.hist_select_callback(
+            glyph=amp_renderer.glyph if amp_renderer is not None else None, image=image_renderer,
+            tiles=self.ccd_tile_source if self.lod_renderers is not None else None))
+        if self.show_failing and not progressive:
+            self.draw_failing(x, y, test_q)
         if box is not None:
             h.add_layout(box)
         xaxis = LinearAxis()
@@ -1541,13 +2866,57 @@ class renderFocalPlane():
         h.add_layout(Grid(dimension=0, ticker=xaxis.ticker))
         h.add_layout(Grid(dimension=1, ticker=yaxis.ticker))
 
-        self.map_layout = layout(row(self.heatmap, h))
+        self.toggle_failing.active = self.show_failing
+        self.reference_input.value = self.reference_run if self.reference_run is not None else ""
+        if self.parse_run_list(text=self.trend_input.value) != self.trend_runs:
+            self.trend_input.value = ", ".join(self.trend_runs)
+        self.drop_compare.label = "Compare: " + (self.compare_op if self.compare_op is not None else "off")
+        if self.current_run in self.array_cache:
+            self.drop_corr.menu = [("No correlation", "off")] + [(t, t) for t in self.array_cache[self.current_run]]
+        panels = [row(self.heatmap, h)]
+        if self.playback_active(view=view):
+            playback = self.playback_controls(amp_renderer=amp_renderer, color_mapper=color_mapper)
+            if playback is not None:
+                panels.append(playback)
+        panels.append(row(self.toggle_failing, self.drop_compare, self.reference_input, self.trend_input,
+                          self.drop_corr))
+        if self.parse_run_list(text=self.mosaic_input.value) != self.mosaic_runs:
+            self.mosaic_input.value = ", ".join(self.mosaic_runs)
+        if self.parse_run_list(text=self.playback_input.value) != self.playback_runs:
+            self.playback_input.value = ", ".join(self.playback_runs)
+        panels.append(row(self.mosaic_input, self.playback_input))
+        corr = self.corr_plot()
+        if corr is not None:
+            panels.append(row(corr))
+        mosaic = self.mosaic_plot()
+        if mosaic is not None:
+            panels.append(mosaic)
+        trend = self.trend_plot()
+        if trend is not None:
+            panels.append(row(trend))
+        if self.hook_runner is not None:
+            self.hook_stats.text = self.hook_runner.stats_text()
+            if len(self.hook_requests) > 0:
+                self.hook_stats.text += " - running the hook, the amps are drawn when it returns"
+            panels.append(row(self.hook_stats))
+        if self.show_summary:
+            summary = self.summary_table()
+            if summary is not None:
+                panels.append(row(summary))
+        self.map_layout = layout(panels)
+
+        if progressive:
+            self.start_progressive(stream_rafts=[raft for raft in range(25) if self.raft_is_there[raft]],
+                                   raft_codes=raft_codes, ccd_codes=ccd_codes, color_mapper=color_mapper)
+        self.submit_hooks()
+
+        # the run's new metadata lookups go to the cache file in one write
+        self.data.metadata.flush()
 
         done_time = time.time() - enter_time
 
         print("Timing: e ", enter_time, " s ", setup_time, " r ", ready_data_time, " h ",
-              heat_map_done_time, " d ", done_time, " t ", self.testq_timer, " h_ccd ",
-              timing_ccd_hierarchy)
+              heat_map_done_time, " d ", done_time, " t ", self.testq_timer)
 
         self.previous_test = self.current_test
 
@@ -0,0 +1,71 @@
+from __future__ import print_function
+import numpy as np
+import focalPlaneArrays as fpa
+
+"""
+Streaming per-amp aggregate of a test quantity over many runs, fed one focal plane array (see
+focalPlaneArrays) at a time so that no more than one run needs to be held.
+
+Mean and standard deviation are exact (Welford's update: O(amps) memory). Medians and percentiles come
+from a per-amp uniform reservoir sample of reservoir_size runs: exact up to that many runs with data for
+the amp, an estimate beyond. Missing (NaN) values are skipped amp by amp.
+"""
+
+
+class runAggregator():
+
+    def __init__(self, reservoir_size=64, seed=0):
+
+        shape = (fpa.n_raft, fpa.n_ccd, fpa.n_amp)
+        self.reservoir_size = reservoir_size
+        self.rng = np.random.default_rng(seed)
+
+        self.n = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.reservoir = np.full((reservoir_size,) + shape, np.nan, dtype=np.float32)
+        self.runs = []
+
+    def add(self, arr=None, run=None):
+        """
+        Fold one run into the aggregate
+        :param arr: (25, 9, 16) focal plane array of the run
+        :param run: run number, for the record
+        :return: nothing
+        """
+        valid = np.isfinite(arr)
+        values = np.where(valid, arr, 0.).astype(np.float64)
+
+        self.n += valid
+        n = np.maximum(self.n, 1)
+        delta = np.where(valid, values - self.mean, 0.)
+        self.mean += delta / n
+        self.m2 += np.where(valid, delta * (values - self.mean), 0.)
+
+        # reservoir: the k-th value of an amp goes in slot k while there is room, then replaces a random slot
+        # with probability reservoir_size / k
+        slot = np.where(self.n <= self.reservoir_size, self.n - 1, self.rng.integers(0, n))
+        take = valid & (slot < self.reservoir_size)
+        self.reservoir[(slot[take],) + take.nonzero()] = arr[take]
+        self.runs.append(run)
+
+    def result(self, op="mean", percentile=90.):
+        """
+        :param op: "mean", "std", "median" or "percentile"
+        :param percentile: percentile for op "percentile"
+        :return: (25, 9, 16) float32 array; NaN for amps with no data (or a single value, for std)
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if op == "mean":
+                out = np.where(self.n > 0, self.mean, np.nan)
+            elif op == "std":
+                out = np.where(self.n > 1, np.sqrt(self.m2 / (self.n - 1)), np.nan)
+            elif op in ["median", "percentile"]:
+                q = 50. if op == "median" else percentile
+                filled = np.isfinite(self.reservoir).any(axis=0)
+                out = np.full(self.n.shape, np.nan)
+                out[filled] = np.nanpercentile(self.reservoir[:, filled], q, axis=0)
+            else:
+                print("Unknown aggregate: ", op)
+                raise ValueError
+        return out.astype(np.float32)
@@ -0,0 +1,108 @@
+from __future__ import print_function
+import json
+import struct
+import zlib
+import argparse
+import numpy as np
+import focalPlaneArrays as fpa
+
+"""
+Single file bundle of everything needed to display one BOT run without eTraveler access: the run info,
+focal plane and raft contents, the available test menu and every test quantity as a focal plane array.
+
+Layout:
+    8 bytes   magic "EOBUNDLE"
+    8 bytes   little-endian uint64 length of the json header
+    header    json: run, tests, menu, contents, layouts, compression, ...
+    padding   to a 64 byte boundary
+    data      float32 array (n_tests, 25, 9, 16), C order; zlib compressed if header["compression"] is "zlib"
+
+Uncompressed bundles are memory-mapped on reading, so only the tests actually displayed are read from disk.
+
+Write a bundle with
+    python runBundle.py -r 12345 -o run12345.eob [--compress]
+"""
+
+MAGIC = b"EOBUNDLE"
+ALIGN = 64
+FP_SHAPE = (fpa.n_raft, fpa.n_ccd, fpa.n_amp)
+
+
+def data_offset(header_len):
+    offset = len(MAGIC) + 8 + header_len
+    return offset + (-offset) % ALIGN
+
+
+def write_bundle(file_spec=None, header=None, arrays=None, compress=False):
+    """
+    :param file_spec: output file
+    :param header: dict of json-serializable run information
+    :param arrays: dict {test name: (25, 9, 16) focal plane array}
+    :param compress: zlib compress the data block (the bundle can then not be memory-mapped)
+    :return: nothing
+    """
+    tests = list(arrays)
+    data = np.ascontiguousarray(np.stack([arrays[test] for test in tests]) if len(tests) > 0 else
+                                np.zeros((0,) + FP_SHAPE), dtype=np.float32).tobytes()
+    if compress:
+        data = zlib.compress(data)
+
+    header = dict(header, version=1, tests=tests, shape=[len(tests)] + list(FP_SHAPE), dtype="float32",
+                  compression="zlib" if compress else None, data_length=len(data))
+    header_bytes = json.dumps(header).encode("utf-8")
+    offset = data_offset(len(header_bytes))
+
+    with open(file_spec, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * (offset - len(MAGIC) - 8 - len(header_bytes)))
+        f.write(data)
+
+
+def read_bundle(file_spec=None):
+    """
+    :param file_spec: bundle file
+    :return: (header dict, dict {test name: (25, 9, 16) float32 array}). The arrays are read-only views of a
+    memory map for uncompressed bundles
+    """
+    with open(file_spec, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            print("Not a run bundle: ", file_spec)
+            raise ValueError
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        offset = data_offset(header_len)
+
+        shape = tuple(header["shape"])
+        if header["compression"] == "zlib":
+            f.seek(offset)
+            block = np.frombuffer(zlib.decompress(f.read(header["data_length"])), dtype=np.float32).reshape(shape)
+        elif shape[0] == 0:
+            block = np.zeros(shape, dtype=np.float32)
+        else:
+            block = np.memmap(file_spec, dtype=np.float32, mode="r", offset=offset, shape=shape)
+
+    return header, {test: block[i] for i, test in enumerate(header["tests"])}
+
+
+if __name__ == "__main__":
+
+    from focalPlaneData import focalPlaneData
+
+    ## Command line arguments
+    parser = argparse.ArgumentParser(
+        description='Write a BOT run bundle for offline display with serveRenderFP.py/plot_EOtest_results.py')
+
+    parser.add_argument('-r', '--run', required=True, help="run number")
+    parser.add_argument('-o', '--output', default=None, help="bundle file (default=run<run>.eob)")
+    parser.add_argument('--compress', action='store_true', help="compress the data (disables memory mapping)")
+    parser.add_argument('--archive', default=None, help="local archive file of EO results (see eoArchive)")
+
+    args = parser.parse_args()
+
+    fpD = focalPlaneData()
+    if args.archive is not None:
+        fpD.use_archive(db_file=args.archive)
+    out_file = args.output if args.output is not None else "run" + args.run + ".eob"
+    fpD.export_bundle(run=args.run, file_spec=out_file, compress=args.compress)
@@ -1,5 +1,7 @@
 from __future__ import print_function
 from renderFocalPlane import renderFocalPlane
+from metadataCache import metadataCache
+from eoRequirements import eoRequirements
 from bokeh.plotting import curdoc
 from bokeh.io import export_png
 from bokeh.layouts import row, layout
@@ -23,32 +25,93 @@ parser = argparse.ArgumentParser(
 parser.add_argument('-t', '--test', default="gain", help="test quantity to display")
 parser.add_argument('-r', '--run', default=None, help="run number")
 parser.add_argument('--hook', default=None, help="name of user hook module to load")
+parser.add_argument('--hook_isolated', action='store_true',
+                    help="run the user hook in a worker process with a per-call timeout")
+parser.add_argument('--hook_timeout', default=10., type=float, help="user hook timeout (s) when isolated")
 parser.add_argument('-p', '--png', default=None, help="file spec for output png of heatmap")
 parser.add_argument('-e', '--emulate', default=None, help="file spec for emulation config")
 parser.add_argument('-m', '--mode', default="full_FP", help="heatmap viewing mode")
 parser.add_argument('-d', '--db', default="Prod", help="eT database")
+parser.add_argument('--heatmap', default="rect", choices=["rect", "image"],
+                    help="heatmap glyphs: a rect per amp, or a single rasterized image")
+parser.add_argument('--lod', action='store_true',
+                    help="full focal plane: draw CCD summary tiles until zoomed in, then only the visible amps")
+parser.add_argument('--progressive', action='store_true',
+                    help="full focal plane: draw the outlines at once and add the amps as the data arrives - per raft "
+                         "in emulation mode; for BOT runs, all rafts once the displayed test is fetched")
+parser.add_argument('--robust_range', action='store_true',
+                    help="auto-range the colour scale on the 1st-99th percentiles")
+parser.add_argument('--summary', action='store_true', help="show the table of summary statistics")
+parser.add_argument('--reference', default=None, help="reference run for comparison mode")
+parser.add_argument('--compare', default=None,
+                    choices=["difference", "ratio", "slope", "mean", "median", "std", "percentile"],
+                    help="show the difference or ratio of the run to the reference run, or the slope per run "
+                         "or a per-amp aggregate over the trend runs")
+parser.add_argument('--percentile', default=90., type=float,
+                    help="percentile for --compare percentile (default=%(default)s)")
+parser.add_argument('--mosaic', default="", help="mosaic runs, shown side by side, e.g. 12540,12545-12547")
+parser.add_argument('--playback', default="", help="playback runs, stepped through in the heatmap, e.g. 12540-12640")
+parser.add_argument('--trend', default="", help="trend runs, e.g. 12540-12560,12600")
+parser.add_argument('--failing', action='store_true', help="outline the amps failing requirements")
+parser.add_argument('--requirements', default=None,
+                    help="csv file of additional requirements: test, threshold, direction, id")
+parser.add_argument('--metadata_cache', default=None,
+                    help="json file persisting run info and focal plane/raft contents between sessions")
+parser.add_argument('--bundle', default=None,
+                    help="run bundle file (see runBundle) - display the run with no database access")
+parser.add_argument('--archive', default=None, help="local archive file of EO results (see eoArchive)")
+parser.add_argument('-b', '--backend', default="canvas", choices=["canvas", "webgl"],
+                    help="bokeh output backend")
 
 p_args = parser.parse_args()
 
 rFP = renderFocalPlane(db=p_args.db)
+if p_args.metadata_cache is not None:
+    rFP.data.metadata = metadataCache(cache_file=p_args.metadata_cache)
+if p_args.archive is not None:
+    rFP.data.use_archive(db_file=p_args.archive)
+rFP.data.requirements = eoRequirements(req_file=p_args.requirements)
 
 if p_args.emulate is not None:
     rc = rFP.set_emulation(config_spec=p_args.emulate)
 else:
     rFP.current_run = p_args.run
 
+if p_args.bundle is not None:
+    bundle_run = rFP.data.load_bundle(file_spec=p_args.bundle)
+    if p_args.run is None:
+        rFP.current_run = bundle_run
+
 rFP.current_test = p_args.test
+rFP.heatmap_backend = p_args.heatmap
+rFP.output_backend = p_args.backend
+rFP.lod = p_args.lod
+rFP.progressive = p_args.progressive
+rFP.robust_range = p_args.robust_range
+rFP.show_summary = p_args.summary
+rFP.show_failing = p_args.failing
+rFP.reference_run = p_args.reference
+rFP.compare_op = p_args.compare
+rFP.aggregate_percentile = p_args.percentile
+rFP.trend_runs = rFP.parse_run_list(text=p_args.trend)
+rFP.mosaic_runs = rFP.parse_run_list(text=p_args.mosaic)
+rFP.playback_runs = rFP.parse_run_list(text=p_args.playback)
 
 # don't set single mode yet!
 
 rFP.set_mode(p_args.mode)
 
+rFP.user_hook_isolated = p_args.hook_isolated
+rFP.user_hook_timeout = p_args.hook_timeout
+
 if p_args.hook is not None:
     rFP.load_user_module(name=p_args.hook)
 
 m_lay = rFP.render()
 
 if p_args.png is not None:
+    # isolated hooks return after the render (see renderFocalPlane.submit_hooks)
+    rFP.wait_for_hooks()
     export_png(rFP.map_layout, p_args.png)
 
 if rFP.map_layout is None:  # handle startup screen case
@@ -0,0 +1,227 @@
+from __future__ import print_function
+import importlib
+import multiprocessing
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import focalPlaneArrays as fpa
+
+"""
+Run user hook modules in a worker process, with a per-call timeout, so that a slow or hung hook cannot
+stall the Bokeh server event loop. The server does not wait for the worker either: run_async makes the calls,
+and waits on them, in a separate thread and hands the results to a callback (see renderFocalPlane.hook_done).
+
+The per-raft hook gets the same arguments as when run in-process, except that test_cache only holds the
+current run's results for the raft (see renderFocalPlane.hook_test_cache) - it is pickled across per call.
+Once a call times out or fails, the remaining per-raft calls of the batch are skipped (see new_render), so a
+hung hook costs one timeout per render rather than one per raft. For the vectorized fp_hook the run's focal
+plane arrays are passed through shared memory, as is the returned array. The worker imports the module
+itself; restart() replaces the worker so a fresh copy of the module is imported. The worker is also replaced
+after a timeout or any failure that is not the hook's own exception (e.g. arguments that cannot be pickled,
+or a worker that died).
+"""
+
+FP_SHAPE = (fpa.n_raft, fpa.n_ccd, fpa.n_amp)
+
+# modules imported in this (worker) process
+_modules = {}
+
+
+def _load(module_name):
+    if module_name not in _modules:
+        _modules[module_name] = importlib.import_module(module_name)
+    return _modules[module_name]
+
+
+class userHookError(Exception):
+    """
+    An exception raised by the user module itself, as opposed to a failure of the worker
+    """
+    pass
+
+
+def _run_hook(module_name, kwargs):
+    t_start = time.time()
+    try:
+        out = np.asarray(_load(module_name).hook(**kwargs), dtype=np.float32)
+    except Exception as e:
+        raise userHookError(repr(e))
+    return out, kwargs["range_limits"], time.time() - t_start
+
+
+def _run_fp_hook(module_name, in_name, tests, out_name, kwargs):
+    # the parent owns (and unlinks) the blocks; spawned workers share its resource tracker
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        t_start = time.time()
+        arr = np.ndarray((len(tests),) + FP_SHAPE, dtype=np.float32, buffer=shm_in.buf)
+        store = {test: arr[i] for i, test in enumerate(tests)}
+        try:
+            out = _load(module_name).fp_hook(store=store, **kwargs)
+        except Exception as e:
+            raise userHookError(repr(e))
+        np.ndarray(FP_SHAPE, dtype=np.float32, buffer=shm_out.buf)[:] = out
+        del arr, store
+        return kwargs["range_limits"], time.time() - t_start
+    finally:
+        for shm in [shm_in, shm_out]:
+            try:
+                shm.close()
+            except BufferError:   # the hook kept a reference to the shared arrays
+                pass
+
+
+class userHookRunner():
+
+    def __init__(self, module_name=None, timeout=10.):
+
+        self.module_name = module_name
+        self.timeout = timeout
+        self.pool = None
+        # the thread the calls are made and waited on in (see run_async) - one at a time, as there is one worker
+        self.waiter = ThreadPoolExecutor(max_workers=1)
+
+        self.stats = {"calls": 0, "total_time": 0., "max_time": 0., "last_time": 0., "timeouts": 0,
+                      "errors": 0, "skipped": 0, "last_error": ""}
+        # set by a timeout or error; the rest of the render's per-raft calls are skipped
+        self.render_failed = False
+
+        self.start()
+
+    def start(self):
+        # spawn rather than fork: the server process runs threads (tornado) that fork does not mix well with
+        self.pool = multiprocessing.get_context("spawn").Pool(processes=1)
+
+    def restart(self):
+        """
+        Replace the worker process - used on timeouts and to pick up a modified user module
+        :return: nothing
+        """
+        self.pool.terminate()
+        self.pool.join()
+        self.start()
+
+    def shutdown(self):
+        self.waiter.shutdown(wait=False)
+        self.pool.terminate()
+        self.pool.join()
+
+    def new_render(self):
+        self.render_failed = False
+
+    def run_async(self, calls=None, done=None):
+        """
+        Make hook calls off the caller's thread (the server's event loop)
+        :param calls: function making the calls with call_hook/call_fp_hook, run in the waiter thread
+        :param done: called with the return value of calls, from the waiter thread
+        :return: Future of the return value of calls
+        """
+        def run():
+            try:
+                out = calls()
+            except Exception as e:
+                print("User hook calls failed: ", repr(e))
+                out = None
+            done(out)
+            return out
+        return self.waiter.submit(run)
+
+    def _wait(self, func, args):
+        """
+        Call a worker function and wait for it, keeping the timing stats
+        :param func: worker function
+        :param args: its arguments
+        :return: the call's return value, or None on timeout or error
+        """
+        self.stats["calls"] += 1
+        t_start = time.time()
+        try:
+            out = self.pool.apply_async(func, args).get(timeout=self.timeout)
+        except userHookError as e:
+            self.stats["errors"] += 1
+            self.stats["last_error"] = str(e)
+            print("User hook failed: ", str(e))
+            self.render_failed = True
+            out = None
+        except multiprocessing.TimeoutError:
+            self.stats["timeouts"] += 1
+            self.stats["last_error"] = "timed out after " + str(self.timeout) + " s"
+            print("User hook timed out after ", self.timeout, " s - restarting worker")
+            self.restart()
+            self.render_failed = True
+            out = None
+        except Exception as e:
+            # not raised by the hook - the worker or the call itself is broken
+            self.stats["errors"] += 1
+            self.stats["last_error"] = repr(e)
+            print("User hook worker failed: ", repr(e), " - restarting worker")
+            self.restart()
+            self.render_failed = True
+            out = None
+
+        elapsed = time.time() - t_start
+        self.stats["last_time"] = elapsed
+        self.stats["total_time"] += elapsed
+        self.stats["max_time"] = max(self.stats["max_time"], elapsed)
+        return out
+
+    def call_hook(self, **kwargs):
+        """
+        Call the per-raft hook in the worker
+        :param kwargs: hook arguments
+        :return: float32 array, or None on timeout or error, or if an earlier call of this render failed.
+        range_limits is updated from the worker's copy
+        """
+        if self.render_failed:
+            self.stats["skipped"] += 1
+            return None
+        out = self._wait(_run_hook, (self.module_name, kwargs))
+        if out is None:
+            return None
+        values, range_limits, _ = out
+        kwargs["range_limits"].update(range_limits)
+        return values
+
+    def call_fp_hook(self, store=None, **kwargs):
+        """
+        Call the vectorized hook in the worker, passing the focal plane arrays through shared memory
+        :param store: dict {test name: (25, 9, 16) array}
+        :param kwargs: remaining hook arguments
+        :return: (25, 9, 16) float32 array, or None on timeout or error
+        """
+        tests = list(store)
+        n_bytes = np.dtype(np.float32).itemsize * int(np.prod(FP_SHAPE))
+        shm_in = shared_memory.SharedMemory(create=True, size=max(1, len(tests)) * n_bytes)
+        shm_out = shared_memory.SharedMemory(create=True, size=n_bytes)
+        try:
+            arr_in = np.ndarray((len(tests),) + FP_SHAPE, dtype=np.float32, buffer=shm_in.buf)
+            for i, test in enumerate(tests):
+                arr_in[i] = store[test]
+            del arr_in
+
+            out = self._wait(_run_fp_hook, (self.module_name, shm_in.name, tests, shm_out.name, kwargs))
+            if out is None:
+                return None
+            range_limits, _ = out
+            kwargs["range_limits"].update(range_limits)
+            return np.ndarray(FP_SHAPE, dtype=np.float32, buffer=shm_out.buf).copy()
+        finally:
+            for shm in [shm_in, shm_out]:
+                shm.close()
+                shm.unlink()
+
+    def stats_text(self):
+        """
+        :return: one-line summary of the hook timing stats
+        """
+        s = self.stats
+        mean = s["total_time"] / s["calls"] if s["calls"] > 0 else 0.
+        text = "User hook (%s): %d calls, last %.3f s, mean %.3f s, max %.3f s, %d timeouts, %d errors" % (
+            self.module_name, s["calls"], s["last_time"], mean, s["max_time"], s["timeouts"], s["errors"])
+        if s["skipped"] > 0:
+            text += ", %d skipped" % s["skipped"]
+        if s["last_error"] != "":
+            text += " - last problem: " + s["last_error"]
+        return text
@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def init(menu_button=None):
+    print("user init setting up menu")
+    my_menu = [("User noise ratio", "User noise ratio")]
+
+    menu_button.menu = my_menu
+
+    return 0
+
+
+def fp_hook(run=None, mode=None, store=None, test=None, range_limits=None):
+    """
+    Vectorized user hook, called once per render for the whole focal plane
+    :param run: run number
+    :param mode: display mode
+    :param store: the run's cached results - dict {test name: (25, 9, 16) float32 array} indexed by raft slot,
+    CCD position and amp (see focalPlaneArrays)
+    :param test: user test name
+    :param range_limits: slider limits dict
+    :return: (25, 9, 16) array of user-supplied quantities; NaN for missing amps
+    """
+
+    # ratio of total to read noise for every amp in one operation
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return store["total_noise"] / store["read_noise"]
@@ -21,7 +21,7 @@ def hook(run=None, mode=None, raft=None, ccd=None, test_cache=None, test=None, r
     """
     User hook for test quantity
     :param run: run number
-    :return: list of user-supplied quantities to be included in the heat map
+    :return: list of user-supplied quantities to be included in the heat map; NaN for missing amps
     """
 # SW0 and SW1 only use 0-7 for resukts. Arrange the indexes to overwrite the back half of
 # SW0 with the front half of SW1
@@ -36,12 +36,12 @@ def hook(run=None, mode=None, raft=None, ccd=None, test_cache=None, test=None, r
 
     if raft in ["R00", "R04", "R40", "R44"]:
         test_len = 48
-        out_list = [-1.] * test_len
+        out_list = [np.nan] * test_len
         return out_list
     else:
         test_len = 144
 
-    out_list = [-1.]*test_len
+    out_list = [np.nan]*test_len
 
     for ccd in slot_index:
         if "SG" in ccd or "SW" in ccd:   # ignore CR